@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+#
+#    Authors:
+#        Pavel Březina <pbrezina@redhat.com>
+#
+#    Copyright (C) 2019 Red Hat
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import re
+import shlex
+import tempfile
+import textwrap
+
+import nutcli
+from nutcli.commands import Command
+from nutcli.parser import UniqueAppendAction
+from nutcli.tasks import Task, TaskList
+
+from commands.vagrant import (VagrantHaltActor, VagrantSSHActor,
+                              VagrantUpActor)
+from util.actor import TestSuiteActor
+from util.folders import SharedFolders
+
+
+class BenchFoldersActor(TestSuiteActor):
+    Transports = ['sshfs', 'sshfs-cached', 'nfs', 'virtiofs']
+
+    Script = textwrap.dedent('''
+    set -e
+    now() {{ date +%s%N; }}
+    elapsed() {{ echo "$1=$(( ($(now) - $2) / 1000000 ))"; }}
+
+    dir={dir}/bench
+    rm -fr $dir
+    mkdir -p $dir
+
+    start=$(now)
+    for i in $(seq 1 {files}); do echo $i > $dir/file-$i; done
+    elapsed create $start
+
+    start=$(now)
+    for i in $(seq 1 {files}); do stat $dir/file-$i > /dev/null; done
+    elapsed stat $start
+
+    start=$(now)
+    rm -f $dir/file-*
+    elapsed remove $start
+
+    start=$(now)
+    dd if=/dev/zero of=$dir/bulk bs=1M count={size} conv=fsync status=none
+    elapsed write $start
+
+    sync && echo 3 > /proc/sys/vm/drop_caches
+    start=$(now)
+    dd if=$dir/bulk of=/dev/null bs=1M status=none
+    elapsed read $start
+
+    rm -fr $dir
+    ''')
+
+    Columns = ['create', 'stat', 'remove', 'write', 'read']
+
+    def setup_parser(self, parser):
+        parser.add_argument(
+            'transports', nargs='*',
+            choices=['all'] + self.Transports,
+            action=UniqueAppendAction,
+            default='all',
+            help='Transports to benchmark. Multiple transports can be set. '
+                 '(Default "all")'
+        )
+
+        parser.add_argument(
+            '-n', '--files', action='store', type=int, dest='files',
+            default=1000,
+            help='Number of files in metadata workload (Default 1000)'
+        )
+
+        parser.add_argument(
+            '--size', action='store', type=int, dest='size', default=256,
+            help='Size of bulk workload file in MiB (Default 256)'
+        )
+
+        parser.epilog = textwrap.dedent('''
+        Client guest is started with one shared folder for each transport
+        mounted at /shared/bench/$transport. Then a metadata heavy workload
+        (create, stat and remove many small files) and a bulk workload
+        (write and read one large file) is run in each folder. The guest is
+        halted when the benchmark is finished.
+
+        Transports that are not available on this host are skipped.
+        ''')
+
+    def __call__(self, transports, files=1000, size=256):
+        transports = self._get_transports(transports)
+        results = {}
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            folders = SharedFolders()
+            for transport in transports:
+                hostdir = f'{tmpdir}/{transport}'
+                os.makedirs(hostdir)
+                folders.add(transport, hostdir, f'/shared/bench/{transport}')
+
+            upshell = nutcli.shell.Shell(env=folders.get_env())
+
+            TaskList('Shared folders benchmark', logger=self.logger)([
+                Task('Halting client')(
+                    VagrantHaltActor(parent=self), ['client']
+                ),
+                Task('Starting client')(
+                    VagrantUpActor(parent=self, shell=upshell), ['client']
+                ),
+                *[
+                    Task(f'Benchmarking {transport}')(
+                        self.bench, results, transport, files, size
+                    ) for transport in transports
+                ],
+                Task('Halting client', always=True)(
+                    VagrantHaltActor(parent=self), ['client']
+                ),
+            ]).execute()
+
+        self.print_results(results)
+
+    def _get_transports(self, transports):
+        transports = nutcli.utils.get_as_list(transports)
+        if 'all' in transports:
+            transports = self.Transports
+
+        available = []
+        for transport in transports:
+            if transport == 'virtiofs' and not SharedFolders.virtiofs_supported():
+                self.warning('virtiofsd is not installed, skipping virtiofs')
+                continue
+
+            if transport == 'nfs' and not SharedFolders.nfs_supported():
+                self.warning('nfs-server is not running, skipping nfs')
+                continue
+
+            available.append(transport)
+
+        return available
+
+    def bench(self, results, transport, files, size):
+        script = self.Script.format(
+            dir=f'/shared/bench/{transport}', files=files, size=size
+        )
+
+        result = VagrantSSHActor(parent=self)._exec_vagrant(
+            ['client'], ['sudo', 'bash', '-c', shlex.quote(script)],
+            capture_output=True
+        )
+
+        if not result.stdout:
+            return
+
+        results[transport] = {
+            key: int(value) / 1000 for key, value
+            in re.findall(r'^(\w+)=(\d+)$', result.stdout, re.MULTILINE)
+        }
+
+    def print_results(self, results):
+        if not results:
+            return
+
+        print('{:15}'.format('Transport') + ''.join(
+            ['{:>10}'.format(x) for x in self.Columns]
+        ))
+
+        for transport, values in results.items():
+            print('{:15}'.format(transport) + ''.join(
+                ['{:>9.2f}s'.format(values.get(x, 0)) for x in self.Columns]
+            ))
+
+
+Commands = Command('bench-folders', 'Benchmark shared folder transports', BenchFoldersActor())
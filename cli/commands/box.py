@@ -22,26 +22,35 @@
 import argparse
 import datetime
 import hashlib
+import json
 import os
 import re
+import shutil
 import textwrap
+import time
+import urllib.parse
+import urllib.request
 
 import nutcli
 from nutcli.commands import Command, CommandParser
 from nutcli.parser import UniqueAppendAction
 from nutcli.tasks import Task, TaskList
 
-from commands.provision import ProvisionGuestsActor
+from commands.provision import EnrollActor, ProvisionGuestsActor
 from commands.vagrant import (VagrantDestroyActor, VagrantHaltActor,
                               VagrantPackageActor, VagrantPruneActor,
                               VagrantUpActor, VagrantUpdateActor)
 from util.actor import TestSuiteActor
+from util.delta import BoxDelta, DeltaError
+from util.environment import Environment
+from util.golden import GoldenManifest
+from util.output import CommandOutput
 
 
 class VagrantBox(object):
     def __init__(
         self, actor, guest, project_dir,
-        argv, version, linux, windows, output_dir
+        argv, version, linux, windows, output_dir, delta_dir=None
     ):
         self.actor = actor
         self.shell = actor.shell
@@ -61,8 +70,13 @@ class VagrantBox(object):
         self.image_path = f'{project_dir}/pool/sssd-test-suite_{guest}.img'
         self.output_dir = output_dir
         self.argv = argv
+        self.delta_dir = delta_dir
+        self.delta = None
+        self.start = None
+        self.duration = None
 
     def _make_readable(self):
+        self.start = time.monotonic()
         self.shell(f'sudo chmod a+r {self.image_path}')
 
     def _zero_disk(self):
@@ -87,6 +101,21 @@ class VagrantBox(object):
 
         self.shell(f'mv -f "{self.box_name}" {self.output_dir}/')
         task.info(f'Box stored at {self.output_dir}/{self.box_name}')
+        self.duration = round(time.monotonic() - self.start, 3)
+
+    def _create_delta(self, task):
+        base = BoxDelta.find_base(
+            self.delta_dir, self.os, self.guest, self.version
+        )
+
+        if base is None:
+            task.info(f'No previous version found in {self.delta_dir}')
+            return
+
+        path = f'{os.path.splitext(self.get_output_path())[0]}.delta'
+        BoxDelta.create(self.actor, base, self.get_output_path(), path)
+        self.delta = path
+        task.info(f'Delta against {os.path.basename(base)} stored at {path}')
 
     def get_tasklist(self):
         return TaskList(
@@ -112,6 +141,9 @@ class VagrantBox(object):
             Task('Package box')(
                 self._package_box
             ),
+            Task('Create delta', enabled=self.delta_dir is not None)(
+                self._create_delta
+            ),
         ])
 
     def get_output_path(self):
@@ -157,11 +189,30 @@ class CreateBoxActor(TestSuiteActor):
             help='Update current boxes before recreating guests.'
         )
 
+        parser.add_argument(
+            '--enroll', action='store_true', dest='enroll',
+            help='Enroll guests before creating boxes (golden boxes).'
+        )
+
         parser.add_argument(
             '-s', '--sequence', action='store_true', dest='sequence',
             help='Run operation on guests in sequence (one by one)'
         )
 
+        parser.add_argument(
+            '--delta', action='store_true', dest='delta',
+            help='Create also delta against the previous version of the box.'
+        )
+
+        parser.add_argument(
+            '--delta-base', action='store', type=str, dest='delta_base',
+            help='Directory with previous versions of the boxes '
+                 '(Default is the output directory).'
+        )
+
+        # --output is already used for output directory
+        CommandOutput.add_argument(parser, '--output-format', 'output_format')
+
         parser.add_argument(
             'guests', nargs='*', choices=['all'] + self.AllGuests,
             action=UniqueAppendAction, default='all',
@@ -183,6 +234,19 @@ class CreateBoxActor(TestSuiteActor):
         - Update current boxes (if --update is specified)
         - Bring up and provision guests
 
+        If --enroll is selected the guests are enrolled together before
+        they are boxed. Content of the shared-enrollment directory is stored
+        in "sssd-golden-$date.$version.json" manifest in the output directory.
+        Use this manifest with 'run --golden' to run tests on these boxes
+        without enrolling them again.
+
+        If --delta is selected, "sssd-$os-$guest-$date.$version.delta" is
+        created next to each box. It contains only the disk clusters that
+        differ from the newest older box of the same guest found in
+        --delta-base directory. Publish it together with the box, 'box
+        metadata' adds it to the box metadata and 'box update' uses it
+        instead of downloading the whole box.
+
         This command may ask you for a sudo password during some steps unless
         you have passwordless sudo.
 
@@ -199,22 +263,53 @@ class CreateBoxActor(TestSuiteActor):
         update,
         sequence,
         guests,
-        argv
+        argv,
+        enroll=False,
+        output_format='text',
+        delta=False,
+        delta_base=None
     ):
         guests = guests if 'all' not in guests else self.AllGuests
         guests.sort()
 
+        delta_dir = None
+        if delta:
+            delta_dir = delta_base if delta_base is not None else output_dir
+
         boxes = [VagrantBox(
-            self, guest, self.project_dir, argv, version, linux, windows, output_dir
+            self, guest, self.project_dir, argv, version, linux, windows,
+            output_dir, delta_dir
         ) for guest in guests]
 
+        with CommandOutput('box create', output_format) as out:
+            try:
+                self.create(boxes, guests, output_dir, scratch, update,
+                            sequence, argv, enroll)
+            finally:
+                out.set(
+                    boxes=[{
+                        'guest': box.guest,
+                        'name': box.box_name,
+                        'version': box.version,
+                        'path': box.get_output_path(),
+                        'delta': box.delta,
+                        'duration': box.duration,
+                    } for box in boxes],
+                    manifest=self.get_manifest_path(boxes, output_dir)
+                    if enroll else None
+                )
+
+    def create(
+        self, boxes, guests, output_dir, scratch, update, sequence, argv,
+        enroll
+    ):
         TaskList('Create Boxes', logger=self.logger)([
             TaskList(name='Provision from scratch', enabled=scratch)([
                 Task('Destroy guests')(
                     VagrantDestroyActor(parent=self), guests, sequence
                 ),
                 Task('Update boxes', enabled=update)(
-                    VagrantUpdateActor(parent=self), guests, sequence
+                    BoxUpdateActor(parent=self), guests, sequence
                 ),
                 Task('Bring up guests')(
                     VagrantUpActor(parent=self), guests, sequence
@@ -223,13 +318,55 @@ class CreateBoxActor(TestSuiteActor):
                     ProvisionGuestsActor(parent=self), guests, argv=argv
                 ),
             ]),
+            TaskList(name='Enroll guests', enabled=enroll)([
+                Task('Enroll guests')(
+                    EnrollActor(parent=self).enroll, list(guests), False,
+                    nutcli.utils.get_as_list(argv)
+                ),
+                Task('Capture enrollment')(
+                    self.capture_enrollment, boxes, output_dir, argv
+                ),
+            ]),
             *[box.get_tasklist() for box in boxes],
             Task('Output information')(self.display_output, boxes)
         ]).execute()
 
+    def get_manifest_path(self, boxes, output_dir):
+        return f'{output_dir}/sssd-golden-{boxes[0].version}.json'
+
+    def capture_enrollment(self, boxes, output_dir, argv, task):
+        manifest = GoldenManifest.create(
+            boxes[0].version,
+            [box.guest for box in boxes],
+            {box.guest: box.box_name for box in boxes},
+            f'{self.project_dir}/shared-enrollment'
+        )
+
+        linux = [box.guest for box in boxes if box.guest in self.LinuxGuests]
+        if linux:
+            ProvisionGuestsActor(parent=self)(
+                guests=linux,
+                playbook=f'{self.ansible_dir}/golden.yml',
+                argv=[
+                    *nutcli.utils.get_as_list(argv),
+                    '--extra-vars', json.dumps({'golden_stamp': manifest.stamp})
+                ]
+            )
+
+        path = self.get_manifest_path(boxes, output_dir)
+        self.shell(['mkdir', '-p', output_dir])
+        self.write_manifest(manifest, path)
+        task.info(f'Manifest stored at {path}')
+
+    @nutcli.decorators.SideEffect()
+    def write_manifest(self, manifest, path):
+        manifest.save(path)
+
     def display_output(self, boxes, task):
         for box in boxes:
             task.info(f'Box written: {box.get_output_path()}')
+            if box.delta is not None:
+                task.info(f'Delta written: {box.delta}')
 
 
 class CreateMetadataActor(TestSuiteActor):
@@ -268,8 +405,9 @@ class CreateMetadataActor(TestSuiteActor):
         )[0]
 
         checksum = self.compute_checksum(box)
+        deltas = self.get_deltas(url, box)
         content = self.get_metadata(
-            url, outfile, box_os, box_guest, box_version, checksum
+            url, outfile, box_os, box_guest, box_version, checksum, deltas
         )
 
         if print_content:
@@ -287,33 +425,45 @@ class CreateMetadataActor(TestSuiteActor):
 
         return sha256.hexdigest()
 
-    def get_metadata(self, url, outfile, os, guest, version, checksum):
-        return textwrap.dedent('''
-        {{
-            "name": "sssd-{os}-{guest}",
-            "description": "SSSD Test Suite '{os}' {guest}",
-            "versions": [
-                {{
-                    "version": "{version}",
-                    "status": "active",
-                    "providers": [
-                        {{
-                            "name": "libvirt",
-                            "url": "{url}/sssd-{os}-{guest}-{version}.box",
-                            "checksum_type": "sha256",
-                            "checksum": "{checksum}"
-                        }}
-                    ]
-                }}
-            ]
-        }}
-        ''').strip().format(
-            os=os,
-            guest=guest,
-            version=version,
-            url=url,
-            checksum=checksum
-        )
+    def get_deltas(self, url, box):
+        """
+        Describe delta created next to the box by 'box create --delta'.
+        The deltas are ignored by vagrant, they are used by 'box update'.
+        """
+        path = f'{os.path.splitext(box)[0]}.delta'
+        if not os.path.exists(path):
+            return []
+
+        delta = BoxDelta.load(path)
+        return [{
+            'base': delta.base,
+            'url': f'{url}/{os.path.basename(path)}',
+            'checksum_type': 'sha256',
+            'checksum': self.compute_checksum(path)
+        }]
+
+    def get_metadata(
+        self, url, outfile, os, guest, version, checksum, deltas=None
+    ):
+        provider = {
+            'name': 'libvirt',
+            'url': f'{url}/sssd-{os}-{guest}-{version}.box',
+            'checksum_type': 'sha256',
+            'checksum': checksum
+        }
+
+        if deltas:
+            provider['deltas'] = deltas
+
+        return json.dumps({
+            'name': f'sssd-{os}-{guest}',
+            'description': f"SSSD Test Suite '{os}' {guest}",
+            'versions': [{
+                'version': version,
+                'status': 'active',
+                'providers': [provider]
+            }]
+        }, indent=4)
 
     @nutcli.decorators.SideEffect()
     def write_metadata(self, outfile, content):
@@ -321,9 +471,182 @@ class CreateMetadataActor(TestSuiteActor):
             f.write(content)
 
 
+class BoxUpdateActor(VagrantUpdateActor):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.delta = True
+
+    def setup_parser(self, parser):
+        super().setup_parser(parser)
+
+        parser.add_argument(
+            '--no-delta', action='store_false', dest='delta',
+            help='Always download whole boxes, do not apply deltas.'
+        )
+
+        parser.epilog = textwrap.dedent('''
+        Update boxes of selected guests.
+
+        If the box is configured with metadata URL that lists a delta against
+        a box version that is already installed, the delta is downloaded and
+        the new version is built locally. Otherwise the whole box is
+        downloaded by vagrant.
+        ''')
+
+    def __call__(
+        self, guests, sequence=False, argv=None, output='text', delta=True
+    ):
+        self.delta = delta
+        return super().__call__(guests, sequence, argv, output)
+
+    def prepare(self, guests):
+        if self.delta:
+            self.apply_deltas(guests)
+
+    def apply_deltas(self, guests):
+        environment = Environment.from_file(
+            self.project_dir, self.get_config_file()
+        )
+
+        if environment is None:
+            return
+
+        # Box name -> metadata URL, guests may share the same box
+        boxes = {}
+        for guest in guests:
+            box = environment.get_box(guest)
+            if box.get('name', None) and box.get('url', None):
+                boxes[box['name']] = box['url']
+
+        for name, url in sorted(boxes.items()):
+            try:
+                self.apply_delta(name, url)
+            except (
+                OSError, ValueError, KeyError, DeltaError,
+                nutcli.shell.ShellCommandError
+            ) as err:
+                self.warning(
+                    f'Unable to update {name} from delta, '
+                    f'whole box will be downloaded: {err}'
+                )
+
+    def apply_delta(self, name, url):
+        with urllib.request.urlopen(self.get_url(url)) as f:
+            metadata = json.load(f)
+
+        versions = [
+            x for x in metadata.get('versions', [])
+            if x.get('status', 'active') == 'active'
+        ]
+
+        if not versions:
+            return
+
+        latest = max(versions, key=lambda x: BoxDelta.version_key(x['version']))
+        installed = BoxDelta.get_installed(BoxDelta.get_vagrant_home(), name)
+        if latest['version'] in installed:
+            return
+
+        deltas = [
+            delta
+            for provider in latest.get('providers', [])
+            if provider.get('name', None) == BoxDelta.Provider
+            for delta in provider.get('deltas', [])
+            if delta.get('base', None) in installed
+        ]
+
+        if not deltas:
+            return
+
+        delta = deltas[0]
+        self.info(
+            f'Updating {name} to {latest["version"]} '
+            f'from delta against {delta["base"]}'
+        )
+
+        if nutcli.decorators.SideEffect.is_dry_run:
+            return
+
+        path = f'{self.cache_dir}/deltas/' + os.path.basename(
+            urllib.parse.urlparse(delta['url']).path
+        )
+
+        try:
+            self.download(delta['url'], path)
+            if BoxDelta.checksum(path) != delta['checksum']:
+                raise DeltaError(f'Checksum of {delta["url"]} does not match')
+
+            BoxDelta.load(path).apply(self, path, name)
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def get_url(self, url):
+        if '://' not in url:
+            return 'file://' + os.path.abspath(url)
+
+        return url
+
+    def download(self, url, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with urllib.request.urlopen(self.get_url(url)) as src:
+            with open(path, 'wb') as dest:
+                shutil.copyfileobj(src, dest)
+
+
+class ApplyDeltaActor(TestSuiteActor):
+    def setup_parser(self, parser):
+        parser.add_argument(
+            '-n', '--name', action='store', type=str, dest='name',
+            help='Name of the installed box (Default: box configured for '
+                 'the guest of the delta)'
+        )
+
+        parser.add_argument(
+            'delta', help='Box delta file.'
+        )
+
+        parser.epilog = textwrap.dedent('''
+        Install new version of a box from delta file created by
+        'box create --delta'. The version of the box that the delta was
+        created against must be installed.
+        ''')
+
+    def __call__(self, name, delta):
+        try:
+            info = BoxDelta.load(delta)
+        except DeltaError as err:
+            self.error(str(err))
+            return 1
+
+        if name is None:
+            environment = Environment.from_file(
+                self.project_dir, self.get_config_file()
+            )
+
+            if environment is not None:
+                name = environment.get_box(info.guest).get('name', None)
+
+        if not name:
+            self.error(f'No box is configured for {info.guest}, use --name.')
+            return 1
+
+        try:
+            if not info.apply(self, delta, name):
+                self.info(f'Box {name} version {info.version} is already installed.')
+                return 0
+        except DeltaError as err:
+            self.error(str(err))
+            return 1
+
+        self.info(f'Box {name} version {info.version} installed.')
+        return 0
+
+
 Commands = Command('box', 'Update and create boxes', CommandParser()([
-    Command('update', 'Update vagrant box', VagrantUpdateActor()),
+    Command('update', 'Update vagrant box', BoxUpdateActor()),
     Command('prune', 'Delete all outdated vagrant boxes', VagrantPruneActor()),
     Command('create', 'Create new vagrant box', CreateBoxActor()),
     Command('metadata', 'Create box metadata', CreateMetadataActor()),
+    Command('apply-delta', 'Install box from delta', ApplyDeltaActor()),
 ]))
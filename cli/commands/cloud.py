@@ -28,6 +28,7 @@ from nutcli.parser import UniqueAppendAction
 from nutcli.tasks import Task, TaskList
 
 from util.actor import TestSuiteActor
+from util.output import CommandOutput
 from util.vgcloud import VagrantCloud
 
 
@@ -91,9 +92,23 @@ class CloudSetCredentialsActor(CloudActor):
 
 
 class CloudListActor(CloudActor):
-    def __call__(self, username, token):
-        api = self.get_cloud_api(username, token)
-        for box in api.list_boxes():
+    def setup_parser(self, parser):
+        super().setup_parser(parser)
+        CommandOutput.add_argument(parser)
+
+    def __call__(self, username, token, output='text'):
+        with CommandOutput('cloud list', output) as out:
+            api = self.get_cloud_api(username, token)
+            boxes = api.list_boxes()
+            out.set(boxes=[
+                {'tag': box.tag, 'name': box.name, 'version': box.version}
+                for box in boxes
+            ])
+
+        if out.json:
+            return
+
+        for box in boxes:
             print('- {:50s} ({})'.format(box.tag, box.version))
 
 
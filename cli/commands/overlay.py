@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+#
+#    Authors:
+#        Pavel Březina <pbrezina@redhat.com>
+#
+#    Copyright (C) 2019 Red Hat
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import textwrap
+
+import nutcli
+from nutcli.commands import Command, CommandParser
+from nutcli.parser import UniqueAppendAction
+from nutcli.tasks import Task, TaskList
+
+from commands.vagrant import (VagrantDestroyActor, VagrantHaltActor,
+                              VagrantUpActor, VagrantWaitActor)
+from util.actor import TestSuiteActor
+from util.overlay import DiskOverlay
+
+
+class OverlayActor(TestSuiteActor):
+    def setup_parser(self, parser):
+        parser.add_argument(
+            'guests', nargs='*',
+            choices=['all'] + self.AllGuests,
+            action=UniqueAppendAction,
+            default='all',
+            help='Guests to use. Multiple guests can be set. (Default "all")'
+        )
+
+    def _get_guests(self, guests):
+        guests = nutcli.utils.get_as_list(guests)
+        return list(self.AllGuests) if 'all' in guests else guests
+
+
+class OverlayCreateActor(OverlayActor):
+    def setup_parser(self, parser):
+        super().setup_parser(parser)
+
+        parser.epilog = textwrap.dedent('''
+        Guests that were not created yet are started first. All guests are
+        halted and their current disks become read-only base images for
+        new copy-on-write overlays. Use 'overlay reset' to discard changes
+        made since then.
+        ''')
+
+    def __call__(self, guests):
+        self.create(self._get_guests(guests))
+
+    def create(self, guests, recreate=False):
+        """
+        If recreate is True, guests that do not have overlays yet are
+        destroyed and created again so the base images contain fresh guests
+        instead of whatever state was left on their disks.
+        """
+        missing = [x for x in guests if DiskOverlay(self, x).machine.id is None]
+        guests = [x for x in guests if not DiskOverlay(self, x).exists]
+
+        destroyed = []
+        if recreate:
+            destroyed = [x for x in guests if x not in missing]
+            missing = list(guests)
+
+        TaskList('Creating overlays', logger=self.logger)([
+            Task('Destroying guests', enabled=bool(destroyed))(
+                VagrantDestroyActor(parent=self), destroyed
+            ),
+            Task('Starting new guests', enabled=bool(missing))(
+                VagrantUpActor(parent=self), missing
+            ),
+            Task('Waiting for new guests', enabled=bool(missing))(
+                VagrantWaitActor(parent=self), missing
+            ),
+            Task('Halting guests', enabled=bool(guests))(
+                VagrantHaltActor(parent=self), guests
+            ),
+            *[
+                Task(f'Creating overlay of {guest}')(
+                    lambda guest: DiskOverlay(self, guest).create(), guest
+                ) for guest in guests
+            ]
+        ]).execute()
+
+
+class OverlayResetActor(OverlayActor):
+    def __call__(self, guests):
+        self.reset(self._get_guests(guests))
+
+    def reset(self, guests):
+        TaskList('Resetting overlays', logger=self.logger)([
+            Task('Halting guests')(
+                VagrantHaltActor(parent=self), guests
+            ),
+            *[
+                Task(f'Resetting overlay of {guest}')(
+                    lambda guest: DiskOverlay(self, guest).reset(), guest
+                ) for guest in guests
+            ]
+        ]).execute()
+
+
+class OverlayRemoveActor(OverlayActor):
+    def setup_parser(self, parser):
+        super().setup_parser(parser)
+
+        parser.epilog = textwrap.dedent('''
+        Changes made since the overlay was created are discarded and the
+        base image is used as guest disk again. Remove overlays before you
+        destroy the guests, otherwise the base images are left in the pool.
+        ''')
+
+    def __call__(self, guests):
+        self.remove(self._get_guests(guests))
+
+    def remove(self, guests):
+        guests = [x for x in guests if DiskOverlay(self, x).exists]
+
+        TaskList('Removing overlays', logger=self.logger)([
+            Task('Halting guests', enabled=bool(guests))(
+                VagrantHaltActor(parent=self), guests
+            ),
+            *[
+                Task(f'Removing overlay of {guest}')(
+                    lambda guest: DiskOverlay(self, guest).remove(), guest
+                ) for guest in guests
+            ]
+        ]).execute()
+
+
+Commands = Command('overlay', 'Manage copy-on-write guest disks', CommandParser()([
+    Command('create', 'Create disk overlays', OverlayCreateActor()),
+    Command('reset', 'Discard changes in disk overlays', OverlayResetActor()),
+    Command('remove', 'Remove disk overlays', OverlayRemoveActor()),
+]))
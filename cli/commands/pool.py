@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+#
+#    Authors:
+#        Pavel Březina <pbrezina@redhat.com>
+#
+#    Copyright (C) 2019 Red Hat
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import textwrap
+
+from nutcli.commands import Command, CommandParser
+from nutcli.parser import UniqueAppendAction
+from nutcli.tasks import Task, TaskList
+
+from commands.vagrant import (VagrantHaltActor, VagrantUpActor,
+                              VagrantWaitActor)
+from util import aio
+from util.actor import TestSuiteActor
+from util.overlay import DiskOverlay
+from util.pool import PoolClient, PoolServer
+from util.sizing import GuestSizing
+
+
+class PoolActor(TestSuiteActor):
+    def get_socket(self):
+        return f'{self.project_dir}/.pool.sock'
+
+
+class PoolServeActor(PoolActor):
+    def setup_parser(self, parser):
+        parser.add_argument(
+            'guests', nargs='*',
+            choices=self.AllGuests,
+            action=UniqueAppendAction,
+            default=['client'],
+            help='Guests to keep running until there is enough demand '
+                 'recorded. Multiple guests can be set. (Default "client")'
+        )
+
+        parser.epilog = textwrap.dedent('''
+        Keep guests running and ready so 'run --pool' can use them
+        immediately instead of starting them. The environment is leased
+        over a local socket (.pool.sock) by one test run at a time.
+
+        When the test run is finished, guests are halted, their disk
+        overlays are reset (see 'overlay create') and guests that are in
+        demand are started again. Guests without overlays are only
+        restarted. Create the overlays after the guests are enrolled so
+        they are restored to enrolled state.
+
+        Guests that are kept running are selected by the last 20 leases,
+        a guest is kept running if it was requested by at least one
+        quarter of them and its memory fits into the host memory.
+
+        Only one environment exists per sssd-test-suite directory.
+        ''')
+
+    def __call__(self, guests):
+        sizing = GuestSizing.from_file(self.get_config_file())
+        server = PoolServer(
+            self.logger,
+            self.get_socket(),
+            f'{self.cache_dir}/pool-demand.json',
+            guests,
+            sizing.memory,
+            sizing.available_memory,
+            self.restore
+        )
+
+        self.info(f'Listening on {self.get_socket()}')
+        aio.run(server.serve())
+
+    def restore(self, used, guests):
+        overlays = [x for x in used if DiskOverlay(self, x).exists]
+        restarted = [x for x in used if x not in overlays]
+        if restarted:
+            self.warning(f'Guests without disk overlays are only restarted: '
+                         f'{restarted}')
+
+        TaskList('pool', logger=self.logger)([
+            Task('Halting guests', enabled=bool(used))(
+                VagrantHaltActor(parent=self), used
+            ),
+            *[
+                Task(f'Resetting overlay of {guest}')(
+                    lambda guest: DiskOverlay(self, guest).reset(), guest
+                ) for guest in overlays
+            ],
+            Task('Starting guests', enabled=bool(guests))(
+                VagrantUpActor(parent=self), guests
+            ),
+            Task('Waiting for guests', enabled=bool(guests))(
+                VagrantWaitActor(parent=self), guests
+            ),
+        ]).execute()
+
+
+class PoolStatusActor(PoolActor):
+    def setup_parser(self, parser):
+        pass
+
+    def __call__(self):
+        status = PoolClient(self.get_socket()).status()
+        if status is None:
+            self.info('Pool daemon is not running')
+            return 1
+
+        print(json.dumps(status, indent=2))
+        return 0
+
+
+Commands = Command('pool', 'Keep guests ready for test runs', CommandParser()([
+    Command('serve', 'Run pool daemon', PoolServeActor()),
+    Command('status', 'Show state of the pool', PoolStatusActor()),
+]))
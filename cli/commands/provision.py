@@ -20,6 +20,10 @@
 #
 
 import argparse
+import datetime
+import json
+import os
+import tempfile
 import textwrap
 
 import nutcli.utils
@@ -27,17 +31,29 @@ from nutcli.commands import Command, CommandParser
 from nutcli.parser import UniqueAppendAction
 from nutcli.tasks import Task, TaskList
 
-from commands.vagrant import VagrantUpActor
+from commands.vagrant import VagrantUpActor, VagrantWaitActor
 from util.actor import TestSuiteActor
+from util.fingerprint import RoleFingerprints
+from util.graph import TaskGraph, format_duration
+from util.license import RunLock, WindowsLicenses
 
 
 class AnsibleActor(TestSuiteActor):
-    def _exec_ansible(self, playbook, unattended=False, limit=None, argv=None):
+    def _exec_ansible(
+        self, playbook, unattended=False, limit=None, argv=None, fast=False
+    ):
         argv = nutcli.utils.get_as_list(argv)
 
-        env = {
-            'ANSIBLE_CONFIG': f'{self.ansible_dir}/ansible.cfg'
-        }
+        if fast:
+            env = {
+                'ANSIBLE_CONFIG': f'{self.ansible_dir}/ansible-fast.cfg',
+                'ANSIBLE_CACHE_PLUGIN_CONNECTION':
+                    f'{self.project_dir}/.ansible/facts'
+            }
+        else:
+            env = {
+                'ANSIBLE_CONFIG': f'{self.ansible_dir}/ansible.cfg'
+            }
 
         limit = ','.join(limit) if limit is not None else 'all'
 
@@ -91,6 +107,30 @@ class ProvisionHostActor(AnsibleActor):
 
 
 class ProvisionGuestsActor(AnsibleActor):
+    # Guests that must be provisioned before the guest can be provisioned.
+    # Guests that do not depend on each other are provisioned in parallel
+    # if --parallel is set.
+    Dependencies = {
+        'ipa': [],
+        'ldap': [],
+        'client': [],
+        'ad': [],
+        'ad-child': ['ad'],
+    }
+
+    # Stages of the default playbook selected by tags. Stages of one guest
+    # run one after another but only the last stage waits for dependencies,
+    # so 'ad-child' installs its features while 'ad' is being promoted.
+    Stages = {
+        'ad': [('prepare', ['win-prepare']), ('domain', ['win-domain'])],
+        'ad-child': [('prepare', ['win-prepare']), ('domain', ['win-domain'])],
+    }
+
+    # Options of ansible-playbook that run only part of the playbook.
+    # Roles can not be considered converged after such run.
+    PartialRunOptions = ['-t', '--tags', '--skip-tags', '-l', '--limit',
+                         '--start-at-task']
+
     def setup_parser(self, parser):
         parser.add_argument(
             '-p', '--playbook', action='store', type=str, dest='playbook',
@@ -98,6 +138,21 @@ class ProvisionGuestsActor(AnsibleActor):
             metavar='PLAYBOOK'
         )
 
+        parser.add_argument(
+            '-f', '--fast', action='store_true', dest='fast',
+            help='Use fast ansible profile (see provision/ansible-fast.cfg)'
+        )
+
+        parser.add_argument(
+            '-P', '--parallel', action='store_true', dest='parallel',
+            help='Provision independent guests in parallel'
+        )
+
+        parser.add_argument(
+            '--force', action='store_true', dest='force',
+            help='Run all roles even if they are already applied'
+        )
+
         parser.add_argument(
             'guests', nargs='*', choices=['all'] + self.AllGuests,
             action=UniqueAppendAction, default='all',
@@ -115,16 +170,141 @@ class ProvisionGuestsActor(AnsibleActor):
         prepared with necessary software and configurations. To enroll client
         to domains use 'enroll' command.
 
+        If --fast is set, ansible runs with SSH pipelining, free strategy and
+        cached facts. Time spent in each task and role is printed at the end.
+
+        If --parallel is set, each guest is provisioned by a separate
+        ansible-playbook process. Guests that do not depend on each other
+        are provisioned at the same time. Windows guests are provisioned in
+        two stages: 'prepare' (common packages and features) and 'domain'.
+        The 'prepare' stage of 'ad-child' runs while 'ad' is being promoted,
+        only its 'domain' stage waits until 'ad' is finished. Duration of
+        each stage is printed at the end.
+
+        Roles that were already successfully applied to a guest are skipped
+        unless the role, variables.yml or the guest machine itself (box or
+        machine id) has changed since then. Use --force to run all roles.
+        This only applies to the default playbook. Roles are remembered as
+        applied only if the whole playbook was run, i.e. ansible-playbook
+        arguments do not contain --tags, --skip-tags, --limit or
+        --start-at-task.
+
         All parameters placed after -- will be passed to ansible-playbook.
         ''')
 
-    def __call__(self, guests, playbook=None, argv=None):
+    def __call__(
+        self, guests, playbook=None, argv=None, fast=False, parallel=False,
+        force=False
+    ):
         guests = guests if 'all' not in guests else ['all']
+        argv = nutcli.utils.get_as_list(argv)
 
+        fingerprints = None
         if playbook is None:
             playbook = f'{self.ansible_dir}/prepare-guests.yml'
+            fingerprints = RoleFingerprints(
+                self.project_dir, playbook, f'{self.cache_dir}/fingerprints.json'
+            )
+
+            if not force:
+                argv += self._skip_converged(fingerprints, guests)
+
+            if self._is_partial_run(argv):
+                self.info('Only part of the playbook is run, roles will not '
+                          'be remembered as applied')
+                fingerprints = None
+
+        if parallel:
+            self._provision_parallel(playbook, guests, argv, fast, fingerprints)
+            return
+
+        self._exec_ansible(
+            playbook, unattended=True, limit=guests, argv=argv, fast=fast
+        )
+
+        if fingerprints is not None:
+            fingerprints.record(self._expand_guests(guests))
+
+    def _expand_guests(self, guests):
+        return guests if 'all' not in guests else self.AllGuests
 
-        self._exec_ansible(playbook, unattended=True, limit=guests, argv=argv)
+    def _is_partial_run(self, argv):
+        for arg in argv:
+            if arg.split('=', 1)[0] in self.PartialRunOptions:
+                return True
+
+            # Short options with attached value, e.g. -tsssd
+            if not arg.startswith('--') and arg[:2] in self.PartialRunOptions:
+                return True
+
+        return False
+
+    def _skip_converged(self, fingerprints, guests):
+        converged = fingerprints.converged(self._expand_guests(guests))
+        for guest, roles in converged.items():
+            if roles:
+                self.info(f'{guest}: skipping converged roles: {", ".join(roles)}')
+
+        return ['--extra-vars', json.dumps({'converged_roles': converged})]
+
+    def _provision_guest(
+        self, playbook, guest, argv, fast, fingerprints, tags=None
+    ):
+        if tags is not None:
+            argv = argv + ['--tags', ','.join(tags)]
+
+        self._exec_ansible(
+            playbook, unattended=True, limit=[guest], argv=argv, fast=fast
+        )
+
+        if fingerprints is not None:
+            fingerprints.record([guest])
+
+    def _get_stages(self, guest, staged):
+        """
+        Return list of (node name, tags) of the guest.
+        """
+        stages = self.Stages.get(guest, None) if staged else None
+        if not stages:
+            return [(guest, None)]
+
+        return [(f'{guest}: {name}', tags) for name, tags in stages]
+
+    def _provision_parallel(self, playbook, guests, argv, fast, fingerprints):
+        guests = self._expand_guests(guests)
+
+        # Stages are tagged only in the default playbook. Fingerprints are
+        # not set for partial runs, whose tags would clash with the stages.
+        staged = fingerprints is not None
+
+        # Name of the last stage of each guest
+        finished = {}
+
+        graph = TaskGraph('provision', self.logger)
+        for guest in self.AllGuests:
+            if guest not in guests:
+                continue
+
+            # Dependencies that are not selected are considered provisioned.
+            requires = [
+                finished[x] for x in self.Dependencies[guest] if x in guests
+            ]
+
+            stages = self._get_stages(guest, staged)
+            finished[guest] = stages[-1][0]
+
+            previous = []
+            for name, tags in stages:
+                # Fingerprints are recorded when all stages are finished.
+                last = name == finished[guest]
+                graph.add(
+                    name, self._provision_guest, playbook, guest, list(argv),
+                    fast, fingerprints if last else None, tags,
+                    requires=previous + (requires if last else [])
+                )
+                previous = [name]
+
+        graph.execute()
 
 
 class EnrollActor(AnsibleActor):
@@ -146,6 +326,11 @@ class EnrollActor(AnsibleActor):
             help='Do not ask for sudo password (requires passwordless sudo).'
         )
 
+        parser.add_argument(
+            '-f', '--fast', action='store_true', dest='fast',
+            help='Use fast ansible profile (see provision/ansible-fast.cfg)'
+        )
+
         parser.add_argument(
             'argv', nargs=argparse.REMAINDER,
             help='Additional arguments passed to the ansible-playbook command'
@@ -177,20 +362,26 @@ class EnrollActor(AnsibleActor):
         --unattended option is specified. However, using this option requires
         passwordless sudo access to your machine.
 
+        If --fast is set, ansible runs with SSH pipelining, free strategy and
+        cached facts. Time spent in each task and role is printed at the end.
+
         All parameters placed after -- will be passed to ansible-playbook.
         ''')
 
-    def __call__(self, guests, sequence, unattended, argv):
+    def __call__(self, guests, sequence, unattended, argv, fast=False):
         TaskList('enroll', logger=self.logger)([
             Task('Start Guest Machines')(
                 VagrantUpActor(parent=self), guests, sequence
             ),
+            Task('Wait for Guest Machines')(
+                VagrantWaitActor(parent=self), guests
+            ),
             Task('Enroll Machines')(
-                self.enroll, guests, unattended, argv
+                self.enroll, guests, unattended, argv, fast
             ),
         ]).execute()
 
-    def enroll(self, guests, unattended, argv):
+    def enroll(self, guests, unattended, argv, fast=False):
         if 'all' in guests:
             limit = ['all']
         else:
@@ -206,7 +397,7 @@ class EnrollActor(AnsibleActor):
 
         self._exec_ansible(
             f'{self.ansible_dir}/enroll.yml',
-            unattended=unattended, limit=guests, argv=argv
+            unattended=unattended, limit=guests, argv=argv, fast=fast
         )
 
 
@@ -312,10 +503,136 @@ class RearmWindowsActor(AnsibleActor):
         )
 
 
+class WindowsLicenseActor(AnsibleActor):
+    def setup_parser(self, parser):
+        parser.add_argument(
+            'guests', nargs='*', choices=['all'] + self.WindowsGuests,
+            action=UniqueAppendAction, default='all',
+            help='Windows guests to check. '
+                 'Multiple guests can be set. (Default "all")'
+        )
+
+        parser.add_argument(
+            '-r', '--rearm-within', action='store', type=float,
+            dest='rearm_within', default=None, metavar='DAYS',
+            help='Renew licenses that expire within DAYS days.'
+        )
+
+        parser.add_argument(
+            'argv', nargs=argparse.REMAINDER,
+            help='Additional arguments passed to the ansible-playbook command'
+        )
+
+        parser.epilog = textwrap.dedent('''
+        This will query remaining time and rearm count of Windows evaluation
+        licenses and remember them in .cache/windows-license.json. The 'run'
+        command uses this information to warn about guests whose license
+        would expire before the tests are finished.
+
+        If --rearm-within is set, licenses that expire within given number
+        of days are renewed and the guests are rebooted. This is skipped if
+        any test run is in progress so it is safe to run this command
+        periodically (e.g. from cron). Guests with no rearms left must be
+        recreated from a new box.
+
+        All parameters placed after -- will be passed to ansible-playbook.
+        ''')
+
+    def __call__(self, guests, argv, rearm_within=None):
+        guests = self.WindowsGuests if 'all' in guests else guests
+        argv = nutcli.utils.get_as_list(argv)
+
+        licenses = self.query(guests, argv)
+        self.print_licenses(licenses, guests)
+
+        if rearm_within is None:
+            return 0
+
+        expiring = licenses.expiring(
+            guests, datetime.timedelta(days=rearm_within)
+        )
+
+        rebuild = [x for x in expiring if licenses.action(x) == 'rebuild']
+        for guest in rebuild:
+            self.warning(f'{guest}: no rearms left, recreate the guest '
+                         'from a new box')
+
+        rearm = [x for x in expiring if licenses.action(x) == 'rearm']
+        if not rearm:
+            return 0
+
+        lock = RunLock(f'{self.cache_dir}/run.lock')
+        if not lock.acquire(exclusive=True):
+            self.info('Test run is in progress, skipping rearm')
+            return 0
+
+        try:
+            self.info(f'Renewing licenses: {", ".join(rearm)}')
+            self._exec_ansible(
+                f'{self.ansible_dir}/rearm-windows-license.yml',
+                unattended=True, limit=rearm,
+                argv=argv + ['--extra-vars', json.dumps({'rearm_force': True})]
+            )
+        finally:
+            lock.release()
+
+        licenses = self.query(rearm, argv)
+        self.print_licenses(licenses, rearm)
+
+        return 0
+
+    def query(self, guests, argv):
+        licenses = WindowsLicenses.load(
+            self.project_dir, f'{self.cache_dir}/windows-license.json'
+        )
+
+        with tempfile.TemporaryDirectory() as license_dir:
+            self._exec_ansible(
+                f'{self.ansible_dir}/windows-license.yml',
+                unattended=True, limit=guests,
+                argv=argv + ['--extra-vars', json.dumps({
+                    'license_dir': license_dir
+                })]
+            )
+
+            for guest in guests:
+                path = f'{license_dir}/{guest}.txt'
+                if not os.path.exists(path):
+                    continue
+
+                with open(path) as f:
+                    licenses.update(guest, f.read())
+
+        licenses.save()
+        return licenses
+
+    def print_licenses(self, licenses, guests):
+        print('{:10} {:15} {:>15} {:>8}'.format(
+            'Guest', 'Status', 'Remaining', 'Rearms'
+        ))
+
+        for guest in guests:
+            info = licenses.get(guest)
+            if info is None:
+                print('{:10} {:15}'.format(guest, 'Unknown'))
+                continue
+
+            remaining = licenses.remaining(guest)
+            print('{:10} {:15} {:>15} {:>8}'.format(
+                guest,
+                info['status'],
+                '{}d {}'.format(
+                    remaining.days, format_duration(remaining.seconds)
+                ),
+                str(info['rearms'])
+            ))
+
+
 Commands = Command('provision', 'Provision machines', CommandParser()([
     Command('host', 'Provision host machine', ProvisionHostActor()),
     Command('guest', 'Provision selected guests machines', ProvisionGuestsActor()),
     Command('enroll', 'Setup trusts and enroll client to domains', EnrollActor()),
     Command('ldap', 'Import ldif into ldap server', ProvisionLDAPActor()),
     Command('rearm', 'Renew windows license', RearmWindowsActor()),
+    Command('license', 'Check and renew windows licenses', WindowsLicenseActor()),
 ]))
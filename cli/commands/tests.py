@@ -19,37 +19,119 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import asyncio
+import concurrent.futures
+import fnmatch
+import hashlib
+import json
 import os
+import re
+import shlex
+import shutil
+import subprocess
 import tempfile
 import textwrap
+import time
+import uuid
 
 import nutcli
-import yaml
 from nutcli.commands import Command
 from nutcli.tasks import Task, TaskList
 
+from commands.overlay import OverlayCreateActor, OverlayRemoveActor
+from commands.provision import EnrollActor
 from commands.vagrant import (VagrantDestroyActor, VagrantHaltActor,
-                              VagrantPruneActor, VagrantSSHActor,
-                              VagrantUpActor, VagrantUpdateActor)
+                              VagrantPruneActor, VagrantRsyncActor,
+                              VagrantSSHActor, VagrantSSHFSMountActor,
+                              VagrantUpActor, VagrantUpdateActor,
+                              VagrantWaitActor)
+from util import aio
 from util.actor import TestSuiteActor
+from util.buildcache import BuildCache
+from util.folders import SharedFolders
+from util.golden import GoldenManifest
+from util.license import RunLock, WindowsLicenses
+from util.logstream import LogStreamer
+from util.machine import VagrantMachine
+from util.overlay import DiskOverlay
+from util.plan import PlanError, TestPlan
+from util.pool import PoolClient, PoolError, PoolTimeoutError
+from util.results import (TestHistory, TestResults, parse_shard,
+                          select_shard, shard_argument)
+from util.telemetry import TelemetrySampler
+
+
+class TestCaseTaskList(TaskList):
+    """
+    Task list that records status and duration of the test case.
+    """
+
+    def __init__(self, results, *args, on_failure=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.results = results
+        self.on_failure = on_failure
+
+    def _run_tasks(self):
+        start = time.monotonic()
+        try:
+            super()._run_tasks()
+        except BaseException as e:
+            self.results.record(
+                self.name, TestResults.Failed, time.monotonic() - start,
+                f'{e.__class__.__name__}: {e}'
+            )
+
+            if self.on_failure is not None:
+                self.on_failure()
+
+            raise
+
+        self.results.record(
+            self.name, TestResults.Passed, time.monotonic() - start
+        )
 
 
 class TestCase(object):
     def __init__(
         self, actor, sssd_dir, artifacts_dir, case_dir, destroy_guests,
-        name, guests, tasks, artifacts, timeout
+        name, guests, tasks, artifacts, timeout, golden=None,
+        transport='sshfs-cached', logs=None, results=None,
+        start_guests=True, stop_guests=True, cleanup=None, build_cache=None,
+        overlays=False, telemetry_interval=0, mount_folders=False
     ):
         self.actor = actor
         self.sssd_dir = sssd_dir
         self.artifacts_dir = artifacts_dir
         self.destroy_guests = destroy_guests
         self.case_dir = case_dir
+        self.golden = golden
+        self.transport = transport
 
         self.name = name
         self.guests = guests if guests else ['client']
         self.tasks = tasks
         self.artifacts = artifacts
         self.timeout = timeout
+        self.logs = logs if logs else []
+        self.streamers = []
+        self.archiver = ArtifactsArchiver(actor, case_dir)
+        self.results = results if results is not None else TestResults()
+
+        # Guests may be kept running from previous test case or for the
+        # next one when both use the same machines.
+        self.start_guests = start_guests
+        self.stop_guests = stop_guests
+        self.cleanup = cleanup if cleanup else []
+        if type(self.cleanup) == str:
+            self.cleanup = [{'shell': self.cleanup}]
+
+        self.overlays = overlays
+        self.mount_folders = mount_folders
+        self.telemetry_interval = telemetry_interval
+        self.telemetry = None
+        self.build_cache = build_cache
+        if build_cache is not None and not build_cache.enabled:
+            self.build_cache = None
 
     def get_tasks(self):
         case_tasks = []
@@ -71,12 +153,134 @@ class TestCase(object):
                     task.get('shell', 'exit 0'),
                     artifacts,
                     task.get('directory', '/shared/sssd'),
-                    task.get('timeout', None)
+                    task.get('timeout', None),
+                    self.archiver,
+                    self.build_cache,
+                    task.get('build-cache', None)
                 ).execute
             ))
 
         return case_tasks
 
+    def cleanup_guests(self):
+        for item in self.cleanup:
+            TestCommand(
+                self.actor,
+                self.case_dir,
+                item.get('directory', '/shared/sssd')
+            ).run_command(
+                item.get('run-on', self.guests[0]),
+                item.get('shell', 'exit 0')
+            )
+
+    def start_telemetry(self):
+        machines = {
+            guest: VagrantMachine(self.actor.project_dir, guest).id
+            for guest in self.guests
+        }
+
+        self.telemetry = TelemetrySampler(
+            self.actor.logger,
+            self.name,
+            {guest: id for guest, id in machines.items() if id is not None},
+            f'{self.artifacts_dir}/telemetry',
+            self.telemetry_interval
+        )
+
+        self.telemetry.start()
+
+    def stop_telemetry(self):
+        if self.telemetry is not None:
+            self.telemetry.stop()
+            self.telemetry = None
+
+    def reset_overlays(self):
+        for guest in self.guests:
+            DiskOverlay(self.actor, guest).reset()
+
+    def halt_kept_guests(self):
+        if self.stop_guests:
+            return
+
+        try:
+            VagrantHaltActor(parent=self.actor)(self.guests)
+        except Exception as e:
+            self.actor.error(f'Unable to halt guests: {e}')
+
+    def get_logs_map(self):
+        '''
+        logs: (optional)
+        - list of paths (followed on all Linux machines)
+        - from: guest
+          files:
+          - list of paths
+        '''
+        logs_map = {}
+        for item in self.logs:
+            if type(item) == dict:
+                guests = [item.get('from', self.guests[0])]
+                paths = item.get('files', [])
+            else:
+                guests = self.guests
+                paths = [item]
+
+            for guest in guests:
+                if guest in TestSuiteActor.LinuxGuests:
+                    logs_map.setdefault(guest, []).extend(paths)
+
+        return logs_map
+
+    def start_streaming(self):
+        ssh = aio.VagrantSSH(
+            VagrantSSHActor(parent=self.actor), self.actor.logger
+        )
+
+        for guest, paths in self.get_logs_map().items():
+            streamer = LogStreamer(
+                self.actor.logger,
+                self.name,
+                guest,
+                paths,
+                f'{self.artifacts_dir}/live',
+                from_start=self.start_guests
+                and (self.destroy_guests or self.overlays)
+            )
+
+            streamer.start(ssh)
+            self.streamers.append(streamer)
+
+    def stop_streaming(self):
+        for streamer in self.streamers:
+            streamer.stop()
+
+        self.streamers = []
+
+    def _read_stamp(self, guest):
+        try:
+            result = VagrantSSHActor(parent=self.actor)._exec_vagrant(
+                [guest], ['cat', GoldenManifest.StampPath], capture_output=True
+            )
+        except nutcli.shell.ShellCommandError:
+            return None
+
+        if not result.stdout:
+            return None
+
+        return json.loads(result.stdout)
+
+    def validate_enrollment(self, task):
+        stamps = {
+            guest: self._read_stamp(guest) for guest in self.guests
+            if guest in TestSuiteActor.LinuxGuests
+        }
+
+        if self.golden.matches(self.guests, stamps):
+            task.info(f'Guests belong to golden set {self.golden.id}')
+            return
+
+        task.info('Guests do not match golden set, enrolling them again')
+        EnrollActor(parent=self.actor).enroll(list(self.guests), True, [])
+
     def get_tasklist(self):
         artifacts = TestArtifacts(
             self.actor,
@@ -86,44 +290,145 @@ class TestCase(object):
             cwd='/shared/sssd'
         )
 
-        upshell = nutcli.shell.Shell(env={
-            'SSSD_TEST_SUITE_RSYNC': f'{self.sssd_dir}:/shared/sssd',
-            'SSSD_TEST_SUITE_SSHFS':
-                f'{self.artifacts_dir}:/shared/artifacts'
-                + f' {self.case_dir}:/shared/commands'
-        })
+        # Artifacts are written by several guests at once and by host (live
+        # logs, timeout dumps) so they need a coherent transport. So do build
+        # cache and ccache which are shared by all guests and runs. Commands
+        # are write-once files written by host, they can be cached.
+        folders = SharedFolders()
+        folders.add('rsync', self.sssd_dir, '/shared/sssd')
+        folders.add(
+            SharedFolders.coherent(self.transport),
+            self.artifacts_dir,
+            '/shared/artifacts'
+        )
+        folders.add(self.transport, self.case_dir, '/shared/commands')
+
+        if self.build_cache is not None:
+            folders.add(
+                SharedFolders.coherent(self.transport),
+                self.build_cache.host_dir,
+                BuildCache.GuestDir
+            )
+            folders.add(
+                SharedFolders.coherent(self.transport),
+                self.build_cache.ccache_dir,
+                BuildCache.CcacheGuestDir
+            )
+
+        upshell = nutcli.shell.Shell(env=folders.get_env())
 
-        return TaskList(
+        linux_guests = [
+            x for x in self.guests if x in TestSuiteActor.LinuxGuests
+        ]
+
+        return TestCaseTaskList(
+            self.results,
             name=self.name,
             logger=self.actor.logger,
-            timeout=self.timeout
+            timeout=self.timeout,
+            on_failure=self.halt_kept_guests
         )([
             Task(
                 name=f'Destroying guests: {self.guests}',
-                enabled=self.destroy_guests
+                enabled=self.destroy_guests and self.start_guests
+                and not self.overlays
             )(
                 VagrantDestroyActor(parent=self.actor), self.guests
             ),
             Task(
                 name=f'Halting guests: {self.guests}',
-                enabled=not self.destroy_guests
+                enabled=(not self.destroy_guests or self.overlays)
+                and self.start_guests
             )(
                 VagrantHaltActor(parent=self.actor), self.guests
             ),
             Task(
-                name=f'Starting guests: {self.guests}'
+                name=f'Resetting disk overlays: {self.guests}',
+                enabled=self.overlays and self.destroy_guests
+                and self.start_guests
+            )(
+                self.reset_overlays
+            ),
+            Task(
+                name=f'Starting guests: {self.guests}',
+                enabled=self.start_guests
             )(
                 VagrantUpActor(parent=self.actor, shell=upshell), self.guests
             ),
+            Task(
+                name=f'Waiting for guests: {self.guests}',
+                enabled=self.start_guests
+            )(
+                VagrantWaitActor(parent=self.actor), self.guests
+            ),
+            Task(
+                name=f'Mounting shared folders: {linux_guests}',
+                enabled=self.mount_folders and bool(linux_guests)
+            )(
+                VagrantSSHFSMountActor(parent=self.actor, shell=upshell),
+                linux_guests
+            ),
+            Task(
+                name=f'Synchronizing SSSD sources: {linux_guests}',
+                enabled=not self.start_guests and bool(linux_guests)
+            )(
+                VagrantRsyncActor(parent=self.actor, shell=upshell),
+                linux_guests
+            ),
+            Task(
+                name='Cleaning up guests',
+                enabled=not self.start_guests and bool(self.cleanup)
+            )(
+                self.cleanup_guests
+            ),
+            Task(
+                name='Validating enrollment',
+                enabled=self.golden is not None and self.start_guests
+            )(
+                self.validate_enrollment
+            ),
+            Task(
+                name='Starting telemetry',
+                enabled=self.telemetry_interval > 0
+            )(
+                self.start_telemetry
+            ),
+            Task(
+                name='Streaming logs',
+                enabled=bool(self.logs)
+            )(
+                self.start_streaming
+            ),
             *self.get_tasks(),
             Task(
-                name=f'Archive artifacts',
+                name='Stopping log streaming',
+                enabled=bool(self.logs),
                 always=True
             )(
-                artifacts.archive
+                self.stop_streaming
+            ),
+            Task(
+                name='Stopping telemetry',
+                enabled=self.telemetry_interval > 0,
+                always=True
+            )(
+                self.stop_telemetry
+            ),
+            Task(
+                name='Archive artifacts',
+                always=True
+            )(
+                artifacts.archive, self.archiver
+            ),
+            Task(
+                name='Waiting for artifacts transfer',
+                always=True
+            )(
+                self.archiver.wait
             ),
             Task(
                 name=f'Halting guests: {self.guests}',
+                enabled=self.stop_guests,
                 always=True
             )(
                 VagrantHaltActor(parent=self.actor), self.guests
@@ -132,6 +437,94 @@ class TestCase(object):
 
 
 class TestCommand(object):
+    """
+    Run shell script on a guest.
+
+    The script runs in its own session on the guest. If it does not finish
+    in time (or the task is interrupted), all processes of the session,
+    their descendants and processes with the task marker in environment
+    are killed after their stacks are dumped to /shared/artifacts and the
+    guest is confirmed to be idle before the next command is run.
+    """
+
+    StateDir = '/var/tmp/sssd-test-suite/tasks'
+
+    Marker = 'SSSD_TEST_SUITE_TASK'
+
+    KillScript = textwrap.dedent('''
+    sidfile={state}/{id}.sid
+    if [ ! -f $sidfile ]; then
+        exit 0
+    fi
+
+    sid=$(cat $sidfile)
+
+    # Processes of the task session and all their descendants (commands run
+    # by sudo with use_pty get a new session) and processes that still have
+    # the task marker in their environment (e.g. reparented daemons).
+    collect() {{
+        {{
+            ps -eo pid=,ppid=,sid= | awk -v sid=$sid '
+                {{ parent[$1] = $2; if ($3 == sid) found[$1] = 1 }}
+                END {{
+                    do {{
+                        changed = 0
+                        for (pid in parent) {{
+                            if (!(pid in found) && (parent[pid] in found)) {{
+                                found[pid] = 1
+                                changed = 1
+                            }}
+                        }}
+                    }} while (changed)
+                    for (pid in found) print pid
+                }}'
+            sudo grep -lsz '^{marker}={id}$' /proc/[0-9]*/environ | cut -d/ -f3
+        }} | sort -un | xargs
+    }}
+
+    list() {{
+        ps -o pid,ppid,user,stat,etime,args -p "$(echo $1 | tr ' ' ,)"
+    }}
+
+    pids=$(collect)
+    if [ -z "$pids" ]; then
+        rm -f $sidfile
+        exit 0
+    fi
+
+    {{
+        echo "Task {id} on {guest} timed out, running processes:"
+        list "$pids"
+        for pid in $pids; do
+            echo ""
+            echo "== $pid: $(tr '\\0' ' ' < /proc/$pid/cmdline)"
+            echo "wchan: $(cat /proc/$pid/wchan)"
+            sudo cat /proc/$pid/stack
+            if command -v eu-stack &> /dev/null; then
+                sudo timeout 30 eu-stack -p $pid
+            elif command -v gdb &> /dev/null; then
+                sudo timeout 30 gdb -batch -p $pid -ex 'thread apply all bt'
+            fi
+        done
+    }} 2>&1 | tee /shared/artifacts/timeout-{guest}-{id}.log
+
+    for signal in TERM KILL; do
+        sudo kill -$signal $pids 2> /dev/null
+        for i in $(seq 1 10); do
+            pids=$(collect)
+            if [ -z "$pids" ]; then
+                rm -f $sidfile
+                exit 0
+            fi
+            sleep 1
+        done
+    done
+
+    echo "Unable to kill processes:"
+    list "$pids"
+    exit 1
+    ''')
+
     def __init__(self, actor, case_dir, cwd=None, timeout=None):
         self.actor = actor
         self.case_dir = case_dir
@@ -139,6 +532,10 @@ class TestCommand(object):
         self.timeout = timeout
 
     def run_command(self, guest, command):
+        # Remote processes may take long to kill when interrupted
+        aio.run(self.run_command_async(guest, command), cancel_timeout=None)
+
+    async def run_command_async(self, guest, command):
         with tempfile.NamedTemporaryFile(dir=self.case_dir) as f:
             if self.cwd is not None:
                 self._change_directory(f, self.cwd)
@@ -147,14 +544,55 @@ class TestCommand(object):
             f.flush()
             os.fchmod(f.fileno(), 0o755)
 
-            @nutcli.decorators.Timeout(timeout=self.timeout)
-            def run():
-                VagrantSSHActor(parent=self.actor)(
-                    guest=guest,
-                    argv=[f'/shared/commands/{os.path.basename(f.name)}']
+            ssh = aio.VagrantSSH(
+                VagrantSSHActor(parent=self.actor), self.actor.logger
+            )
+
+            id = os.path.basename(f.name)
+            try:
+                await ssh.run(
+                    guest,
+                    self.get_remote_command(id),
+                    timeout=aio.parse_timeout(self.timeout)
                 )
+            except (nutcli.shell.ShellTimeoutError, asyncio.CancelledError):
+                # The guest must be idle before anything else runs on it.
+                await aio.complete(self.kill_remote(ssh, guest, id))
+                raise
+
+    def get_remote_command(self, id):
+        # Session id of the script is stored so all its processes can be
+        # found and killed even when the SSH connection is gone.
+        script = shlex.quote(
+            f'echo $$ > {self.StateDir}/{id}.sid && exec /shared/commands/{id}'
+        )
+
+        wrapper = (
+            f'mkdir -p {self.StateDir} && '
+            f'export {self.Marker}={id} && '
+            f'setsid -w bash -c {script}; '
+            f'rc=$?; rm -f {self.StateDir}/{id}.sid; exit $rc'
+        )
+
+        return ['bash', '-c', shlex.quote(wrapper)]
+
+    async def kill_remote(self, ssh, guest, id):
+        script = self.KillScript.format(
+            state=self.StateDir, id=id, guest=guest, marker=self.Marker
+        )
+        result = await ssh.run(
+            guest, ['bash', '-c', shlex.quote(script)],
+            capture_output=True, check=False, timeout=300
+        )
 
-            run()
+        for line in (result.stdout or '').splitlines():
+            self.actor.logger.info(f'[{guest}] {line}')
+
+        if result.rc != 0:
+            raise RuntimeError(
+                f'Guest {guest} is not idle, processes of timed out task '
+                f'{id} are still running'
+            )
 
     def _change_directory(self, f, dest):
         f.write(textwrap.dedent(f'''
@@ -166,19 +604,60 @@ class TestCommand(object):
 class TestCaseTask(TestCommand):
     def __init__(
         self, actor, case_dir,
-        guest, command, artifacts=None, cwd=None, timeout=None
+        guest, command, artifacts=None, cwd=None, timeout=None,
+        archiver=None, build_cache=None, build_dir=None
     ):
         super().__init__(actor, case_dir, cwd, timeout)
 
         self.guest = guest
         self.command = command
         self.artifacts = artifacts
+        self.archiver = archiver
+        self.build_cache = build_cache
+        self.build_dir = build_dir
 
-    def execute(self):
+    def execute(self, task):
         try:
-            self.run_command(self.guest, self.command)
+            if self.build_cache is None:
+                self.run_command(self.guest, self.command)
+            elif self.build_dir is None:
+                self.run_command(
+                    self.guest,
+                    self.build_cache.get_environment_script() + self.command
+                )
+            else:
+                self.execute_cached(task)
         finally:
-            self.artifacts.archive()
+            self.artifacts.archive(self.archiver)
+
+    def execute_cached(self, task):
+        machine = VagrantMachine(self.actor.project_dir, self.guest)
+        key = self.build_cache.get_key(
+            f'{machine.box_name}@{machine.box_version}',
+            self.command,
+            os.path.join(self.cwd or '', self.build_dir)
+        )
+
+        if self.build_cache.exists(key):
+            task.info(f'Restoring {self.build_dir} from build cache')
+            self.run_command(
+                self.guest,
+                self.build_cache.get_restore_script(key, self.build_dir)
+            )
+            self.build_cache.touch(key)
+            return
+
+        self.run_command(
+            self.guest,
+            self.build_cache.get_environment_script() + self.command
+        )
+
+        task.info(f'Storing {self.build_dir} in build cache')
+        self.run_command(
+            self.guest,
+            self.build_cache.get_store_script(key, self.build_dir)
+        )
+        self.build_cache.prune()
 
 
 class TestArtifacts(TestCommand):
@@ -209,23 +688,79 @@ class TestArtifacts(TestCommand):
                 files_list = get_guest_list(
                     files_map, item.get('from', self.default_guest)
                 )
-                files_list.extend(item)
+                files_list.extend(item.get('files', []))
             else:  # [files]
                 files_list = get_guest_list(files_map, self.default_guest)
                 files_list.append(item)
 
         return files_map
 
-    def archive(self):
+    def archive(self, archiver=None):
+        """
+        Copy artifacts to the artifacts directory. If archiver is set, the
+        artifacts are only copied to a snapshot directory on the guest and
+        the transfer to the shared directory is left to the archiver.
+        """
         for guest, files in self.get_files_map().items():
-            copy = [
-                f'cp -fr {f} /shared/artifacts/ &> /dev/null'
+            snapshot = f'{ArtifactsArchiver.SnapshotDir}/{uuid.uuid4().hex}'
+            dest = snapshot if archiver is not None else '/shared/artifacts'
+
+            copy = [f'mkdir -p {dest}'] + [
+                f'cp -fr {f} {dest}/ &> /dev/null'
                 + f'|| echo "> Unable to archive {f}"'
                 for f in files
             ]
 
             self.run_command(guest, '\n'.join(copy))
 
+            if archiver is not None:
+                archiver.submit(guest, snapshot)
+
+
+class ArtifactsArchiver(TestCommand):
+    """
+    Transfer artifact snapshots from guests to the artifacts directory in
+    background so the next task does not have to wait for it.
+    """
+
+    SnapshotDir = '/var/tmp/sssd-test-suite/artifacts'
+
+    def __init__(self, actor, case_dir):
+        super().__init__(actor, case_dir, cwd=None, timeout=None)
+
+        self.futures = []
+        self.lock = None
+
+    def submit(self, guest, snapshot):
+        self.futures.append(aio.submit(self.transfer(guest, snapshot)))
+
+    def wait(self):
+        """
+        Wait until all pending transfers are finished.
+        """
+        futures = self.futures
+        self.futures = []
+
+        # Transfers are cancelled when the background loop is shut down
+        errors = [
+            x.exception() for x in concurrent.futures.wait(futures).done
+            if not x.cancelled() and x.exception() is not None
+        ]
+
+        if errors:
+            raise errors[0]
+
+    async def transfer(self, guest, snapshot):
+        # Transfers are serialized so newer artifacts overwrite older ones.
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+
+        async with self.lock:
+            await self.run_command_async(guest, textwrap.dedent(f'''
+            cp -fr {snapshot}/. /shared/artifacts/
+            rm -fr {snapshot}
+            '''))
+
 
 class RunTestsActor(TestSuiteActor):
     """
@@ -239,6 +774,7 @@ class RunTestsActor(TestSuiteActor):
         run-on: guest (optional, defaults to client or machines[0])
         directory: working directory (optional, default to /shared/sssd)
         shell: pwd
+        build-cache: build directory to cache (optional)
         timeout: timeout (optional
         artifacts: (optional)
         - list of paths (guest is client or machines[0])
@@ -246,11 +782,22 @@ class RunTestsActor(TestSuiteActor):
           files:
           - list of files
       timeout: timeout (optional)
+      tags: (optional)
+      - list of tags
+      cleanup: (optional, run when guests are reused)
+      - run-on: guest (optional, defaults to client or machines[0])
+        directory: working directory (optional, default to /shared/sssd)
+        shell: command
       artifacts: (optional)
       - list of paths (guest is client or machines[0])
       - from: guest
         files:
         - list of files
+      logs: (optional)
+      - list of paths (followed on all machines)
+      - from: guest
+        files:
+        - list of paths
     """
 
     def setup_parser(self, parser):
@@ -286,19 +833,248 @@ class RunTestsActor(TestSuiteActor):
             help='Do not destroy existing machines.'
         )
 
+        parser.add_argument(
+            '--shared-folders', action='store', type=str, dest='transport',
+            choices=['auto', 'sshfs', 'sshfs-cached', 'nfs', 'virtiofs'],
+            default='sshfs-cached',
+            help='How to share artifacts and commands directories with '
+                 'guests (Default "sshfs-cached", artifacts use sshfs '
+                 'without caching).'
+        )
+
+        parser.add_argument(
+            '-g', '--golden', action='store', type=str, dest='golden',
+            help='Path to golden boxes manifest created by "box create --enroll".'
+        )
+
+        parser.add_argument(
+            '--shard', action='store', type=shard_argument, dest='shard',
+            help='Run only K-th of N parts of the test suite (format K/N).'
+        )
+
+        parser.add_argument(
+            '--history', action='store', type=str, dest='history',
+            help='Path to test durations history or results.json of a '
+                 'previous run used to balance shards. All shards must use '
+                 'the same file, shards are split round-robin without it.'
+        )
+
+        parser.add_argument(
+            '--case', action='append', type=str, dest='cases', default=[],
+            help='Run only test cases with matching name (shell wildcards '
+                 'are allowed). Can be set multiple times.'
+        )
+
+        parser.add_argument(
+            '--tag', action='append', type=str, dest='tags', default=[],
+            help='Run only test cases with this tag. Can be set multiple '
+                 'times.'
+        )
+
+        parser.add_argument(
+            '--no-build-cache', action='store_false', dest='build_cache',
+            help='Do not use build cache and ccache.'
+        )
+
+        parser.add_argument(
+            '--overlays', action='store_true', dest='overlays',
+            help='Reset copy-on-write disk overlays instead of destroying '
+                 'guests.'
+        )
+
+        parser.add_argument(
+            '--telemetry-interval', action='store', type=float,
+            dest='telemetry_interval', default=10,
+            help='How often to sample resource usage of guests and host in '
+                 'seconds, 0 disables it (Default 10).'
+        )
+
+        parser.add_argument(
+            '--reuse-guests', action='store_true', dest='reuse_guests',
+            help='Keep guests running between test cases with the same '
+                 'machines.'
+        )
+
+        parser.add_argument(
+            '--pool', action='store_true', dest='pool',
+            help='Lease running guests from the pool daemon (see '
+                 '"pool serve").'
+        )
+
+        parser.add_argument(
+            '--pool-timeout', action='store', type=int, dest='pool_timeout',
+            default=3600, metavar='SECONDS',
+            help='How long to wait until the environment is returned to the '
+                 'pool by other runs (Default 3600).'
+        )
+
+        parser.add_argument(
+            '--plan', action='store_true', dest='plan',
+            help='Print test cases that would be run with estimated '
+                 'durations and exit.'
+        )
+
+        group = parser.add_mutually_exclusive_group()
+        group.add_argument(
+            '--resume', action='store_const', const='resume', dest='reuse',
+            help='Skip test cases that already passed in previous run.'
+        )
+
+        group.add_argument(
+            '--rerun-failed', action='store_const', const='failed',
+            dest='reuse',
+            help='Run only test cases that failed in previous run.'
+        )
+
         parser.epilog = textwrap.dedent('''
         This command will execute tests described in yaml configuration file.
         This file can be specified with --test-config parameter. If not set,
-        $sssd/contrib/test-suite/test-suite.yml is used.
+        $sssd/contrib/test-suite/test-suite.yml is used. The file is validated
+        before any guest is started and the compiled plan is cached in
+        .cache/plans. Use --plan to print the schedule with durations
+        estimated from --history without running it.
+
+        If --golden is set, the guests are expected to be created from golden
+        boxes that were already enrolled together. Enrollment data from the
+        manifest are restored on the host and the guests are enrolled again
+        only if they do not belong to this set.
+
+        Commands directory is shared with guests using sshfs with caching
+        by default, artifacts directory is modified from both sides so it
+        uses sshfs without caching. Use --shared-folders to select a
+        different transport, 'auto' selects virtiofs if it is available on
+        the host, then nfs if nfs server is running, then cached sshfs.
+
+        Status and duration of each test case is written to
+        $artifacts/results.json. Durations of passed test cases are also
+        remembered in .cache/test-history.json.
+
+        If --shard K/N is set, test cases are split into N parts and only
+        the K-th part is run. Test cases are balanced by their durations
+        from --history, or assigned round-robin if --history is not set.
+        The local .cache/test-history.json differs between hosts so it is
+        never used to split shards. All shards must use the same --history
+        file. Use the 'merge' command to combine artifacts of all shards.
+
+        Test cases can be selected by name with --case and by tags listed
+        in 'tags' key of the test case with --tag. If both are set, test
+        case must match both.
+
+        --resume and --rerun-failed read $artifacts/results.json of the
+        previous run. Results are reused only if they were produced with
+        the same SSSD revision (including uncommitted changes) and the same
+        box versions. --resume skips test cases that already passed,
+        --rerun-failed runs only test cases that failed. Passed test cases
+        are kept in results.json as they were.
+
+        If --reuse-guests is set, test cases with the same machines are
+        reordered to run one after another and the guests are started only
+        for the first one and halted after the last one. For the other test
+        cases, SSSD sources are synchronized again with 'vagrant rsync'
+        (removing any files created in /shared/sssd) and commands from
+        'cleanup' key of the test case are run instead.
+
+        If --pool is set and the pool daemon is running, the environment is
+        leased from it for the whole run. Guests that are already running in
+        the pool are not started again for the first test case, shared
+        folders are mounted with sshfs instead. The environment is returned
+        to the pool when the run is finished. If it is leased by another run,
+        the run waits --pool-timeout seconds for it and fails then.
+
+        If --overlays is set, guests that do not have disk overlays yet are
+        destroyed and created again and their fresh disks become the base of
+        new overlays (see 'overlay create'). Guests are reset to the state at
+        the time when overlays were created instead of being destroyed before
+        each test case. Overlays are kept for next runs.
+
+        While test tasks are running, CPU, memory, disk and network usage of
+        guests and host load are sampled every --telemetry-interval seconds
+        and stored in $artifacts/telemetry together with per test case
+        summary.
         ''')
 
-    def __call__(self, sssd_dir, artifacts_dir, update, prune, suite, destroy):
-        suite = self.load_test_suite(suite, sssd_dir)
+    def __call__(
+        self, sssd_dir, artifacts_dir, update, prune, suite, destroy,
+        golden=None, transport='sshfs-cached', shard=None, history=None,
+        cases=None, tags=None, reuse=None, reuse_guests=False,
+        build_cache=True, overlays=False, telemetry_interval=10, plan=False,
+        pool=False, pool_timeout=3600
+    ):
+        try:
+            suite = self.load_test_suite(suite, sssd_dir).cases
+        except PlanError as e:
+            self.error(str(e))
+            return 1
 
-        required_guests = set()
-        for case in suite:
-            required_guests.update(case.get('machines', []))
-        required_guests = list(required_guests)
+        golden = GoldenManifest.load(golden) if golden is not None else None
+
+        suite = self.filter_suite(suite, cases, tags)
+
+        shared_history = bool(history)
+        history_file = f'{self.cache_dir}/test-history.json'
+        history = TestHistory.load(history if history else history_file)
+        results = TestResults(
+            shard,
+            key=self.get_run_key(sssd_dir, suite, destroy),
+            path=f'{artifacts_dir}/results.json'
+        )
+
+        previous = None
+        if reuse is not None:
+            previous = self.load_previous_results(
+                artifacts_dir, results.key, update, shard
+            )
+
+        # Continue in the same shard as the previous run
+        if previous is not None and shard is None:
+            shard = previous.shard
+            results.shard = shard
+
+        # Shards must be split identically on all hosts, only explicitly
+        # shared history can be used
+        if shard is not None:
+            suite = self.select_shard(
+                suite, shard, history if shared_history else TestHistory()
+            )
+
+        if previous is not None:
+            suite = self.select_reused(suite, previous, results, reuse)
+
+        schedule = self.schedule(suite, reuse_guests)
+        self.check_licenses(suite, history)
+
+        if plan:
+            self.print_plan(schedule, history)
+            return 0
+
+        if build_cache:
+            build_cache = BuildCache(self.cache_dir, results.key['sssd'])
+        else:
+            build_cache = None
+
+        required_guests = TestPlan(suite).guests
+
+        pool_client = None
+        ready = []
+        if pool:
+            try:
+                pool_client, ready = self.lease_environment(
+                    required_guests, update, pool_timeout
+                )
+            except PoolTimeoutError as e:
+                self.error(f'Unable to lease environment from the pool: {e}')
+                return 1
+
+            schedule = self.use_ready_guests(schedule, ready)
+
+        # Folders can be mounted on running guests only with sshfs.
+        if ready and transport not in ('sshfs', 'sshfs-cached'):
+            self.warning(f'{transport} can not be used with running guests, '
+                         'using sshfs-cached')
+            transport = 'sshfs-cached'
+
+        transport = SharedFolders.select(transport)
+        self.info(f'Using {transport} to share folders with guests')
 
         tasks = TaskList('test-suite', logger=self.logger)([
             TaskList(
@@ -309,6 +1085,9 @@ class RunTestsActor(TestSuiteActor):
                 Task('Creating artifacts directory')(
                     lambda: self.shell(['mkdir', '-p', artifacts_dir])
                 ),
+                Task('Removing disk overlays', enabled=update and overlays)(
+                    OverlayRemoveActor(parent=self).remove, required_guests
+                ),
                 Task('Destroying guests to allow update', enabled=update)(
                     VagrantDestroyActor(parent=self), guests=required_guests
                 ),
@@ -317,39 +1096,443 @@ class RunTestsActor(TestSuiteActor):
                 ),
                 Task('Removing outdated boxes', enabled=prune)(
                     VagrantPruneActor(parent=self), force=True
+                ),
+                Task('Restoring enrollment data', enabled=golden is not None)(
+                    self.restore_enrollment, golden
+                ),
+                Task('Creating build cache', enabled=build_cache is not None)(
+                    lambda: build_cache.setup()
+                ),
+                Task('Creating disk overlays', enabled=overlays)(
+                    OverlayCreateActor(parent=self).create, required_guests,
+                    recreate=True
                 )
             ])
         ])
 
         with tempfile.TemporaryDirectory() as case_dir:
-            for case in suite:
+            for case, start_guests, stop_guests in schedule:
                 test_case = TestCase(
                     actor=self,
                     sssd_dir=sssd_dir,
                     artifacts_dir=artifacts_dir,
                     case_dir=case_dir,
                     destroy_guests=destroy,
-                    name=case.get('name', None),
-                    guests=case.get('machines', ['client']),
-                    tasks=case.get('tasks', []),
-                    artifacts=case.get('artifacts', []),
-                    timeout=case.get('timeout', None)
+                    name=case['name'],
+                    guests=case['machines'],
+                    tasks=case['tasks'],
+                    artifacts=case['artifacts'],
+                    timeout=case['timeout'],
+                    golden=golden,
+                    transport=transport,
+                    logs=case['logs'],
+                    results=results,
+                    start_guests=start_guests,
+                    stop_guests=stop_guests,
+                    cleanup=case['cleanup'],
+                    build_cache=build_cache,
+                    overlays=overlays,
+                    telemetry_interval=telemetry_interval,
+                    mount_folders=not start_guests and case is schedule[0][0]
                 )
 
                 tasks.append(test_case.get_tasklist())
 
-            tasks.execute()
+            # Guests must not be rebooted by license rearm during the run.
+            lock = RunLock(f'{self.cache_dir}/run.lock')
+            if not lock.acquire():
+                self.info('Waiting for Windows license renewal to finish')
+                lock.acquire(wait=True)
+
+            try:
+                tasks.execute()
+            finally:
+                lock.release()
+                if pool_client is not None:
+                    pool_client.release()
+                self.save_results(artifacts_dir, suite, results)
+                history.update(results)
+                history.save(history_file)
 
         return 0
 
+    def lease_environment(self, guests, update, timeout=None):
+        """
+        Lease environment from the pool daemon. Return (client, list of
+        guests that are ready) or (None, []) if the pool can not be used.
+        Raise PoolTimeoutError if the environment is not returned by other
+        runs in time, the guests must not be used then.
+        """
+        if update:
+            self.warning('Boxes may be updated, pool is not used')
+            return (None, [])
+
+        if nutcli.decorators.SideEffect.is_dry_run:
+            return (None, [])
+
+        client = PoolClient(f'{self.project_dir}/.pool.sock')
+        self.info('Leasing environment from the pool (waiting until it is '
+                  'returned by other runs)')
+        try:
+            ready = client.lease(guests, timeout)
+        except PoolTimeoutError:
+            raise
+        except (PoolError, OSError) as e:
+            self.warning(f'Unable to lease environment from the pool: {e}')
+            return (None, [])
+
+        if ready is None:
+            self.warning('Pool daemon is not running')
+            return (None, [])
+
+        self.info(f'Leased environment with running guests: {ready}')
+        return (client, ready)
+
+    def use_ready_guests(self, schedule, ready):
+        """
+        Do not start guests of the first test case if they are all ready.
+        """
+        if not schedule:
+            return schedule
+
+        case, start, stop = schedule[0]
+        if not set(case['machines']).issubset(ready):
+            return schedule
+
+        return [(case, False, stop)] + schedule[1:]
+
+    def schedule(self, suite, reuse_guests):
+        """
+        Return list of (case, start_guests, stop_guests). If guests are
+        reused, cases with the same machines are grouped together in order
+        of their first appearance and guests are kept running inside the
+        group.
+        """
+        def machines(case):
+            return tuple(sorted(set(case['machines'])))
+
+        if not reuse_guests:
+            return [(case, True, True) for case in suite]
+
+        groups = {}
+        for case in suite:
+            groups.setdefault(machines(case), []).append(case)
+
+        schedule = []
+        for cases in groups.values():
+            for idx, case in enumerate(cases):
+                schedule.append((case, idx == 0, idx == len(cases) - 1))
+
+        self.info(f'Guests are started {len(groups)} times '
+                  f'for {len(suite)} test cases')
+
+        return schedule
+
+    def print_plan(self, schedule, history):
+        plan = TestPlan([case for case, start, stop in schedule])
+        estimates = plan.estimate(history)
+
+        def duration(seconds):
+            if seconds is None:
+                return 'unknown'
+
+            return time.strftime('%H:%M:%S', time.gmtime(seconds))
+
+        print('{:4} {:40} {:25} {:>10}'.format(
+            '#', 'Test case', 'Machines', 'Estimate'
+        ))
+
+        for i, (case, start, stop) in enumerate(schedule):
+            machines = ' '.join(case['machines'])
+            if not start:
+                machines += ' (reused)'
+
+            print('{:<4} {:40} {:25} {:>10}'.format(
+                i + 1, case['name'], machines, duration(estimates[i])
+            ))
+
+        known = [x for x in estimates if x is not None]
+        print('')
+        print(f'Test cases: {len(schedule)}')
+        print(f'Guests: {" ".join(plan.guests)}')
+        print('Estimated duration: {}'.format(
+            duration(sum(known)) if known else 'unknown'
+        ))
+
+    def check_licenses(self, suite, history):
+        """
+        Warn about Windows guests whose license would expire before the
+        test run is expected to finish.
+        """
+        plan = TestPlan(suite)
+        guests = [x for x in plan.guests if x in self.WindowsGuests]
+        if not guests:
+            return
+
+        licenses = WindowsLicenses.load(
+            self.project_dir, f'{self.cache_dir}/windows-license.json'
+        )
+
+        estimate = sum([x for x in plan.estimate(history) if x is not None])
+        for guest in guests:
+            remaining = licenses.remaining(guest)
+            if remaining is None:
+                self.info(f'{guest}: Windows license state is not known, '
+                          'see "provision license"')
+            elif remaining.total_seconds() <= estimate:
+                self.warning(
+                    f'{guest}: Windows license expires in '
+                    f'{str(remaining).split(".")[0]}, before '
+                    'the tests are expected to finish. Renew it with '
+                    '"provision license --rearm-within DAYS"'
+                )
+
+    def filter_suite(self, suite, cases, tags):
+        if cases:
+            suite = [
+                x for x in suite
+                if any([fnmatch.fnmatchcase(x['name'], p) for p in cases])
+            ]
+
+        if tags:
+            suite = [
+                x for x in suite
+                if set(tags).intersection(x['tags'])
+            ]
+
+        if cases or tags:
+            self.info(f'Selected {len(suite)} test cases')
+
+        return suite
+
+    def get_sssd_revision(self, sssd_dir):
+        def git(*args):
+            result = subprocess.run(
+                ['git', '-C', sssd_dir, *args],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL
+            )
+
+            return result.stdout if result.returncode == 0 else None
+
+        revision = git('rev-parse', 'HEAD')
+        if revision is None:
+            return None
+
+        revision = revision.decode('utf-8').strip()
+
+        # Uncommitted changes, including new files that are not ignored
+        diff = git('diff', 'HEAD') or b''
+        untracked = git('ls-files', '--others', '--exclude-standard', '-z')
+        untracked = [x for x in (untracked or b'').split(b'\0') if x]
+        if not diff and not untracked:
+            return revision
+
+        sha256 = hashlib.sha256(diff)
+        for name in sorted(untracked):
+            sha256.update(b'\0' + name + b'\0')
+            try:
+                with open(os.path.join(os.fsencode(sssd_dir), name), 'rb') as f:
+                    sha256.update(f.read())
+            except OSError:
+                pass
+
+        return revision + '+' + sha256.hexdigest()[:12]
+
+    def get_box_versions(self, guests, destroy):
+        """
+        Box versions that will be used by guests. Existing guests are kept
+        if they are not destroyed, otherwise the newest installed box is
+        used.
+        """
+        result = subprocess.run(
+            ['vagrant', 'box', 'list'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            env={**os.environ, 'VAGRANT_CWD': self.vagrant_dir}
+        )
+
+        installed = {}
+        regex = re.compile(r'^(\S+)\s+\(([^,]+), ([^)]+)\)$', re.MULTILINE)
+        for (box, provider, version) in regex.findall(result.stdout.decode()):
+            installed.setdefault(box, []).append(version)
+
+        def version_key(version):
+            return [int(x) if x.isdigit() else 0 for x in version.split('.')]
+
+        with open(self.get_config_file()) as f:
+            config = json.load(f)
+
+        versions = {}
+        for guest in sorted(guests):
+            machine = VagrantMachine(self.project_dir, guest)
+            if not destroy and machine.id is not None:
+                versions[guest] = f'{machine.box_name}@{machine.box_version}'
+                continue
+
+            box = config.get('boxes', {}).get(guest, {}).get('name', None)
+            available = sorted(installed.get(box, []), key=version_key)
+            versions[guest] = f'{box}@{available[-1] if available else None}'
+
+        return versions
+
+    def get_run_key(self, sssd_dir, suite, destroy):
+        try:
+            boxes = self.get_box_versions(TestPlan(suite).guests, destroy)
+        except (OSError, ValueError) as e:
+            self.warning(f'Unable to read box versions: {e}')
+            boxes = None
+
+        return {
+            'sssd': self.get_sssd_revision(sssd_dir),
+            'boxes': boxes,
+        }
+
+    def load_previous_results(self, artifacts_dir, key, update, shard=None):
+        path = f'{artifacts_dir}/results.json'
+        if not os.path.exists(path):
+            self.warning(f'{path} does not exist, running all test cases')
+            return None
+
+        if update:
+            self.warning('Boxes may be updated, running all test cases')
+            return None
+
+        if key['sssd'] is None or key['boxes'] is None:
+            self.warning('Unable to identify SSSD revision or box versions, '
+                         'running all test cases')
+            return None
+
+        previous = TestResults.load(path)
+        if previous.key != key:
+            self.warning('Previous results were produced with different SSSD '
+                         'revision or boxes, running all test cases')
+            return None
+
+        if shard is not None and previous.shard != shard:
+            self.warning(f'Previous results were produced by shard '
+                         f'{previous.shard}, running all test cases')
+            return None
+
+        return previous
+
+    def select_reused(self, suite, previous, results, reuse):
+        passed = {x['name']: x for x in previous.passed}
+        failed = {x['name'] for x in previous.failed}
+
+        selected = []
+        reused = 0
+        for case in suite:
+            if case['name'] in passed:
+                results.reuse(passed[case['name']])
+                reused += 1
+            elif reuse == 'resume':
+                selected.append(case)
+            elif case['name'] in failed:
+                selected.append(case)
+            elif previous.get(case['name']) is not None:
+                results.reuse(previous.get(case['name']))
+
+        self.info(f'Reusing {reused} passed test cases, '
+                  f'running {len(selected)} test cases')
+
+        return selected
+
+    def select_shard(self, suite, shard, history):
+        k, n = parse_shard(shard)
+        selected = select_shard([x['name'] for x in suite], k, n, history)
+
+        self.info(f'Running shard {k}/{n}: {len(selected)} of {len(suite)} test cases')
+        return [suite[i] for i in selected]
+
+    def save_results(self, artifacts_dir, suite, results):
+        for case in suite:
+            if results.get(case['name']) is None:
+                results.record(case['name'], TestResults.Skipped, 0)
+
+        results.save(f'{artifacts_dir}/results.json')
+
+    @nutcli.decorators.SideEffect()
+    def restore_enrollment(self, golden):
+        golden.restore(f'{self.project_dir}/shared-enrollment')
+
     def load_test_suite(self, config, sssd):
         if config is None:
             config = f'{sssd}/contrib/test-suite/test-suite.yml'
 
-        with open(config) as f:
-            return yaml.safe_load(f)
+        return TestPlan.compile(config, self.cache_dir)
+
+
+class MergeResultsActor(TestSuiteActor):
+    def setup_parser(self, parser):
+        parser.add_argument(
+            'shards', nargs='+',
+            help='Artifacts directories of the shards.'
+        )
+
+        parser.add_argument(
+            '-o', '--output', action='store', type=str, dest='output',
+            help='Path to directory where merged artifacts will be stored.',
+            required=True
+        )
+
+        parser.epilog = textwrap.dedent('''
+        Artifacts of all shards are copied into the output directory. If the
+        same file exists in more shards, the shard number is appended to its
+        name. Results of all shards are merged into $output/results.json,
+        this file can be used as --history of the next run.
+
+        The command fails if any test case failed or was skipped.
+        ''')
+
+    def __call__(self, shards, output):
+        merged = []
+        for idx, shard in enumerate(shards, start=1):
+            path = f'{shard}/results.json'
+            if not os.path.exists(path):
+                self.warning(f'{path} does not exist')
+                results = TestResults()
+            else:
+                results = TestResults.load(path)
+
+            merged.append(results)
+            suffix = (results.shard or str(idx)).split('/')[0]
+            self.copy_artifacts(shard, output, f'shard-{suffix}')
+
+        results = TestResults.merge(merged)
+        results.save(f'{output}/results.json')
+
+        for case in results.cases:
+            print('{:10} {:>10.1f}s  {}'.format(
+                case['status'], case['duration'], case['name']
+            ))
+
+        passed = len([
+            x for x in results.cases if x['status'] == TestResults.Passed
+        ])
+
+        print(f'{passed} of {len(results.cases)} test cases passed')
+
+        return 0 if passed == len(results.cases) else 1
+
+    @nutcli.decorators.SideEffect()
+    def copy_artifacts(self, src, dest, suffix):
+        for root, dirs, files in os.walk(src):
+            destdir = os.path.join(dest, os.path.relpath(root, src))
+            os.makedirs(destdir, exist_ok=True)
+
+            for name in files:
+                if root == src and name == 'results.json':
+                    continue
+
+                target = os.path.join(destdir, name)
+                if os.path.exists(target):
+                    target = f'{target}.{suffix}'
+
+                shutil.copy2(os.path.join(root, name), target)
 
 
 Commands = [
-    Command('run', 'Run SSSD tests', RunTestsActor())
+    Command('run', 'Run SSSD tests', RunTestsActor()),
+    Command('merge', 'Merge artifacts and results of test suite shards', MergeResultsActor())
 ]
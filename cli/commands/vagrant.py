@@ -20,15 +20,21 @@
 #
 
 import argparse
-import os
 import re
 import sys
+import textwrap
+import time
 
 import nutcli
 from nutcli.commands import Command
 from nutcli.parser import UniqueAppendAction
 
 from util.actor import TestSuiteActor
+from util.environment import Environment
+from util.output import CommandOutput
+from util.readiness import ReadinessChecker, get_probes
+from util.sizing import GuestSizing
+from util.status import GuestStatus
 
 
 class VagrantCommandActor(TestSuiteActor):
@@ -52,33 +58,57 @@ class VagrantCommandActor(TestSuiteActor):
             help='Run operation on guests in sequence (one by one)'
         )
 
+        CommandOutput.add_argument(parser)
+
         parser.add_argument(
             '--argv', dest='argv', nargs=argparse.REMAINDER, default=[],
             help='Additional arguments passed to the command'
         )
 
-    def _exec_vagrant(self, args=None, argv=None, **kwargs):
-        if self.cli_args.config is not None:
-            config = self.cli_args.config
-        else:
-            config = os.environ.get(
-               'SSSD_TEST_SUITE_CONFIG', self.vagrant_dir + '/config.json'
-            )
-
+    def get_command(self, args=None, argv=None):
         command = ['vagrant', *self.command.split(' '), *nutcli.utils.get_as_list(args)]
         if argv is not None:
             command += ['--'] + argv
 
+        return command
+
+    def get_env(self):
+        config = self.get_config_file()
+
+        env = {
+            'VAGRANT_CWD': self.vagrant_dir,
+            'SSSD_TEST_SUITE_CONFIG': config,
+            **GuestSizing.from_file(config).get_env()
+        }
+
+        # Vagrantfile reads precomputed environment instead of evaluating
+        # the configuration again.
+        environment = Environment.from_file(
+            self.project_dir, config, self.shell.env.clone().set(env).get()
+        )
+
+        if environment is not None:
+            env['SSSD_TEST_SUITE_ENVIRONMENT'] = environment.save(
+                f'{self.cache_dir}/environment'
+            )
+
+        return env
+
+    def _exec_vagrant(self, args=None, argv=None, **kwargs):
         return self.shell(
-            command,
-            env={
-                'VAGRANT_CWD': self.vagrant_dir,
-                'SSSD_TEST_SUITE_CONFIG': config
-            },
+            self.get_command(args, argv),
+            env=self.get_env(),
             **kwargs
         )
 
-    def __call__(self, guests, sequence=False, argv=None):
+    def prepare(self, guests):
+        """
+        Called before vagrant is executed, override to do additional work
+        that belongs to the command.
+        """
+        pass
+
+    def __call__(self, guests, sequence=False, argv=None, output='text'):
         argv = nutcli.utils.get_as_list(argv)
 
         def run_guest(guests, argv):
@@ -91,17 +121,59 @@ class VagrantCommandActor(TestSuiteActor):
         guests = guests if 'all' not in guests else self.AllGuests
         guests.sort()
 
-        if sequence:
-            for guest in guests:
-                run_guest([guest], argv)
-        else:
-            run_guest(guests, argv)
+        with CommandOutput(self.command, output) as out:
+            durations = {}
+            try:
+                self.prepare(guests)
+                if sequence:
+                    for guest in guests:
+                        start = time.monotonic()
+                        run_guest([guest], argv)
+                        durations[guest] = round(time.monotonic() - start, 3)
+                else:
+                    # Guests are handled by single vagrant process so they
+                    # all share its duration.
+                    start = time.monotonic()
+                    run_guest(guests, argv)
+                    duration = round(time.monotonic() - start, 3)
+                    durations = {guest: duration for guest in guests}
+            finally:
+                if out.json:
+                    out.set(
+                        durations=durations,
+                        guests=GuestStatus(
+                            self.logger, self.project_dir
+                        ).collect(guests)
+                    )
 
 
 class VagrantStatusActor(VagrantCommandActor):
     def __init__(self, *args, **kwargs):
         super().__init__('status', None, *args, **kwargs)
 
+    def __call__(self, guests, sequence=False, argv=None, output='text'):
+        sizing = GuestSizing.from_file(self.get_config_file())
+
+        # Vagrant is not run at all to get machine readable status.
+        if output == 'json':
+            guests = guests if 'all' not in guests else self.AllGuests
+            with CommandOutput(self.command, output) as out:
+                status = GuestStatus(self.logger, self.project_dir).collect(
+                    sorted(guests)
+                )
+
+                for guest, info in status.items():
+                    info['cpus'] = sizing.cpus.get(guest, None)
+                    info['memory'] = sizing.memory.get(guest, None)
+
+                out.set(guests=status)
+            return
+
+        for line in sizing.describe():
+            self.info(line)
+
+        super().__call__(guests, sequence, argv)
+
 
 class VagrantUpActor(VagrantCommandActor):
     def __init__(self, *args, **kwargs):
@@ -113,16 +185,26 @@ class VagrantHaltActor(VagrantCommandActor):
         super().__init__('halt', None, *args, **kwargs)
 
 
+class VagrantRsyncActor(VagrantCommandActor):
+    def __init__(self, *args, **kwargs):
+        super().__init__('rsync', None, *args, **kwargs)
+
+
+class VagrantSSHFSMountActor(VagrantCommandActor):
+    def __init__(self, *args, **kwargs):
+        super().__init__('sshfs --mount', None, *args, **kwargs)
+
+
 class VagrantDestroyActor(VagrantCommandActor):
     def __init__(self, *args, **kwargs):
         super().__init__('destroy', [2], *args, **kwargs)
 
-    def __call__(self, guests, sequence=False, argv=None):
+    def __call__(self, guests, sequence=False, argv=None, output='text'):
         argv = nutcli.utils.get_as_list(argv)
         if '-f' not in argv:
             argv.append('-f')
 
-        super().__call__(guests, sequence, argv)
+        super().__call__(guests, sequence, argv, output)
 
 
 class VagrantReloadActor(VagrantCommandActor):
@@ -144,13 +226,13 @@ class VagrantUpdateActor(VagrantCommandActor):
     def __init__(self, *args, **kwargs):
         super().__init__('box update', None, *args, **kwargs)
 
-    def __call__(self, guests, sequence=False, argv=None):
+    def __call__(self, guests, sequence=False, argv=None, output='text'):
         argv = nutcli.utils.get_as_list(argv)
 
         if not sys.stdout.isatty() and not '--no-tty' in argv:
             argv.append('--no-tty')
 
-        return super().__call__(guests, sequence, argv)
+        return super().__call__(guests, sequence, argv, output)
 
 
 class VagrantPackageActor(VagrantCommandActor):
@@ -239,6 +321,43 @@ class VagrantRDPActor(VagrantCommandActor):
         self._exec_vagrant([guest], argv)
 
 
+class VagrantWaitActor(TestSuiteActor):
+    def setup_parser(self, parser):
+        parser.add_argument(
+            'guests', nargs='*',
+            choices=['all'] + self.AllGuests,
+            action=UniqueAppendAction,
+            default='all',
+            help='Guests to wait for. '
+                 'Multiple guests can be set. (Default "all")'
+        )
+
+        parser.add_argument(
+            '-t', '--timeout', action='store', type=int, dest='timeout',
+            default=900, help='Maximum time to wait in seconds (Default 900)'
+        )
+
+        parser.epilog = textwrap.dedent('''
+        Wait until services provided by selected guests are ready. All
+        services are checked concurrently using their own protocol:
+
+        - ipa: SSH, LDAP rootDSE, Kerberos KDC and DNS
+        - ldap: SSH and LDAP rootDSE
+        - client: SSH
+        - ad, ad-child: WinRM, LDAP rootDSE, Kerberos KDC and DNS
+        ''')
+
+    def __call__(self, guests, timeout=900):
+        guests = guests if 'all' not in guests else self.AllGuests
+        self.wait(guests, timeout)
+
+    @nutcli.decorators.SideEffect()
+    def wait(self, guests, timeout):
+        ReadinessChecker(self.logger, timeout=timeout).wait({
+            guest: get_probes(guest) for guest in guests
+        })
+
+
 Commands = [
     Command('status', 'Show current state of guest machines', VagrantStatusActor()),
     Command('up', 'Bring up guest machines', VagrantUpActor()),
@@ -247,6 +366,7 @@ Commands = [
     Command('reload', 'Restarts guest machines', VagrantReloadActor()),
     Command('resume', 'Resume suspended guest machines', VagrantResumeActor()),
     Command('suspend', 'Suspends guest machines', VagrantSuspendActor()),
+    Command('wait', 'Wait until guest services are ready', VagrantWaitActor()),
     Command('ssh', 'Open SSH to guest machine', VagrantSSHActor()),
     Command('rdp', 'Open remote desktop to guest machine', VagrantRDPActor()),
 ]
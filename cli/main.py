@@ -9,8 +9,11 @@ import argcomplete
 import nutcli.commands
 import nutcli.runner
 
+import commands.bench
 import commands.box
 import commands.cloud
+import commands.overlay
+import commands.pool
 import commands.provision
 import commands.tests
 import commands.vagrant
@@ -42,12 +45,15 @@ class Program:
         nutcli.commands.CommandParser()([
             nutcli.commands.CommandGroup('Vagrant Commands')([
                 commands.vagrant.Commands,
+                commands.overlay.Commands,
             ]),
             nutcli.commands.CommandGroup('Automation')([
                 commands.tests.Commands,
                 commands.provision.Commands,
                 commands.box.Commands,
-                commands.cloud.Commands
+                commands.cloud.Commands,
+                commands.bench.Commands,
+                commands.pool.Commands
             ])
         ]).setup_parser(parser)
         argcomplete.autocomplete(parser)
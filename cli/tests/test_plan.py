@@ -0,0 +1,88 @@
+import textwrap
+
+import pytest
+from nutcli.tasks import Task
+
+from commands import tests
+from util import plan as testplan
+from util import results as testresults
+
+
+def compile_plan(tmp_path, suite, cache_dir=None):
+    path = tmp_path / 'suite.yml'
+    path.write_text(textwrap.dedent(suite))
+    return testplan.TestPlan.compile(str(path), cache_dir)
+
+
+def test_timeout_is_compiled_to_whole_seconds(tmp_path):
+    plan = compile_plan(tmp_path, '''
+        - name: Case A
+          machines: [client]
+          timeout: 6 hours
+          tasks:
+          - shell: echo hi
+            timeout: 1.5 seconds
+        - name: Case B
+          machines: [client]
+          timeout: 90
+          tasks:
+          - shell: echo hi
+    ''')
+
+    case_a, case_b = plan.cases
+    assert case_a['timeout'] == 21600
+    assert type(case_a['timeout']) == int
+    assert case_a['tasks'][0]['timeout'] == 2
+    assert case_b['timeout'] == 90
+    assert case_b['tasks'][0]['timeout'] is None
+
+
+def test_cached_plan_keeps_timeout(tmp_path):
+    suite = '''
+        - name: Case A
+          machines: [client]
+          timeout: 1 hour 30 minutes
+          tasks:
+          - shell: echo hi
+    '''
+
+    cache_dir = tmp_path / 'cache'
+    compile_plan(tmp_path, suite, str(cache_dir))
+    plan = compile_plan(tmp_path, suite, str(cache_dir))
+
+    assert plan.cases[0]['timeout'] == 5400
+
+
+def test_compiled_case_with_string_timeout_runs(tmp_path):
+    plan = compile_plan(tmp_path, '''
+        - name: Case A
+          machines: [client]
+          timeout: 6 hours
+          tasks:
+          - shell: echo hi
+    ''')
+
+    case = plan.cases[0]
+    results = testresults.TestResults()
+    tests.TestCaseTaskList(
+        results,
+        name=case['name'],
+        timeout=case['timeout'],
+    )([
+        Task('Run task')(lambda: None),
+    ]).execute()
+
+    assert [x['name'] for x in results.passed] == ['Case A']
+
+
+def test_invalid_timeout_is_reported(tmp_path):
+    with pytest.raises(testplan.PlanError) as e:
+        compile_plan(tmp_path, '''
+            - name: Case A
+              machines: [client]
+              timeout: forever
+              tasks:
+              - shell: echo hi
+        ''')
+
+    assert 'timeout' in str(e.value)
@@ -0,0 +1,29 @@
+import argparse
+
+import pytest
+
+from util import results as testresults
+
+
+def test_shard_argument():
+    assert testresults.shard_argument('2/3') == '2/3'
+
+    for value in ['3/2', '0/2', '1', 'a/b']:
+        with pytest.raises(argparse.ArgumentTypeError):
+            testresults.shard_argument(value)
+
+
+def test_select_shard_without_history_is_round_robin():
+    names = ['a', 'b', 'c', 'd', 'e']
+    history = testresults.TestHistory()
+
+    assert testresults.select_shard(names, 1, 2, history) == [0, 2, 4]
+    assert testresults.select_shard(names, 2, 2, history) == [1, 3]
+
+
+def test_select_shard_with_history_is_balanced():
+    names = ['a', 'b', 'c', 'd']
+    history = testresults.TestHistory({'a': [10], 'b': [1], 'c': [1], 'd': [8]})
+
+    assert testresults.select_shard(names, 1, 2, history) == [0]
+    assert testresults.select_shard(names, 2, 2, history) == [1, 2, 3]
@@ -41,3 +41,12 @@ class TestSuiteActor(nutcli.commands.Actor):
         )
 
         self.vagrant_dir = self.project_dir
+        self.cache_dir = f'{self.project_dir}/.cache'
+
+    def get_config_file(self):
+        if self.cli_args is not None and self.cli_args.config is not None:
+            return self.cli_args.config
+
+        return os.environ.get(
+            'SSSD_TEST_SUITE_CONFIG', self.vagrant_dir + '/config.json'
+        )
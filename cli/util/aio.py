@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+#
+#    Authors:
+#        Pavel Březina <pbrezina@redhat.com>
+#
+#    Copyright (C) 2019 Red Hat
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Asyncio execution core.
+
+All coroutines run on one event loop in a background thread so that
+synchronous code (nutcli tasks and actors) can start them with run() or
+submit() and concurrent work (log streaming, artifacts transfer, telemetry,
+readiness polling) shares the same loop and resource limits.
+"""
+
+import asyncio
+import concurrent.futures
+import inspect
+import os
+import re
+import signal
+import threading
+
+import nutcli.decorators
+import nutcli.shell
+
+
+class BackgroundLoop(object):
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name='aio', daemon=True
+        )
+        self.thread.start()
+
+    def submit(self, coro):
+        """
+        Schedule coroutine on the loop, return concurrent.futures.Future.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call(self, function, *args):
+        """
+        Call function from the loop thread.
+        """
+        self.loop.call_soon_threadsafe(function, *args)
+
+
+_background = None
+_background_lock = threading.Lock()
+
+
+def background():
+    global _background
+
+    with _background_lock:
+        if _background is None:
+            _background = BackgroundLoop()
+
+        return _background
+
+
+def submit(coro):
+    return background().submit(coro)
+
+
+def run(coro, cancel_timeout=30):
+    """
+    Run coroutine on the background loop and wait for its result.
+
+    If the wait is interrupted (e.g. by KeyboardInterrupt or by timeout of
+    nutcli task list), the coroutine is cancelled so it can terminate its
+    subprocesses before the exception is propagated. It is given
+    cancel_timeout seconds to do so, None means to wait until it finishes.
+    """
+    future = submit(coro)
+    try:
+        return future.result()
+    except BaseException:
+        if not future.done():
+            future.cancel()
+            concurrent.futures.wait([future], timeout=cancel_timeout)
+        raise
+
+
+async def complete(coro):
+    """
+    Await coroutine until it finishes even if the caller is cancelled in the
+    meantime. The cancellation is propagated afterwards.
+    """
+    task = asyncio.ensure_future(coro)
+    cancelled = False
+    while not task.done():
+        try:
+            await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if task.cancelled():
+                raise
+
+            cancelled = True
+
+    result = task.result()
+    if cancelled:
+        raise asyncio.CancelledError()
+
+    return result
+
+
+def parse_timeout(timeout):
+    """
+    Convert timeout in the format accepted by test suite yaml (seconds or
+    string like "1 hour 30 minutes") to seconds. None means no timeout.
+    """
+    if timeout is None:
+        return None
+
+    if type(timeout) in (int, float):
+        return timeout
+
+    matches = re.findall(r'([\d.]+)\W*(hours?|minutes?|seconds?)?', str(timeout))
+    if not matches:
+        raise ValueError(f'Unknown timeout format: {timeout}')
+
+    units = {'h': 3600, 'm': 60, 's': 1, '': 1}
+    return sum([float(value) * units[unit[:1]] for value, unit in matches])
+
+
+class Limits(object):
+    """
+    Named semaphores bounding concurrent use of resources.
+    """
+
+    Defaults = {
+        'ssh': 8,
+        'virsh': 4,
+        'probe': 32,
+    }
+
+    def __init__(self, limits=None):
+        self.limits = {**self.Defaults, **(limits or {})}
+        self.semaphores = {}
+
+    def __call__(self, name):
+        if name not in self.semaphores:
+            self.semaphores[name] = asyncio.BoundedSemaphore(self.limits[name])
+
+        return self.semaphores[name]
+
+
+limits = Limits()
+
+
+class AsyncShell(object):
+    """
+    Asynchronous counterpart of nutcli shell.
+
+    It honors nutcli dry run and execution logging, raises the same
+    exceptions and kills the whole process group of the command when it
+    times out or when the coroutine is cancelled.
+    """
+
+    def __init__(self, logger, env=None):
+        self.logger = logger
+        self.env = env if env is not None else {}
+
+    async def __call__(
+        self, command, env=None, cwd=None, capture_output=False,
+        timeout=None, check=True, side_effect=True, stdin=None
+    ):
+        env = {**self.env, **(env or {})}
+        dry_run = nutcli.decorators.SideEffect.is_dry_run and side_effect
+
+        if dry_run or nutcli.decorators.LogExecution.should_log_execution:
+            self.logger.info(f'[shell] Working directory: {cwd or os.getcwd()}')
+            self.logger.info('[shell] Environment: ' + ' '.join(
+                [f'{k}={v!r}' for k, v in env.items()]
+            ))
+            self.logger.info(f'[shell] Command: {command}')
+
+        if dry_run:
+            return nutcli.shell.ShellResult(0)
+
+        pipe = asyncio.subprocess.PIPE if capture_output else None
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            env={**os.environ, **env},
+            cwd=cwd,
+            stdin=stdin,
+            stdout=pipe,
+            stderr=pipe,
+            start_new_session=True
+        )
+
+        try:
+            stdout, stderr = await asyncio.wait_for(
+                process.communicate(), timeout
+            )
+        except asyncio.TimeoutError:
+            await self.kill(process)
+            raise nutcli.shell.ShellTimeoutError(
+                timeout, command, cwd, self._env(env), None, None
+            ) from None
+        except asyncio.CancelledError:
+            await self.kill(process)
+            raise
+
+        stdout = stdout.decode('utf-8', 'replace') if stdout is not None else None
+        stderr = stderr.decode('utf-8', 'replace') if stderr is not None else None
+
+        if check and process.returncode != 0:
+            raise nutcli.shell.ShellCommandError(
+                process.returncode, command, cwd, self._env(env), stdout, stderr
+            )
+
+        return nutcli.shell.ShellResult(process.returncode, stdout, stderr)
+
+    async def spawn(self, command, env=None, **kwargs):
+        """
+        Start long running command (e.g. to stream its output) in its own
+        process group. Use kill() to terminate it.
+        """
+        return await asyncio.create_subprocess_exec(
+            *command,
+            env={**os.environ, **self.env, **(env or {})},
+            start_new_session=True,
+            **kwargs
+        )
+
+    @staticmethod
+    async def kill(process, grace=10):
+        if process.returncode is not None:
+            return
+
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+            await asyncio.wait_for(asyncio.shield(process.wait()), grace)
+        except asyncio.TimeoutError:
+            os.killpg(process.pid, signal.SIGKILL)
+            await process.wait()
+        except ProcessLookupError:
+            pass
+
+    @staticmethod
+    def _env(env):
+        return nutcli.shell.ShellEnvironment().set(env)
+
+
+class VagrantSSH(object):
+    """
+    Run commands on guests over 'vagrant ssh'.
+
+    :param vagrant: Vagrant command actor, used to build the command line
+        and its environment.
+    """
+
+    def __init__(self, vagrant, logger):
+        self.vagrant = vagrant
+        self.shell = AsyncShell(logger)
+
+    def get_command(self, guest, argv):
+        return self.vagrant.get_command([guest], argv)
+
+    async def run(self, guest, argv, **kwargs):
+        async with limits('ssh'):
+            return await self.shell(
+                self.get_command(guest, argv),
+                env=self.vagrant.get_env(),
+                **kwargs
+            )
+
+    async def spawn(self, guest, argv, **kwargs):
+        return await self.shell.spawn(
+            self.get_command(guest, argv),
+            env=self.vagrant.get_env(),
+            **kwargs
+        )
+
+
+class Virsh(object):
+    """
+    Read-only queries of libvirt domains.
+
+    Libvirt is accessed directly without sudo, prepare-host installs polkit
+    rule that allows it, so the queries never wait for a password.
+    """
+
+    URI = 'qemu:///system'
+
+    # Result of the connection check, shared by all instances
+    _error = None
+    _checked = False
+
+    def __init__(self, logger):
+        self.shell = AsyncShell(logger)
+
+    async def run(self, *args):
+        async with limits('virsh'):
+            try:
+                return await self.shell(
+                    ['virsh', '-c', self.URI, *args], capture_output=True,
+                    check=False, side_effect=False,
+                    stdin=asyncio.subprocess.DEVNULL
+                )
+            except OSError as e:
+                return nutcli.shell.ShellResult(127, '', str(e))
+
+    async def connect(self):
+        """
+        Check that libvirt is accessible. Return None on success or the
+        error message.
+        """
+        if not Virsh._checked:
+            result = await self.run('uri')
+            if result.rc != 0:
+                Virsh._error = (result.stderr or '').strip() \
+                    or f'virsh returned {result.rc}'
+
+            Virsh._checked = True
+
+        return Virsh._error
+
+    async def domstats(self, domain, *groups):
+        """
+        Return dictionary of domain statistics or None if the domain is not
+        running.
+        """
+        result = await self.run('domstats', *groups, domain)
+        if result.rc != 0:
+            return None
+
+        stats = {}
+        for line in result.stdout.splitlines():
+            if '=' in line:
+                key, value = line.strip().split('=', 1)
+                stats[key] = value
+
+        return stats
+
+    async def domstate(self, domain):
+        result = await self.run('domstate', domain)
+        if result.rc != 0:
+            return None
+
+        return result.stdout.strip()
+
+    async def domblklist(self, domain):
+        """
+        Return paths of file disks of the domain or None if the domain does
+        not exist.
+        """
+        result = await self.run('domblklist', '--details', domain)
+        if result.rc != 0:
+            return None
+
+        disks = []
+        for line in result.stdout.splitlines():
+            fields = line.split()
+            if len(fields) == 4 and fields[:2] == ['file', 'disk']:
+                disks.append(fields[3])
+
+        return disks
+
+    async def volinfo(self, volume):
+        """
+        Return dictionary of storage volume information or None if the
+        volume does not exist. Volume can be given by its path.
+        """
+        result = await self.run('vol-info', volume)
+        if result.rc != 0:
+            return None
+
+        info = {}
+        for line in result.stdout.splitlines():
+            if ':' in line:
+                key, value = line.split(':', 1)
+                info[key.strip()] = value.strip()
+
+        return info
+
+
+async def call(function, *args, **kwargs):
+    """
+    Await coroutine function or run blocking function in executor.
+    """
+    if inspect.iscoroutinefunction(function):
+        return await function(*args, **kwargs)
+
+    return await asyncio.to_thread(function, *args, **kwargs)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+#
+#    Authors:
+#        Pavel Březina <pbrezina@redhat.com>
+#
+#    Copyright (C) 2019 Red Hat
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import glob
+import hashlib
+import json
+import os
+
+import nutcli.decorators
+
+
+class BuildCache(object):
+    """
+    Host side cache of build directories produced by test tasks.
+
+    An entry is a tarball of the build directory identified by SSSD
+    revision, box the task runs on, the task command and the build
+    directory. The cache directory is shared with guests at GuestDir,
+    ccache directory at CcacheGuestDir.
+    """
+
+    GuestDir = '/shared/build-cache'
+    CcacheGuestDir = '/shared/ccache'
+
+    def __init__(self, cache_dir, revision, keep=10):
+        self.host_dir = f'{cache_dir}/build'
+        self.ccache_dir = f'{cache_dir}/ccache'
+        self.revision = revision
+        self.keep = keep
+
+    @property
+    def enabled(self):
+        # Without known revision it is not possible to tell if the build
+        # directory matches the sources.
+        return self.revision is not None
+
+    def get_key(self, box, command, directory):
+        data = json.dumps({
+            'revision': self.revision,
+            'box': box,
+            'command': command,
+            'directory': directory,
+        }, sort_keys=True)
+
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def get_host_path(self, key):
+        return f'{self.host_dir}/{key}.tar.gz'
+
+    def get_guest_path(self, key):
+        return f'{self.GuestDir}/{key}.tar.gz'
+
+    def exists(self, key):
+        return os.path.exists(self.get_host_path(key))
+
+    def get_restore_script(self, key, directory):
+        return (
+            f'mkdir -p {directory} && '
+            f'tar -xzf {self.get_guest_path(key)} -C {directory}'
+        )
+
+    def get_store_script(self, key, directory):
+        tmp = f'{self.get_guest_path(key)}.$$'
+        return (
+            f'tar -czf {tmp} -C {directory} . && '
+            f'mv -f {tmp} {self.get_guest_path(key)}'
+        )
+
+    def get_environment_script(self):
+        return '\n'.join([
+            f'export CCACHE_DIR={self.CcacheGuestDir}',
+            'for dir in /usr/lib64/ccache /usr/lib/ccache; do',
+            '    if [ -d $dir ]; then',
+            '        export PATH=$dir:$PATH',
+            '        break',
+            '    fi',
+            'done',
+            ''
+        ])
+
+    @nutcli.decorators.SideEffect()
+    def setup(self):
+        os.makedirs(self.host_dir, exist_ok=True)
+        os.makedirs(self.ccache_dir, exist_ok=True)
+
+    @nutcli.decorators.SideEffect()
+    def prune(self):
+        """
+        Keep only the most recently used entries.
+        """
+        entries = sorted(
+            glob.glob(f'{self.host_dir}/*.tar.gz'),
+            key=os.path.getmtime,
+            reverse=True
+        )
+
+        for path in entries[self.keep:]:
+            os.remove(path)
+
+    @nutcli.decorators.SideEffect()
+    def touch(self, key):
+        os.utime(self.get_host_path(key))
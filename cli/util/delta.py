@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+#
+#    Authors:
+#        Pavel Březina <pbrezina@redhat.com>
+#
+#    Copyright (C) 2019 Red Hat
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import glob
+import hashlib
+import json
+import os
+import re
+import tarfile
+
+import nutcli.decorators
+
+
+class DeltaError(Exception):
+    pass
+
+
+class BoxDelta(object):
+    """
+    Difference between two versions of a libvirt vagrant box.
+
+    Consecutive box versions differ only by a few updated packages. The
+    delta stores image of the new version as a compressed qcow2 overlay of
+    the previous version's image, so it contains only clusters that have
+    changed. The box can be rebuilt from the delta when the previous
+    version is installed.
+
+    The delta file is a tar archive with delta.json description, the
+    overlay and remaining box files (metadata.json, Vagrantfile). Commands
+    are executed through shell of the given actor so they honor dry run.
+    """
+
+    Version = 1
+
+    Description = 'delta.json'
+
+    Overlay = 'delta.qcow2'
+
+    Image = 'box.img'
+
+    Provider = 'libvirt'
+
+    def __init__(self, os_name, guest, base, version, base_checksum):
+        self.os = os_name
+        self.guest = guest
+        self.base = base
+        self.version = version
+        self.base_checksum = base_checksum
+
+    @staticmethod
+    def parse_name(path):
+        """
+        Return (os, guest, version) of box or delta file created by
+        'box create' or None if the name does not match.
+        """
+        match = re.match(
+            r'^sssd-(.+)-(ad-child|ad|ipa|ldap|client)-(\d+\.\d+)\.(?:box|delta)$',
+            os.path.basename(path)
+        )
+
+        return match.groups() if match else None
+
+    @staticmethod
+    def version_key(version):
+        return tuple(int(x) if x.isdigit() else 0 for x in version.split('.'))
+
+    @staticmethod
+    def checksum(path, block_size=65536):
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                sha256.update(block)
+
+        return sha256.hexdigest()
+
+    @staticmethod
+    def get_vagrant_home():
+        return os.environ.get(
+            'VAGRANT_HOME', os.path.expanduser('~/.vagrant.d')
+        )
+
+    @classmethod
+    def get_box_dir(cls, home, name):
+        return f'{home}/boxes/' + name.replace('/', '-VAGRANTSLASH-')
+
+    @classmethod
+    def get_installed(cls, home, name):
+        """
+        Return dictionary of version -> provider directory of installed
+        versions of box with given name.
+        """
+        box_dir = cls.get_box_dir(home, name)
+        installed = {}
+
+        # Newer vagrant puts the provider directory under architecture
+        pattern = f'{glob.escape(box_dir)}/*/**/{cls.Provider}/{cls.Image}'
+        for path in glob.glob(pattern, recursive=True):
+            version = os.path.relpath(path, box_dir).split('/')[0]
+            installed[version] = os.path.dirname(path)
+
+        return installed
+
+    @classmethod
+    def find_base(cls, directory, os_name, guest, version):
+        """
+        Find the newest box of the same guest and OS that is older than
+        given version.
+        """
+        boxes = {}
+        for path in glob.glob(f'{glob.escape(directory)}/sssd-*.box'):
+            name = cls.parse_name(path)
+            if name is None or name[:2] != (os_name, guest):
+                continue
+
+            if cls.version_key(name[2]) < cls.version_key(version):
+                boxes[name[2]] = path
+
+        if not boxes:
+            return None
+
+        return boxes[max(boxes, key=cls.version_key)]
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with tarfile.open(path) as tar:
+                data = json.load(tar.extractfile(cls.Description))
+        except (OSError, KeyError, tarfile.TarError, ValueError) as err:
+            raise DeltaError(f'{path} is not a valid box delta: {err}')
+
+        if data.get('version', None) != cls.Version:
+            raise DeltaError(f'{path}: unsupported delta version')
+
+        return cls(
+            data['os'], data['guest'], data['base'], data['box-version'],
+            data['base-checksum']
+        )
+
+    @classmethod
+    def create(cls, actor, base_box, box, output):
+        """
+        Create delta file between base box and a newer box.
+        """
+        (os_name, guest, base) = cls.parse_name(base_box)
+        (_, _, version) = cls.parse_name(box)
+
+        work = f'{output}.work'
+        actor.shell(['rm', '-fr', work])
+        actor.shell(['mkdir', '-p', f'{work}/base', f'{work}/box', f'{work}/files'])
+
+        try:
+            actor.shell(['tar', '-xf', base_box, '-C', f'{work}/base'])
+            actor.shell(['tar', '-xf', box, '-C', f'{work}/box'])
+
+            # Only clusters that differ from the backing file are written.
+            # When the delta is applied, the base image is linked as box.img
+            # next to the overlay.
+            actor.shell([
+                'qemu-img', 'convert', '-q', '-c', '-O', 'qcow2',
+                '-B', os.path.abspath(f'{work}/base/{cls.Image}'),
+                '-o', 'backing_fmt=qcow2',
+                f'{work}/box/{cls.Image}', f'{work}/{cls.Overlay}'
+            ])
+            actor.shell([
+                'qemu-img', 'rebase', '-u', '-F', 'qcow2', '-b', cls.Image,
+                f'{work}/{cls.Overlay}'
+            ])
+
+            actor.shell(f'''
+            find "{work}/box" -mindepth 1 -maxdepth 1 ! -name {cls.Image} \\
+                -exec mv -t "{work}/files" {{}} +
+            ''')
+
+            delta = cls(os_name, guest, base, version, None)
+            delta._describe(f'{work}/base/{cls.Image}', work)
+
+            actor.shell([
+                'tar', '-cf', output, '-C', work,
+                cls.Description, cls.Overlay, 'files'
+            ])
+        finally:
+            actor.shell(['rm', '-fr', work])
+
+        return delta
+
+    @nutcli.decorators.SideEffect()
+    def _describe(self, base_image, work):
+        self.base_checksum = self.checksum(base_image)
+        with open(f'{work}/{self.Description}', 'w') as f:
+            json.dump({
+                'version': self.Version,
+                'os': self.os,
+                'guest': self.guest,
+                'base': self.base,
+                'box-version': self.version,
+                'base-checksum': self.base_checksum,
+            }, f, indent=2)
+
+    def apply(self, actor, path, name, home=None):
+        """
+        Install new version of box with given name from the delta file.
+        The base version must be installed. Return False if the version is
+        already installed.
+        """
+        home = home if home is not None else self.get_vagrant_home()
+        box_dir = self.get_box_dir(home, name)
+        installed = self.get_installed(home, name)
+
+        if self.version in installed:
+            return False
+
+        if self.base not in installed:
+            raise DeltaError(
+                f'Box {name} version {self.base} is not installed'
+            )
+
+        base_image = f'{installed[self.base]}/{self.Image}'
+        if self.checksum(base_image) != self.base_checksum:
+            raise DeltaError(
+                f'Box {name} version {self.base} does not match the delta'
+            )
+
+        # Keep the same layout (e.g. architecture directory) as the base
+        relpath = os.path.relpath(installed[self.base], box_dir).split('/')
+        target = '/'.join([box_dir, self.version, *relpath[1:]])
+
+        # Vagrant temporary directory is on the same filesystem as boxes
+        work = f'{home}/tmp/sssd-delta-{os.path.basename(box_dir)}-{self.version}'
+        actor.shell(['rm', '-fr', work])
+        actor.shell(['mkdir', '-p', work])
+
+        try:
+            actor.shell(['tar', '-xf', path, '-C', work])
+            actor.shell(['ln', '-s', base_image, f'{work}/{self.Image}'])
+            actor.shell([
+                'qemu-img', 'convert', '-q', '-O', 'qcow2',
+                f'{work}/{self.Overlay}', f'{work}/files/{self.Image}'
+            ])
+            actor.shell(['mkdir', '-p', os.path.dirname(target)])
+            actor.shell(['mv', f'{work}/files', target])
+        finally:
+            actor.shell(['rm', '-fr', work])
+
+        return True
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+#
+#    Authors:
+#        Pavel Březina <pbrezina@redhat.com>
+#
+#    Copyright (C) 2019 Red Hat
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import hashlib
+import json
+import os
+
+import nutcli.decorators
+
+
+class Environment(object):
+    """
+    Model of the test environment: machines, their addresses, boxes, memory,
+    CPUs and shared folders.
+
+    The model is computed from config.json and SSSD_TEST_SUITE_* variables
+    and written to a JSON file that is the only source of machines and
+    folders for Vagrantfile. Files are named by hash of their content so
+    the same environment is written only once and existing files are never
+    modified.
+    """
+
+    Version = 1
+
+    MaxCachedFiles = 20
+
+    Machines = {
+        'ipa': {
+            'type': 'linux',
+            'hostname': 'master.ipa.vm',
+            'ip': '192.168.100.10',
+        },
+        'ldap': {
+            'type': 'linux',
+            'hostname': 'master.ldap.vm',
+            'ip': '192.168.100.20',
+        },
+        'client': {
+            'type': 'linux',
+            'hostname': 'master.client.vm',
+            'ip': '192.168.100.30',
+        },
+        'ad': {
+            'type': 'windows',
+            'hostname': 'root-dc',
+            'ip': '192.168.100.110',
+        },
+        'ad-child': {
+            'type': 'windows',
+            'hostname': 'child-dc',
+            'ip': '192.168.100.120',
+        },
+    }
+
+    # Folder type -> environment variable with additional folders
+    Folders = {
+        'sshfs': 'SSSD_TEST_SUITE_SSHFS',
+        'sshfs-cached': 'SSSD_TEST_SUITE_SSHFS_CACHED',
+        'virtiofs': 'SSSD_TEST_SUITE_VIRTIOFS',
+        'nfs': 'SSSD_TEST_SUITE_NFS',
+        'rsync': 'SSSD_TEST_SUITE_RSYNC',
+    }
+
+    def __init__(self, project_dir, config=None, env=None):
+        self.project_dir = project_dir
+        self.config = config if config is not None else {}
+        self.env = env if env is not None else dict(os.environ)
+
+    @classmethod
+    def from_file(cls, project_dir, path, env=None):
+        """
+        Load environment from configuration file. Return None if the file
+        does not exist.
+        """
+        try:
+            with open(path) as f:
+                return cls(project_dir, json.load(f), env)
+        except FileNotFoundError:
+            return None
+
+    @classmethod
+    def ip(cls, guest):
+        return cls.Machines[guest]['ip']
+
+    def _get_sizing(self, variable, guest):
+        for item in self.env.get(variable, '').split():
+            name, _, value = item.partition(':')
+            if name == guest:
+                return int(value)
+
+        return None
+
+    def get_box(self, guest):
+        return self.config.get('boxes', {}).get(guest, {})
+
+    def get_memory(self, guest):
+        value = self._get_sizing('SSSD_TEST_SUITE_MEMORY', guest)
+        if value is not None:
+            return value
+
+        return self.get_box(guest).get('memory', None) or 0
+
+    def get_cpus(self, guest):
+        return self._get_sizing('SSSD_TEST_SUITE_CPUS', guest) or 0
+
+    def get_folders(self, type):
+        """
+        Return list of [host, guest] folders of given type.
+        """
+        if self.env.get('SSSD_TEST_SUITE_BOX', None) == 'yes':
+            return []
+
+        # Host directory is used as a key, later definition wins.
+        folders = {}
+        if type == 'sshfs':
+            folders[f'{self.project_dir}/shared-enrollment'] = \
+                '/shared/enrollment'
+
+        for folder in self.config.get('folders', {}).get(type, None) or []:
+            if folder.get('host', None) and folder.get('guest', None):
+                folders[folder['host']] = folder['guest']
+
+        for mount in self.env.get(self.Folders[type], '').split():
+            host, _, guest = mount.partition(':')
+            folders[host] = guest
+
+        return [[host, guest] for host, guest in folders.items()]
+
+    def get_machine(self, guest):
+        box = self.get_box(guest)
+        return {
+            'name': guest,
+            **self.Machines[guest],
+            'box': box.get('name', None) or None,
+            'url': box.get('url', None) or None,
+            'memory': self.get_memory(guest),
+            'cpus': self.get_cpus(guest),
+        }
+
+    def to_dict(self):
+        return {
+            'version': self.Version,
+            'machines': [self.get_machine(x) for x in self.Machines],
+            'folders': {x: self.get_folders(x) for x in self.Folders},
+        }
+
+    def save(self, cache_dir):
+        """
+        Write the model to the cache directory and return path to the file.
+        """
+        content = json.dumps(self.to_dict(), indent=2, sort_keys=True)
+        digest = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        path = f'{cache_dir}/{digest}.json'
+
+        self._write(path, content)
+        return path
+
+    @nutcli.decorators.SideEffect()
+    def _write(self, path, content):
+        if os.path.exists(path):
+            return
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(content)
+        os.rename(tmp, path)
+
+        # Keep only recently created files. A pruned environment that is
+        # still in use is simply written again by its next save.
+        cache_dir = os.path.dirname(path)
+        files = sorted(
+            [
+                os.path.join(cache_dir, x) for x in os.listdir(cache_dir)
+                if x.endswith('.json')
+            ],
+            key=os.path.getmtime
+        )
+
+        for name in files[:-self.MaxCachedFiles]:
+            os.remove(name)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+#
+#    Authors:
+#        Pavel Březina <pbrezina@redhat.com>
+#
+#    Copyright (C) 2019 Red Hat
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import hashlib
+import json
+import os
+import threading
+
+import nutcli.decorators
+import yaml
+
+from util.machine import VagrantMachine
+
+
+class RoleFingerprints(object):
+    """
+    Fingerprints of roles that were successfully applied to guests.
+
+    A fingerprint is computed from the role files, role parameters,
+    variables.yml and from the machine and box that the guest is created
+    from. If the fingerprint did not change since the last successful run,
+    the role is considered converged and it does not have to be run again.
+    """
+
+    def __init__(self, project_dir, playbook, cache_file):
+        self.project_dir = project_dir
+        self.ansible_dir = f'{project_dir}/provision'
+        self.playbook = playbook
+        self.cache_file = cache_file
+        self.roles = self._load_roles()
+        self.lock = threading.Lock()
+
+    def _load_yaml(self, path):
+        with open(path) as f:
+            return yaml.safe_load(f)
+
+    def _load_groups(self):
+        inventory = self._load_yaml(f'{self.ansible_dir}/inventory.yml')
+        groups = {}
+        for name, group in inventory['all']['children'].items():
+            groups[name] = list((group.get('hosts') or {}).keys())
+
+        groups['all'] = [y for x in groups.values() for y in x]
+        return groups
+
+    def _load_roles(self):
+        groups = self._load_groups()
+        roles = {}
+        for play in self._load_yaml(self.playbook):
+            # These plays are run every time.
+            if 'always' in play.get('tags', []):
+                continue
+
+            hosts = []
+            for pattern in play.get('hosts', '').split(':'):
+                hosts += groups.get(pattern, [pattern])
+
+            for role in play.get('roles', []):
+                entry = role if type(role) == dict else {'role': role}
+                for host in hosts:
+                    roles.setdefault(host, []).append(entry)
+
+        return roles
+
+    def _hash_file(self, sha256, path):
+        sha256.update(os.path.relpath(path, self.ansible_dir).encode('utf-8'))
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(65536), b''):
+                sha256.update(block)
+
+    def compute(self, guest, entry):
+        machine = VagrantMachine(self.project_dir, guest)
+        if machine.id is None:
+            return None
+
+        sha256 = hashlib.sha256()
+        sha256.update(json.dumps({
+            'role': entry,
+            'machine': machine.id,
+            'box': machine.box
+        }, sort_keys=True).encode('utf-8'))
+
+        self._hash_file(sha256, f'{self.ansible_dir}/variables.yml')
+
+        role_dir = f'{self.ansible_dir}/roles/{entry["role"]}'
+        for root, dirs, files in os.walk(role_dir):
+            dirs.sort()
+            for name in sorted(files):
+                self._hash_file(sha256, os.path.join(root, name))
+
+        return sha256.hexdigest()
+
+    def compute_all(self, guest):
+        return {
+            entry['role']: self.compute(guest, entry)
+            for entry in self.roles.get(guest, [])
+        }
+
+    def load(self):
+        try:
+            with open(self.cache_file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def converged(self, guests):
+        """
+        Return dictionary of guest -> list of roles that are converged.
+        """
+        stored = self.load()
+        converged = {}
+        for guest in guests:
+            recorded = stored.get(guest, {})
+            converged[guest] = [
+                role for role, fingerprint in self.compute_all(guest).items()
+                if fingerprint is not None
+                and recorded.get(role, None) == fingerprint
+            ]
+
+        return converged
+
+    @nutcli.decorators.SideEffect()
+    def record(self, guests):
+        """
+        Store fingerprints of all roles of selected guests.
+        """
+        with self.lock:
+            stored = self.load()
+            for guest in guests:
+                stored[guest] = self.compute_all(guest)
+
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            with open(self.cache_file, 'w') as f:
+                json.dump(stored, f, indent=2, sort_keys=True)
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+#
+#    Authors:
+#        Pavel Březina <pbrezina@redhat.com>
+#
+#    Copyright (C) 2019 Red Hat
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import shutil
+import subprocess
+
+
+class SharedFolders(object):
+    """
+    Transports that can be used to share host folders with Linux guests.
+
+    Each transport is passed to the Vagrantfile in its own environment
+    variable as a list of "host_path:guest_path".
+
+    - sshfs: no caching, safe for folders modified from both sides
+    - sshfs-cached: attribute and data caching, only safe for folders that
+      are written from one side or with write-once files
+    - nfs: requires nfs server on the host
+    - virtiofs: libvirt native, requires virtiofsd on the host
+    - rsync: one way copy to the guest at start up
+    """
+
+    Transports = {
+        'sshfs': 'SSSD_TEST_SUITE_SSHFS',
+        'sshfs-cached': 'SSSD_TEST_SUITE_SSHFS_CACHED',
+        'nfs': 'SSSD_TEST_SUITE_NFS',
+        'virtiofs': 'SSSD_TEST_SUITE_VIRTIOFS',
+        'rsync': 'SSSD_TEST_SUITE_RSYNC',
+    }
+
+    VirtiofsDaemons = [
+        '/usr/libexec/virtiofsd',
+        '/usr/lib/qemu/virtiofsd',
+    ]
+
+    def __init__(self):
+        self.folders = {}
+
+    @classmethod
+    def virtiofs_supported(cls):
+        return any([os.path.exists(x) for x in cls.VirtiofsDaemons])
+
+    @classmethod
+    def nfs_supported(cls):
+        if shutil.which('systemctl') is None:
+            return False
+
+        result = subprocess.run(
+            ['systemctl', 'is-active', '--quiet', 'nfs-server.service'],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+
+        return result.returncode == 0
+
+    @classmethod
+    def select(cls, transport):
+        """
+        Resolve "auto" transport to the fastest transport that is available
+        on this host.
+        """
+        if transport != 'auto':
+            if transport not in cls.Transports:
+                raise ValueError(f'Unknown shared folder transport: {transport}')
+
+            return transport
+
+        if cls.virtiofs_supported():
+            return 'virtiofs'
+
+        if cls.nfs_supported():
+            return 'nfs'
+
+        return 'sshfs-cached'
+
+    @classmethod
+    def coherent(cls, transport):
+        """
+        Return transport that is safe for folders that are modified from
+        both sides at the same time.
+        """
+        if transport == 'sshfs-cached':
+            return 'sshfs'
+
+        return transport
+
+    def add(self, transport, host, guest):
+        self.folders.setdefault(transport, []).append((host, guest))
+        return self
+
+    def get_env(self):
+        return {
+            self.Transports[transport]: ' '.join(
+                [f'{host}:{guest}' for host, guest in folders]
+            )
+            for transport, folders in self.folders.items()
+        }
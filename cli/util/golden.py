@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+#
+#    Authors:
+#        Pavel Březina <pbrezina@redhat.com>
+#
+#    Copyright (C) 2019 Red Hat
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import base64
+import datetime
+import json
+import os
+import uuid
+
+
+class GoldenManifest(object):
+    """
+    Description of a set of boxes that were enrolled together.
+
+    The manifest contains content of the shared enrollment directory
+    (certificates and keytabs) at the time when the boxes were created so
+    it can be restored on the host before the boxes are used. Linux guests
+    are stamped with the manifest id so it is possible to check that the
+    running guests belong to the same set.
+    """
+
+    StampPath = '/etc/sssd-test-suite/golden.json'
+
+    def __init__(self, id, version, guests, boxes, enrollment, created=None):
+        self.id = id
+        self.version = version
+        self.guests = guests
+        self.boxes = boxes
+        self.enrollment = enrollment
+        self.created = created
+
+    @classmethod
+    def create(cls, version, guests, boxes, enrollment_dir):
+        enrollment = {}
+        for root, dirs, files in os.walk(enrollment_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                relpath = os.path.relpath(path, enrollment_dir)
+                if relpath == 'README':
+                    continue
+
+                with open(path, 'rb') as f:
+                    enrollment[relpath] = base64.b64encode(f.read()).decode()
+
+        return cls(
+            str(uuid.uuid4()), version, sorted(guests), boxes, enrollment,
+            datetime.datetime.now().isoformat(timespec='seconds')
+        )
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+
+        return cls(
+            data['id'], data['version'], data['guests'], data['boxes'],
+            data['enrollment'], data.get('created', None)
+        )
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({
+                'id': self.id,
+                'version': self.version,
+                'created': self.created,
+                'guests': self.guests,
+                'boxes': self.boxes,
+                'enrollment': self.enrollment,
+            }, f, indent=2)
+
+    def restore(self, enrollment_dir):
+        for relpath, content in self.enrollment.items():
+            path = os.path.join(enrollment_dir, relpath)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(base64.b64decode(content))
+
+    @property
+    def stamp(self):
+        return {
+            'id': self.id,
+            'version': self.version,
+            'guests': self.guests
+        }
+
+    def matches(self, guests, stamps):
+        """
+        Check that selected guests are part of this set. Stamps is a
+        dictionary of guest -> stamp read from Linux guests.
+        """
+        if not set(guests).issubset(self.guests):
+            return False
+
+        for stamp in stamps.values():
+            if stamp is None or stamp.get('id', None) != self.id:
+                return False
+
+        return True
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+#
+#    Authors:
+#        Pavel Březina <pbrezina@redhat.com>
+#
+#    Copyright (C) 2019 Red Hat
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import asyncio
+import datetime
+
+from util import aio
+
+
+def format_duration(seconds):
+    hours, remainder = divmod(seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return '{:02}:{:02}:{:02}'.format(int(hours), int(minutes), int(seconds))
+
+
+class TaskGraph(object):
+    """
+    Execute functions that depend on each other.
+
+    Each node is started as soon as all nodes that it requires are finished,
+    therefore independent nodes run in parallel. If a node fails, all nodes
+    that require it are skipped and the first error is raised when all
+    running nodes are finished.
+
+    Nodes may be coroutine functions, blocking functions are run in a
+    thread so they do not block the event loop.
+    """
+
+    class Node(object):
+        def __init__(self, name, function, args, kwargs, requires):
+            self.name = name
+            self.function = function
+            self.args = args
+            self.kwargs = kwargs
+            self.requires = requires
+            self.start = None
+            self.end = None
+            self.state = 'pending'
+
+        @property
+        def duration(self):
+            if self.start is None or self.end is None:
+                return None
+
+            return (self.end - self.start).total_seconds()
+
+        async def __call__(self):
+            self.start = datetime.datetime.now()
+            try:
+                return await aio.call(self.function, *self.args, **self.kwargs)
+            finally:
+                self.end = datetime.datetime.now()
+
+    def __init__(self, name, logger):
+        self.name = name
+        self.logger = logger
+        self.nodes = {}
+        self.duration = None
+
+    def add(self, name, function, *args, requires=None, **kwargs):
+        self.nodes[name] = self.Node(
+            name, function, args, kwargs, list(requires or [])
+        )
+
+        return self
+
+    def execute(self):
+        for node in self.nodes.values():
+            for required in node.requires:
+                if required not in self.nodes:
+                    raise ValueError(
+                        f'Node {node.name} requires unknown node {required}'
+                    )
+
+        start = datetime.datetime.now()
+        errors = aio.run(self._execute())
+        self.duration = (datetime.datetime.now() - start).total_seconds()
+
+        self._summary()
+
+        pending = [x.name for x in self.nodes.values() if x.state == 'pending']
+        if pending:
+            raise ValueError(f'Circular dependency between nodes: {pending}')
+
+        if errors:
+            raise errors[0]
+
+    async def _execute(self):
+        errors = []
+        running = {}
+        while True:
+            self._schedule(running)
+            if not running:
+                break
+
+            finished, _ = await asyncio.wait(
+                running, return_when=asyncio.FIRST_COMPLETED
+            )
+
+            for future in finished:
+                node = running.pop(future)
+                try:
+                    future.result()
+                    node.state = 'done'
+                    self.logger.info(
+                        f'[{self.name}] {node.name} finished in '
+                        f'{format_duration(node.duration)}'
+                    )
+                except BaseException as e:
+                    node.state = 'failed'
+                    errors.append(e)
+                    self.logger.error(
+                        f'[{self.name}] {node.name} failed with '
+                        f'{e.__class__.__name__}: {str(e)}'
+                    )
+
+        return errors
+
+    def _schedule(self, running):
+        # Skipping a node may cause other nodes to be skipped as well.
+        changed = True
+        while changed:
+            changed = False
+            for node in self.nodes.values():
+                if node.state != 'pending':
+                    continue
+
+                states = [self.nodes[x].state for x in node.requires]
+                if any([x in ('failed', 'skipped') for x in states]):
+                    node.state = 'skipped'
+                    changed = True
+                    self.logger.info(
+                        f'[{self.name}] {node.name} (skipped on error)'
+                    )
+
+        for node in self.nodes.values():
+            if node.state != 'pending':
+                continue
+
+            states = [self.nodes[x].state for x in node.requires]
+            if all([x == 'done' for x in states]):
+                node.state = 'running'
+                self.logger.info(f'[{self.name}] {node.name} started')
+                running[asyncio.ensure_future(node())] = node
+
+    def _summary(self):
+        self.logger.info(f'[{self.name}] Summary:')
+        for node in self.nodes.values():
+            duration = node.duration
+            if duration is None:
+                self.logger.info(f'[{self.name}]   {node.name:20s} {node.state}')
+                continue
+
+            self.logger.info(
+                f'[{self.name}]   {node.name:20s} {node.state:8s} '
+                f'{format_duration(duration)}'
+            )
+
+        # Difference between these two is the time saved by running nodes
+        # in parallel.
+        total = sum([x.duration or 0 for x in self.nodes.values()])
+        self.logger.info(
+            f'[{self.name}]   {"Total":20s} {"":8s} '
+            f'{format_duration(self.duration)} '
+            f'(sequential {format_duration(total)})'
+        )
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+#
+#    Authors:
+#        Pavel Březina <pbrezina@redhat.com>
+#
+#    Copyright (C) 2019 Red Hat
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import datetime
+import fcntl
+import json
+import os
+import re
+
+import nutcli.decorators
+
+from util.machine import VagrantMachine
+
+
+class WindowsLicenses(object):
+    """
+    Last known state of Windows evaluation licenses of guests.
+
+    The state is obtained from 'slmgr.vbs -dlv' output and stored together
+    with the time of the query and machine id, so it is possible to compute
+    when the license expires without connecting to the guest. Information
+    about a guest is discarded when the guest is recreated.
+    """
+
+    def __init__(self, project_dir, path, guests=None):
+        self.project_dir = project_dir
+        self.path = path
+        self.guests = guests if guests is not None else {}
+
+    @staticmethod
+    def parse(output):
+        """
+        Parse output of 'slmgr.vbs -dlv' into dictionary with license status,
+        remaining minutes and remaining rearm count.
+        """
+        status = re.search(r'License Status:\s*(\w+)', output)
+        minutes = re.search(r'expiration:\s*(\d+) minute', output)
+        rearms = re.search(r'rearm count:\s*(\d+)', output)
+
+        status = status.group(1) if status else 'Unknown'
+        return {
+            'status': status,
+            'minutes': int(minutes.group(1)) if minutes else 0,
+            'rearms': int(rearms.group(1)) if rearms else None,
+        }
+
+    def update(self, guest, output, checked=None):
+        checked = checked if checked is not None else datetime.datetime.now()
+        info = self.parse(output)
+
+        # Notification status means the license has already expired.
+        minutes = info['minutes'] if info['status'] == 'Licensed' else 0
+        info['checked'] = checked.isoformat(timespec='seconds')
+        info['expires'] = (
+            checked + datetime.timedelta(minutes=minutes)
+        ).isoformat(timespec='seconds')
+        info['machine'] = VagrantMachine(self.project_dir, guest).id
+
+        self.guests[guest] = info
+
+    def get(self, guest):
+        """
+        Return license information of the guest or None if it is not known
+        or the guest was recreated since it was obtained.
+        """
+        info = self.guests.get(guest, None)
+        if info is None:
+            return None
+
+        if info['machine'] != VagrantMachine(self.project_dir, guest).id:
+            return None
+
+        return info
+
+    def expires(self, guest):
+        info = self.get(guest)
+        if info is None:
+            return None
+
+        return datetime.datetime.fromisoformat(info['expires'])
+
+    def remaining(self, guest, now=None):
+        """
+        Return remaining license time of the guest as timedelta or None if
+        it is not known.
+        """
+        expires = self.expires(guest)
+        if expires is None:
+            return None
+
+        now = now if now is not None else datetime.datetime.now()
+        return max(expires - now, datetime.timedelta(0))
+
+    def expiring(self, guests, within):
+        """
+        Return guests whose license expires within given timedelta.
+        """
+        expiring = []
+        for guest in guests:
+            remaining = self.remaining(guest)
+            if remaining is not None and remaining <= within:
+                expiring.append(guest)
+
+        return expiring
+
+    def action(self, guest):
+        """
+        What has to be done when the license of the guest is about to
+        expire, 'rearm' or 'rebuild' if there are no rearms left.
+        """
+        info = self.get(guest)
+        if info is None:
+            return None
+
+        return 'rearm' if info['rearms'] else 'rebuild'
+
+    @nutcli.decorators.SideEffect()
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump(self.guests, f, indent=2)
+
+    @classmethod
+    def load(cls, project_dir, path):
+        if not os.path.exists(path):
+            return cls(project_dir, path)
+
+        with open(path) as f:
+            return cls(project_dir, path, json.load(f))
+
+
+class RunLock(object):
+    """
+    Lock held while tests are running.
+
+    Test runs hold a shared lock so they do not block each other. Maintenance
+    that disrupts guests (e.g. license rearm which reboots them) takes an
+    exclusive lock and it is skipped if any test run is in progress.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def acquire(self, exclusive=False, wait=False):
+        """
+        Acquire the lock. Return False if it is held by someone else and
+        wait is not set.
+        """
+        self.release()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+
+        operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        try:
+            fcntl.flock(self.fd, operation | (0 if wait else fcntl.LOCK_NB))
+        except BlockingIOError:
+            self.release()
+            return False
+
+        return True
+
+    def release(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+#
+#    Authors:
+#        Pavel Březina <pbrezina@redhat.com>
+#
+#    Copyright (C) 2019 Red Hat
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import asyncio
+import os
+import re
+import shlex
+
+import nutcli.decorators
+
+from util import aio
+
+
+class LogStreamer(object):
+    """
+    Follow log files on a guest and write them incrementally to the host.
+
+    All paths are followed by single ``tail -F`` running over one SSH
+    connection. Lines are handed over from the reader to the writer through
+    a bounded queue so slow disk can not make the memory grow; the reader
+    simply stops reading from SSH until the writer catches up.
+
+    Shell globs in paths are expanded on the guest when the streamer is
+    started, files that are created later must be listed explicitly.
+
+    Logs of each test case are written to their own directory. If the
+    guest was not started from a clean disk (e.g. it is reused from the
+    previous test case), only lines written after the streamer was started
+    are followed so the history is not copied again.
+    """
+
+    Header = re.compile(rb'^==> (.+) <==$')
+
+    def __init__(
+        self, logger, name, guest, paths, output_dir, from_start=True,
+        buffer_size=10000
+    ):
+        self.logger = logger
+        self.name = re.sub(r'[^\w.-]+', '-', name).strip('-')
+        self.guest = guest
+        self.paths = paths
+        self.output_dir = f'{output_dir}/{self.name}/{guest}'
+        self.from_start = from_start
+        self.buffer_size = buffer_size
+        self.process = None
+        self.future = None
+        self.stopping = False
+
+    def get_remote_command(self):
+        lines = '+1' if self.from_start else '0'
+        tail = f'exec tail -v -F -n {lines} -- ' + ' '.join(self.paths)
+        return ['sudo', 'sh', '-c', shlex.quote(tail)]
+
+    @nutcli.decorators.SideEffect()
+    def start(self, ssh):
+        """
+        Start streaming.
+
+        :param ssh: aio.VagrantSSH adapter used to connect to the guest.
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.stopping = False
+        self.future = aio.submit(self._stream(ssh))
+
+        self.logger.info(
+            f'Streaming {" ".join(self.paths)} from {self.guest} '
+            f'to {self.output_dir}'
+        )
+
+    @nutcli.decorators.SideEffect()
+    def stop(self):
+        if self.future is None:
+            return
+
+        aio.run(self._stop())
+        self.future = None
+
+    async def _stop(self):
+        self.stopping = True
+        if self.process is not None:
+            await aio.AsyncShell.kill(self.process)
+
+        await asyncio.wrap_future(self.future)
+
+    async def _stream(self, ssh):
+        self.process = await ssh.spawn(
+            self.guest,
+            self.get_remote_command(),
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+
+        if self.stopping:
+            await aio.AsyncShell.kill(self.process)
+
+        queue = asyncio.Queue(maxsize=self.buffer_size)
+        writer = asyncio.create_task(self._write(queue))
+        try:
+            await self._read(queue)
+        finally:
+            await queue.put(None)
+            await writer
+            self.process = None
+
+    async def _read(self, queue):
+        current = None
+        pending = False
+
+        # tail prints the first header right away and separates the
+        # following ones with an empty line, log lines that only look like
+        # a header are written as they are.
+        header = True
+
+        while True:
+            line = await self.process.stdout.readline()
+            if not line:
+                break
+
+            match = self.Header.match(line.rstrip(b'\n')) if header else None
+            header = False
+            if match:
+                current = match.group(1).decode('utf-8', 'replace')
+                pending = False
+                continue
+
+            if pending:
+                await queue.put((current, b'\n'))
+                pending = False
+
+            if line == b'\n':
+                pending = True
+                header = True
+                continue
+
+            if current is not None:
+                await queue.put((current, line))
+
+    async def _write(self, queue):
+        files = {}
+
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+
+                path, line = item
+                if path not in files:
+                    files[path] = self._open(path)
+
+                files[path].write(line)
+
+                # Flush only when there is nothing else to write so live
+                # readers see complete bursts without syncing every line.
+                if queue.empty():
+                    for f in files.values():
+                        f.flush()
+        finally:
+            for f in files.values():
+                f.close()
+
+    def _open(self, path):
+        dest = os.path.join(self.output_dir, path.lstrip('/'))
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        return open(dest, 'wb')
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+#
+#    Authors:
+#        Pavel Březina <pbrezina@redhat.com>
+#
+#    Copyright (C) 2019 Red Hat
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import os
+
+
+class VagrantMachine(object):
+    """
+    Information about guest machine that vagrant stores in .vagrant directory.
+    """
+
+    def __init__(self, project_dir, name, provider='libvirt'):
+        self.name = name
+        self.data_dir = f'{project_dir}/.vagrant/machines/{name}/{provider}'
+
+    def _read(self, name):
+        try:
+            with open(f'{self.data_dir}/{name}') as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    @property
+    def id(self):
+        """
+        Machine id (libvirt domain UUID) or None if the machine was not
+        created yet.
+        """
+        return self._read('id')
+
+    @property
+    def box(self):
+        """
+        Dictionary with name, version and provider of the box that was used
+        to create the machine. Empty if it is not known.
+        """
+        content = self._read('box_meta')
+        if not content:
+            return {}
+
+        return json.loads(content)
+
+    @property
+    def box_name(self):
+        return self.box.get('name', None)
+
+    @property
+    def box_version(self):
+        return self.box.get('version', None)
+
+    @property
+    def private_key(self):
+        path = f'{self.data_dir}/private_key'
+        return path if os.path.exists(path) else None
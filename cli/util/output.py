@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+#
+#    Authors:
+#        Pavel Březina <pbrezina@redhat.com>
+#
+#    Copyright (C) 2019 Red Hat
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import os
+import sys
+import time
+
+
+class CommandOutput(object):
+    """
+    Machine readable output of a command.
+
+    If JSON output is selected, everything that would be written to
+    standard output while the command runs (log messages and output of
+    executed programs) is redirected to standard error, so standard output
+    contains only one JSON document with the command result, its duration
+    and data set by the command.
+    """
+
+    Formats = ['text', 'json']
+
+    def __init__(self, command, format='text'):
+        self.command = command
+        self.format = format
+        self.data = {}
+        self.start = None
+        self.stdout = None
+
+    @staticmethod
+    def add_argument(parser, option='--output', dest='output'):
+        parser.add_argument(
+            option, action='store', type=str, dest=dest,
+            choices=CommandOutput.Formats, default='text',
+            help='Output format (Default "text")'
+        )
+
+    @property
+    def json(self):
+        return self.format == 'json'
+
+    def set(self, **kwargs):
+        self.data.update(kwargs)
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        if self.json:
+            sys.stdout.flush()
+            self.stdout = os.dup(1)
+            os.dup2(2, 1)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.json:
+            return False
+
+        sys.stdout.flush()
+        os.dup2(self.stdout, 1)
+        os.close(self.stdout)
+
+        result = {
+            'command': self.command,
+            'result': 'ok' if exc_type is None else 'failed',
+            'duration': round(time.monotonic() - self.start, 3),
+            **self.data,
+        }
+
+        if exc_value is not None:
+            result['error'] = str(exc_value)
+
+        print(json.dumps(result, indent=2))
+        return False
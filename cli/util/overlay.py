@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+#
+#    Authors:
+#        Pavel Březina <pbrezina@redhat.com>
+#
+#    Copyright (C) 2019 Red Hat
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+
+import nutcli.shell
+
+from util import aio
+from util.machine import VagrantMachine
+
+
+class DiskOverlay(object):
+    """
+    Copy-on-write overlay over the guest disk.
+
+    The current guest disk is turned into a base image and the guest gets
+    a thin qcow2 overlay backed by it. Resetting the guest back to the base
+    state only replaces the overlay with an empty one, which is much faster
+    than destroying and creating the guest again. The guest must be halted
+    when the overlay is created, reset or removed.
+
+    Commands are executed through shell of the given actor so they honor
+    dry run. Disk and base image are looked up with read-only libvirt
+    queries that do not need sudo.
+    """
+
+    Pool = 'sssd-test-suite'
+
+    def __init__(self, actor, guest):
+        self.actor = actor
+        self.guest = guest
+        self.machine = VagrantMachine(actor.project_dir, guest)
+        self.virsh = aio.Virsh(actor.logger)
+        self._disk = None
+
+    @property
+    def disk(self):
+        """
+        Path to the guest disk. It is read from libvirt domain, if the guest
+        does not exist yet the default location in the pool is used.
+        """
+        if self._disk is not None:
+            return self._disk
+
+        if self.machine.id is None:
+            return self.default_disk
+
+        disks = aio.run(self.virsh.domblklist(self.machine.id))
+        if disks:
+            self._disk = disks[0]
+
+        return self._disk if self._disk is not None else self.default_disk
+
+    @property
+    def default_disk(self):
+        return f'{self.actor.project_dir}/pool/{self.Pool}_{self.guest}.img'
+
+    @property
+    def base(self):
+        (path, ext) = os.path.splitext(self.disk)
+        return f'{path}.base{ext}'
+
+    @property
+    def exists(self):
+        # The pool is refreshed whenever the base image is created or
+        # removed so it is known to libvirt.
+        return aio.run(self.virsh.volinfo(self.base)) is not None
+
+    def create(self):
+        """
+        Turn current guest disk into base image and put overlay over it.
+        """
+        if self.exists:
+            raise RuntimeError(f'Overlay of {self.guest} already exists')
+
+        self.actor.shell(['sudo', 'mv', self.disk, self.base])
+        self._create_overlay()
+
+    def reset(self):
+        """
+        Discard all changes made since the overlay was created.
+        """
+        # Checked through shell so it passes in dry run, where the overlay
+        # was not really created.
+        try:
+            self.actor.shell(['sudo', 'test', '-f', self.base])
+        except nutcli.shell.ShellCommandError:
+            raise RuntimeError(f'Overlay of {self.guest} does not exist')
+
+        self._create_overlay()
+
+    def remove(self):
+        """
+        Discard the overlay and use base image as guest disk again.
+        """
+        if not self.exists:
+            return
+
+        self.actor.shell(['sudo', 'mv', '-f', self.base, self.disk])
+        self._refresh_pool()
+
+    def _create_overlay(self):
+        self.actor.shell(['sudo', 'rm', '-f', self.disk])
+        self.actor.shell([
+            'sudo', 'qemu-img', 'create', '-q', '-f', 'qcow2',
+            '-F', 'qcow2', '-b', self.base, self.disk
+        ])
+        self.actor.shell(['sudo', 'chown', f'--reference={self.base}', self.disk])
+        self.actor.shell(['sudo', 'chmod', f'--reference={self.base}', self.disk])
+        self._refresh_pool()
+
+    def _refresh_pool(self):
+        self.actor.shell(['sudo', 'virsh', 'pool-refresh', self.Pool])
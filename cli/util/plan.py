@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+#
+#    Authors:
+#        Pavel Březina <pbrezina@redhat.com>
+#
+#    Copyright (C) 2019 Red Hat
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import hashlib
+import json
+import math
+import os
+
+import nutcli.decorators
+import yaml
+
+from util import aio
+from util.actor import TestSuiteActor
+
+
+class PlanError(ValueError):
+    """
+    Test suite configuration does not match the schema. All errors found
+    in the file are reported at once.
+    """
+
+    def __init__(self, path, errors):
+        self.path = path
+        self.errors = errors
+
+        super().__init__(
+            f'Invalid test suite {path}:\n'
+            + '\n'.join([f'  {x}' for x in errors])
+        )
+
+
+class TestPlan(object):
+    """
+    Test suite compiled from yaml configuration.
+
+    The configuration is validated against the schema, all optional values
+    are resolved to their defaults and timeouts are converted to whole
+    seconds so errors are found before any guest is started. Compiled plans
+    are cached by hash of the configuration file.
+
+    Each test case has following keys: name, machines, tags, timeout,
+    tasks, cleanup, artifacts and logs. Tasks and cleanup commands have
+    run-on, directory, shell (and name, timeout, build-cache, artifacts for
+    tasks). Artifacts and logs are lists of {from: guest, files: [paths]}.
+    """
+
+    # Increase when the compiled format changes to invalidate cached plans
+    Version = 2
+
+    MaxCachedPlans = 20
+
+    DefaultDirectory = '/shared/sssd'
+
+    Timeout = (int, float, str)
+
+    Schema = {
+        'case': {
+            'name': str,
+            'machines': list,
+            'tasks': list,
+            'timeout': Timeout,
+            'tags': list,
+            'cleanup': (str, list),
+            'artifacts': list,
+            'logs': list,
+        },
+        'task': {
+            'name': str,
+            'run-on': str,
+            'directory': str,
+            'shell': str,
+            'build-cache': str,
+            'timeout': Timeout,
+            'artifacts': list,
+        },
+        'cleanup': {
+            'run-on': str,
+            'directory': str,
+            'shell': str,
+        },
+        'files': {
+            'from': str,
+            'files': list,
+        },
+    }
+
+    def __init__(self, cases, digest=None):
+        self.cases = cases
+        self.digest = digest
+
+    @property
+    def guests(self):
+        """
+        All guests required by the plan.
+        """
+        return sorted(self.graph.keys())
+
+    @property
+    def graph(self):
+        """
+        Dictionary of guest -> names of test cases that use the guest.
+        """
+        graph = {}
+        for case in self.cases:
+            for guest in case['machines']:
+                graph.setdefault(guest, []).append(case['name'])
+
+        return graph
+
+    def to_dict(self):
+        return {
+            'version': self.Version,
+            'digest': self.digest,
+            'cases': self.cases,
+        }
+
+    @classmethod
+    def compile(cls, path, cache_dir=None):
+        """
+        Compile test suite configuration. If cache_dir is set, compiled plan
+        is loaded from the cache if the file did not change.
+        """
+        with open(path, 'rb') as f:
+            content = f.read()
+
+        sha256 = hashlib.sha256(f'{cls.Version}:'.encode('utf-8'))
+        sha256.update(content)
+        digest = sha256.hexdigest()
+
+        cached = None
+        if cache_dir is not None:
+            cached = f'{cache_dir}/plans/{digest}.json'
+            try:
+                with open(cached) as f:
+                    return cls(json.load(f)['cases'], digest)
+            except (OSError, ValueError, KeyError):
+                pass
+
+        compiler = PlanCompiler(path)
+        plan = cls(compiler.compile(yaml.safe_load(content)), digest)
+
+        if cached is not None:
+            plan.save(cached)
+
+        return plan
+
+    @nutcli.decorators.SideEffect()
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+        # Keep only recently used plans
+        plans_dir = os.path.dirname(path)
+        plans = sorted(
+            [os.path.join(plans_dir, x) for x in os.listdir(plans_dir)],
+            key=os.path.getmtime
+        )
+
+        for plan in plans[:-self.MaxCachedPlans]:
+            os.remove(plan)
+
+    def estimate(self, history):
+        """
+        Return list of estimated durations of test cases in seconds from
+        history. Cases without history are estimated with average of known
+        durations, None is returned for them if there is no history at all.
+        """
+        estimates = [history.get(x['name']) for x in self.cases]
+        known = [x for x in estimates if x is not None]
+        if not known:
+            return estimates
+
+        average = sum(known) / len(known)
+        return [x if x is not None else average for x in estimates]
+
+
+class PlanCompiler(object):
+    def __init__(self, path):
+        self.path = path
+        self.errors = []
+
+    def error(self, where, message):
+        self.errors.append(f'{where}: {message}')
+
+    def check_keys(self, where, value, schema):
+        """
+        Check that value is dictionary with known keys of correct types.
+        Return False if the value can not be compiled further.
+        """
+        if type(value) != dict:
+            self.error(where, 'expected dictionary')
+            return False
+
+        for key, item in value.items():
+            if key not in TestPlan.Schema[schema]:
+                self.error(where, f'unknown key "{key}"')
+                continue
+
+            expected = TestPlan.Schema[schema][key]
+            if not isinstance(item, expected) or type(item) == bool:
+                self.error(f'{where}.{key}', f'invalid value "{item}"')
+
+        return True
+
+    def get(self, value, key, types, default):
+        item = value.get(key, None)
+        if item is None or not isinstance(item, types) or type(item) == bool:
+            return default
+
+        return item
+
+    def check_guest(self, where, guest, machines):
+        if guest not in machines:
+            self.error(where, f'guest "{guest}" is not listed in machines')
+
+    def compile_timeout(self, where, value):
+        try:
+            seconds = aio.parse_timeout(value.get('timeout', None))
+        except ValueError as e:
+            self.error(f'{where}.timeout', str(e))
+            return None
+
+        return math.ceil(seconds) if seconds is not None else None
+
+    def compile_strings(self, where, value):
+        if type(value) != list:
+            return []
+
+        for i, item in enumerate(value):
+            if type(item) != str:
+                self.error(f'{where}[{i}]', f'expected string, got "{item}"')
+
+        return [x for x in value if type(x) == str]
+
+    def compile_files(self, where, value, default_guest, machines):
+        files = []
+        for i, item in enumerate(value):
+            item_where = f'{where}[{i}]'
+            if type(item) == str:
+                files.append({'from': default_guest, 'files': [item]})
+                continue
+
+            if not self.check_keys(item_where, item, 'files'):
+                continue
+
+            guest = self.get(item, 'from', str, default_guest)
+            self.check_guest(f'{item_where}.from', guest, machines)
+            files.append({
+                'from': guest,
+                'files': self.compile_strings(
+                    f'{item_where}.files', item.get('files', [])
+                ),
+            })
+
+        return files
+
+    def compile_logs(self, where, value, machines):
+        # Plain paths are followed on all Linux machines
+        logs = []
+        for i, item in enumerate(value):
+            if type(item) != str:
+                logs += self.compile_files(where, [item], machines[0], machines)
+                continue
+
+            for guest in machines:
+                if guest in TestSuiteActor.LinuxGuests:
+                    logs.append({'from': guest, 'files': [item]})
+
+        return logs
+
+    def compile_command(self, where, value, machines, schema):
+        if not self.check_keys(where, value, schema):
+            return None
+
+        if 'shell' not in value:
+            self.error(where, 'missing "shell" key')
+
+        guest = self.get(value, 'run-on', str, machines[0])
+        self.check_guest(f'{where}.run-on', guest, machines)
+
+        return {
+            'run-on': guest,
+            'directory': self.get(
+                value, 'directory', str, TestPlan.DefaultDirectory
+            ),
+            'shell': self.get(value, 'shell', str, 'exit 0'),
+        }
+
+    def compile_task(self, where, value, machines):
+        task = self.compile_command(where, value, machines, 'task')
+        if task is None:
+            return None
+
+        task.update({
+            'name': self.get(value, 'name', str, None),
+            'timeout': self.compile_timeout(where, value),
+            'build-cache': self.get(value, 'build-cache', str, None),
+            'artifacts': self.compile_files(
+                f'{where}.artifacts',
+                self.get(value, 'artifacts', list, []),
+                task['run-on'],
+                machines
+            ),
+        })
+
+        return task
+
+    def compile_case(self, index, value):
+        where = f'[{index}]'
+        if not self.check_keys(where, value, 'case'):
+            return None
+
+        name = self.get(value, 'name', str, None) or f'Test case {index + 1}'
+        where = f'[{index}] {name}'
+
+        machines = self.compile_strings(
+            f'{where}.machines', value.get('machines', None)
+        ) or ['client']
+
+        for guest in machines:
+            if guest not in TestSuiteActor.AllGuests:
+                self.error(f'{where}.machines', f'unknown guest "{guest}"')
+
+        cleanup = self.get(value, 'cleanup', (str, list), [])
+        if type(cleanup) == str:
+            cleanup = [{'shell': cleanup}]
+
+        tasks = [
+            self.compile_task(f'{where}.tasks[{i}]', x, machines)
+            for i, x in enumerate(self.get(value, 'tasks', list, []))
+        ]
+
+        cleanup = [
+            self.compile_command(f'{where}.cleanup[{i}]', x, machines, 'cleanup')
+            for i, x in enumerate(cleanup)
+        ]
+
+        return {
+            'name': name,
+            'machines': machines,
+            'tags': self.compile_strings(
+                f'{where}.tags', value.get('tags', [])
+            ),
+            'timeout': self.compile_timeout(where, value),
+            'tasks': [x for x in tasks if x is not None],
+            'cleanup': [x for x in cleanup if x is not None],
+            'artifacts': self.compile_files(
+                f'{where}.artifacts',
+                self.get(value, 'artifacts', list, []),
+                machines[0],
+                machines
+            ),
+            'logs': self.compile_logs(
+                f'{where}.logs', self.get(value, 'logs', list, []), machines
+            ),
+        }
+
+    def compile(self, suite):
+        if type(suite) != list:
+            raise PlanError(self.path, ['expected list of test cases'])
+
+        cases = [self.compile_case(i, x) for i, x in enumerate(suite)]
+        cases = [x for x in cases if x is not None]
+
+        names = set()
+        for case in cases:
+            if case['name'] in names:
+                self.error(case['name'], 'duplicate test case name')
+            names.add(case['name'])
+
+        if self.errors:
+            raise PlanError(self.path, self.errors)
+
+        return cases
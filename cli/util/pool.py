@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+#
+#    Authors:
+#        Pavel Březina <pbrezina@redhat.com>
+#
+#    Copyright (C) 2019 Red Hat
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import asyncio
+import collections
+import json
+import os
+import socket
+import uuid
+
+
+class PoolError(Exception):
+    pass
+
+
+class PoolTimeoutError(PoolError):
+    pass
+
+
+class PoolClient(object):
+    """
+    Lease warm environment from the pool daemon ('pool serve').
+
+    The lease is bound to the connection. It is returned to the pool when
+    it is released or when the leasing process exits. If the environment
+    is leased by another process, lease() waits until it is returned or
+    until the timeout expires.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.sock = None
+        self.file = None
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            sock.close()
+            return None
+
+        return sock
+
+    def _request(self, file, message):
+        file.write(json.dumps(message).encode('utf-8') + b'\n')
+        file.flush()
+
+        line = file.readline()
+        if not line:
+            raise PoolError('Pool daemon closed the connection')
+
+        reply = json.loads(line)
+        if 'error' in reply:
+            raise PoolError(reply['error'])
+
+        return reply
+
+    def lease(self, guests, timeout=None):
+        """
+        Lease the environment, waiting until it is ready. Return list of
+        selected guests that are running and reset or None if the pool
+        daemon is not running. Raise PoolTimeoutError if the environment
+        is not ready in timeout seconds, None means to wait forever.
+        """
+        sock = self._connect()
+        if sock is None:
+            return None
+
+        sock.settimeout(timeout)
+        file = sock.makefile('rwb')
+        try:
+            reply = self._request(file, {'command': 'lease', 'guests': guests})
+        except socket.timeout:
+            file.close()
+            sock.close()
+            raise PoolTimeoutError(
+                f'Environment is not ready after {timeout} seconds, it is '
+                'probably leased by another run'
+            ) from None
+        except BaseException:
+            file.close()
+            sock.close()
+            raise
+
+        sock.settimeout(None)
+
+        self.sock = sock
+        self.file = file
+        return reply['ready']
+
+    def release(self):
+        if self.sock is None:
+            return
+
+        try:
+            self._request(self.file, {'command': 'release'})
+        finally:
+            self.file.close()
+            self.sock.close()
+            self.sock = None
+            self.file = None
+
+    def status(self):
+        """
+        Return state of the pool or None if the pool daemon is not running.
+        """
+        sock = self._connect()
+        if sock is None:
+            return None
+
+        with sock, sock.makefile('rwb') as file:
+            return self._request(file, {'command': 'status'})
+
+
+class PoolServer(object):
+    """
+    Keep guests of the environment running and ready to be leased.
+
+    Guests that are kept running are chosen by recent demand: guests that
+    were requested by at least DemandRatio of the last MaxDemand leases, as
+    long as their memory fits into memory available on the host. Before the
+    environment is offered again, all guests that could be used by the
+    previous lease are restored by the restore function.
+
+    restore(used, guests) is a blocking function that must bring guests
+    in 'used' to their initial state and start and wait for 'guests'.
+
+    Only one lease is granted at a time, other lease requests wait in order
+    until the environment is returned and restored.
+    """
+
+    MaxDemand = 20
+    DemandRatio = 0.25
+
+    def __init__(
+        self, logger, path, demand_file, default_guests, memory,
+        available_memory, restore
+    ):
+        self.logger = logger
+        self.path = path
+        self.demand_file = demand_file
+        self.default_guests = default_guests
+        self.memory = memory
+        self.available_memory = available_memory
+        self.restore = restore
+
+        self.demand = self.load_demand()
+        self.state = 'starting'
+        self.warm = []
+        self.used = set()
+        self.lease = None
+        self.queued = 0
+        self.idle = None
+        self.lock = None
+        self.leases = None
+
+    def load_demand(self):
+        try:
+            with open(self.demand_file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+
+    def record_demand(self, guests):
+        self.demand.append(sorted(guests))
+        del self.demand[:-self.MaxDemand]
+
+        os.makedirs(os.path.dirname(self.demand_file), exist_ok=True)
+        with open(self.demand_file, 'w') as f:
+            json.dump(self.demand, f, indent=2)
+
+    def select_guests(self):
+        if not self.demand:
+            candidates = list(self.default_guests)
+        else:
+            counts = collections.Counter([y for x in self.demand for y in x])
+            candidates = [
+                guest for guest, count in counts.most_common()
+                if count >= len(self.demand) * self.DemandRatio
+            ]
+
+        selected = []
+        memory = 0
+        for guest in candidates:
+            required = self.memory.get(guest, 0)
+            if memory + required > self.available_memory:
+                self.logger.info(
+                    f'[pool] {guest} does not fit into host memory, '
+                    'it will not be kept running'
+                )
+                continue
+
+            selected.append(guest)
+            memory += required
+
+        return sorted(selected)
+
+    async def refill(self):
+        async with self.lock:
+            await self._refill()
+
+    async def _refill(self):
+        self.state = 'restoring'
+        self.idle.clear()
+
+        guests = self.select_guests()
+        used = sorted(self.used.union(self.warm, guests))
+        self.logger.info(f'[pool] Restoring environment, keeping {guests} '
+                         'running')
+
+        try:
+            await asyncio.to_thread(self.restore, used, guests)
+            self.warm = guests
+            self.used = set()
+            self.state = 'ready'
+            self.logger.info(f'[pool] Environment is ready: {guests}')
+        except Exception as e:
+            self.warm = []
+            self.used = set(used)
+            self.state = 'failed'
+            self.logger.error(f'[pool] Unable to restore environment: {e}')
+
+        self.idle.set()
+
+    async def handle_lease(self, id, reader, message):
+        if self.lease == id:
+            return {'error': 'Environment is already leased'}
+
+        if self.lease is not None:
+            self.logger.info('[pool] Environment is leased, request is queued')
+
+        self.queued += 1
+        try:
+            await self.leases.acquire()
+        finally:
+            self.queued -= 1
+
+        self.lease = id
+        guests = message.get('guests', [])
+        self.record_demand(guests)
+
+        await self.idle.wait()
+
+        # The client may have given up waiting in the queue.
+        if reader.at_eof():
+            self.logger.info('[pool] Queued lease was abandoned')
+            return None
+
+        self.used.update(self.warm, guests)
+        self.state = 'leased'
+        self.logger.info(f'[pool] Environment leased for {guests}')
+
+        return {'ready': [x for x in guests if x in self.warm]}
+
+    def handle_status(self):
+        return {
+            'state': self.state,
+            'warm': self.warm,
+            'leased': self.lease is not None,
+            'queued': self.queued,
+            'demand': dict(collections.Counter(
+                [y for x in self.demand for y in x]
+            )),
+            'leases': len(self.demand),
+        }
+
+    async def handle(self, reader, writer):
+        id = uuid.uuid4().hex
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                message = json.loads(line)
+                command = message.get('command', None)
+                if command == 'lease':
+                    reply = await self.handle_lease(id, reader, message)
+                    if reply is None:
+                        break
+                elif command == 'status':
+                    reply = self.handle_status()
+                elif command == 'release':
+                    reply = {}
+                else:
+                    reply = {'error': f'Unknown command: {command}'}
+
+                writer.write(json.dumps(reply).encode('utf-8') + b'\n')
+                await writer.drain()
+
+                if command == 'release':
+                    break
+        except (ConnectionError, ValueError) as e:
+            self.logger.error(f'[pool] Invalid request: {e}')
+        finally:
+            writer.close()
+            if self.lease == id:
+                self.lease = None
+                if self.state == 'leased':
+                    self.logger.info('[pool] Environment returned')
+                    # Next lease must wait for the restore
+                    self.idle.clear()
+                    asyncio.ensure_future(self.refill())
+
+                self.leases.release()
+
+    async def serve(self):
+        self.idle = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.leases = asyncio.Lock()
+
+        status = await asyncio.to_thread(PoolClient(self.path).status)
+        if status is not None:
+            raise PoolError(f'Pool daemon is already running at {self.path}')
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+        server = await asyncio.start_unix_server(self.handle, path=self.path)
+        try:
+            async with server:
+                await self.refill()
+                await server.serve_forever()
+        finally:
+            if os.path.exists(self.path):
+                os.remove(self.path)
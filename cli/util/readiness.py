@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+#
+#    Authors:
+#        Pavel Březina <pbrezina@redhat.com>
+#
+#    Copyright (C) 2019 Red Hat
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import asyncio
+import random
+import socket
+import ssl
+import struct
+import time
+
+from util import aio
+from util.environment import Environment
+
+
+class ProbeNotReady(Exception):
+    """
+    Service is reachable but it is not yet able to serve requests.
+    """
+    pass
+
+
+def _der(tag, content):
+    length = len(content)
+    if length < 0x80:
+        return bytes([tag, length]) + content
+
+    encoded = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+    return bytes([tag, 0x80 | len(encoded)]) + encoded + content
+
+
+def _der_int(value):
+    return _der(0x02, value.to_bytes((value.bit_length() + 8) // 8, 'big'))
+
+
+def _der_str(tag, value):
+    return _der(tag, value.encode('utf-8'))
+
+
+def _der_seq(*items):
+    return _der(0x30, b''.join(items))
+
+
+def _der_ctx(number, content):
+    return _der(0xa0 | number, content)
+
+
+class Probe(object):
+    """
+    Base class for readiness probes.
+
+    Method check() must return if the service is ready, raise ProbeNotReady
+    if the service is reachable but not ready yet, or raise OSError if it is
+    not reachable at all.
+    """
+
+    name = None
+
+    def __init__(self, host, port, timeout=5):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    def __str__(self):
+        return f'{self.name} ({self.host}:{self.port})'
+
+    def connect(self):
+        return socket.create_connection(
+            (self.host, self.port), timeout=self.timeout
+        )
+
+    def recv(self, sock, size=4096):
+        data = sock.recv(size)
+        if not data:
+            raise ProbeNotReady('Connection closed by remote host')
+
+        return data
+
+    def check(self):
+        raise NotImplementedError()
+
+
+class SSHProbe(Probe):
+    name = 'SSH'
+
+    def __init__(self, host, port=22, **kwargs):
+        super().__init__(host, port, **kwargs)
+
+    def check(self):
+        with self.connect() as sock:
+            if not self.recv(sock).startswith(b'SSH-'):
+                raise ProbeNotReady('Unexpected SSH banner')
+
+
+class LDAPProbe(Probe):
+    """
+    Read LDAP rootDSE with anonymous bind.
+    """
+
+    name = 'LDAP'
+
+    def __init__(self, host, port=389, **kwargs):
+        super().__init__(host, port, **kwargs)
+
+    def request(self):
+        search = _der(0x63, b''.join([
+            _der_str(0x04, ''),                # baseObject
+            _der(0x0a, b'\x00'),               # scope: baseObject
+            _der(0x0a, b'\x00'),               # derefAliases: never
+            _der_int(0),                       # sizeLimit
+            _der_int(0),                       # timeLimit
+            _der(0x01, b'\x00'),               # typesOnly
+            _der_str(0x87, 'objectClass'),     # filter: present
+            _der_seq()                         # attributes
+        ]))
+
+        return _der_seq(_der_int(1), search)
+
+    def check(self):
+        with self.connect() as sock:
+            sock.sendall(self.request())
+            data = self.recv(sock)
+
+        # SEQUENCE { messageID 1, SearchResultEntry }
+        if len(data) < 2 or data[0] != 0x30:
+            raise ProbeNotReady('Invalid LDAP response')
+
+        offset = 2 if data[1] < 0x80 else 2 + (data[1] & 0x7f)
+        if data[offset:offset + 3] != b'\x02\x01\x01':
+            raise ProbeNotReady('Invalid LDAP message id')
+
+        if data[offset + 3:offset + 4] != b'\x64':
+            raise ProbeNotReady('rootDSE is not available')
+
+
+class KerberosProbe(Probe):
+    """
+    Send AS-REQ for a non-existing principal. Any KRB-ERROR reply means that
+    the KDC is serving the realm.
+    """
+
+    name = 'Kerberos'
+
+    def __init__(self, host, realm, port=88, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.realm = realm
+
+    def principal(self, type, *names):
+        return _der_seq(
+            _der_ctx(0, _der_int(type)),
+            _der_ctx(1, _der_seq(*[_der_str(0x1b, x) for x in names]))
+        )
+
+    def request(self):
+        body = _der_seq(
+            _der_ctx(0, _der(0x03, b'\x00\x00\x00\x00\x00')),
+            _der_ctx(1, self.principal(1, 'sssd-test-suite-probe')),
+            _der_ctx(2, _der_str(0x1b, self.realm)),
+            _der_ctx(3, self.principal(2, 'krbtgt', self.realm)),
+            _der_ctx(5, _der_str(0x18, '20370913024805Z')),
+            _der_ctx(7, _der_int(random.randint(0, 0x7fffffff))),
+            _der_ctx(8, _der_seq(_der_int(18), _der_int(17)))
+        )
+
+        request = _der(0x6a, _der_seq(
+            _der_ctx(1, _der_int(5)),
+            _der_ctx(2, _der_int(10)),
+            _der_ctx(4, body)
+        ))
+
+        return struct.pack('>I', len(request)) + request
+
+    def check(self):
+        with self.connect() as sock:
+            sock.sendall(self.request())
+            data = self.recv(sock)
+
+        # KRB-ERROR [APPLICATION 30] or AS-REP [APPLICATION 11]
+        if len(data) < 5 or data[4] not in (0x7e, 0x6b):
+            raise ProbeNotReady('Invalid Kerberos response')
+
+
+class DNSProbe(Probe):
+    """
+    Query SOA record of the zone over UDP.
+    """
+
+    name = 'DNS'
+
+    def __init__(self, host, zone, port=53, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.zone = zone
+
+    def request(self, id):
+        header = struct.pack('>HHHHHH', id, 0x0100, 1, 0, 0, 0)
+        qname = b''.join([
+            bytes([len(x)]) + x.encode('utf-8') for x in self.zone.split('.')
+        ]) + b'\x00'
+
+        return header + qname + struct.pack('>HH', 6, 1)
+
+    def check(self):
+        id = random.randint(0, 0xffff)
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.sendto(self.request(id), (self.host, self.port))
+            data = sock.recv(4096)
+
+        try:
+            (rid, flags, _, ancount) = struct.unpack('>HHHH', data[:8])
+        except struct.error:
+            raise ProbeNotReady('Truncated DNS response')
+
+        if rid != id:
+            raise ProbeNotReady('Invalid DNS response')
+
+        if flags & 0x000f != 0 or ancount == 0:
+            raise ProbeNotReady(f'Zone {self.zone} is not available')
+
+
+class WinRMProbe(Probe):
+    name = 'WinRM'
+
+    def __init__(self, host, port=5986, **kwargs):
+        super().__init__(host, port, **kwargs)
+
+    def check(self):
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+
+        with self.connect() as raw:
+            with context.wrap_socket(raw) as sock:
+                sock.sendall((
+                    f'POST /wsman HTTP/1.1\r\n'
+                    f'Host: {self.host}:{self.port}\r\n'
+                    f'Content-Length: 0\r\n'
+                    f'Connection: close\r\n\r\n'
+                ).encode('utf-8'))
+
+                if not self.recv(sock).startswith(b'HTTP/1.1 '):
+                    raise ProbeNotReady('Invalid WinRM response')
+
+
+class ReadinessChecker(object):
+    """
+    Poll probes concurrently until all of them succeed.
+
+    Each probe is retried with exponential backoff. If the service is
+    reachable but not ready yet, the delay is reset to the minimal value
+    since the service is most probably just starting.
+    """
+
+    def __init__(self, logger, timeout=900, min_delay=1, max_delay=15):
+        self.logger = logger
+        self.timeout = timeout
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+
+    async def _poll(self, guest, probe, deadline):
+        delay = self.min_delay
+        start = time.monotonic()
+        while True:
+            try:
+                # Probes use blocking sockets with their own timeout.
+                async with aio.limits('probe'):
+                    await asyncio.to_thread(probe.check)
+
+                elapsed = time.monotonic() - start
+                self.logger.info(f'{guest}: {probe} is ready ({elapsed:.1f}s)')
+                return
+            except ProbeNotReady as e:
+                error = e
+                delay = self.min_delay
+            except OSError as e:
+                error = e
+                delay = min(delay * 2, self.max_delay)
+
+            if time.monotonic() + delay > deadline:
+                raise TimeoutError(f'{guest}: {probe} is not ready: {error}')
+
+            await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+
+    async def wait_async(self, probes):
+        deadline = time.monotonic() + self.timeout
+        results = await asyncio.gather(*[
+            self._poll(guest, probe, deadline)
+            for guest, items in probes.items() for probe in items
+        ], return_exceptions=True)
+
+        errors = [x for x in results if isinstance(x, BaseException)]
+        for error in errors:
+            if not isinstance(error, TimeoutError):
+                raise error
+
+        if errors:
+            raise TimeoutError('\n'.join([str(x) for x in errors]))
+
+    def wait(self, probes):
+        """
+        Wait until all probes are ready. Probes is a dictionary of
+        guest -> list of probes.
+        """
+        aio.run(self.wait_async(probes))
+
+
+def get_probes(guest):
+    """
+    Readiness probes of services provided by selected guest.
+    """
+    ip = Environment.ip(guest)
+    probes = {
+        'ipa': lambda: [
+            SSHProbe(ip),
+            LDAPProbe(ip),
+            KerberosProbe(ip, 'IPA.VM'),
+            DNSProbe(ip, 'ipa.vm'),
+        ],
+        'ldap': lambda: [
+            SSHProbe(ip),
+            LDAPProbe(ip),
+        ],
+        'client': lambda: [
+            SSHProbe(ip),
+        ],
+        'ad': lambda: [
+            WinRMProbe(ip),
+            LDAPProbe(ip),
+            KerberosProbe(ip, 'AD.VM'),
+            DNSProbe(ip, 'ad.vm'),
+        ],
+        'ad-child': lambda: [
+            WinRMProbe(ip),
+            LDAPProbe(ip),
+            KerberosProbe(ip, 'CHILD.AD.VM'),
+            DNSProbe(ip, 'child.ad.vm'),
+        ],
+    }
+
+    return probes[guest]()
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+#
+#    Authors:
+#        Pavel Březina <pbrezina@redhat.com>
+#
+#    Copyright (C) 2019 Red Hat
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import argparse
+import datetime
+import heapq
+import json
+import os
+import threading
+
+import nutcli.decorators
+
+
+class TestResults(object):
+    """
+    Status and duration of each test case of one test run.
+    """
+
+    Passed = 'passed'
+    Failed = 'failed'
+    Skipped = 'skipped'
+
+    def __init__(self, shard=None, cases=None, key=None, path=None):
+        """
+        :param key: Identification of what was tested (SSSD revision and
+            box versions), results can be reused only with the same key.
+        :param path: If set, results are saved after each recorded case.
+        """
+        self.shard = shard
+        self.cases = cases if cases is not None else []
+        self.key = key
+        self.path = path
+        self.lock = threading.Lock()
+
+    def record(self, name, status, duration, error=None):
+        with self.lock:
+            self.cases.append({
+                'name': name,
+                'status': status,
+                'duration': round(duration, 3),
+                'error': error,
+                'finished': datetime.datetime.now().isoformat(),
+            })
+
+            if self.path is not None:
+                self.save(self.path)
+
+    def reuse(self, case):
+        """
+        Take over result of a test case from previous run.
+        """
+        with self.lock:
+            self.cases.append({**case, 'reused': True})
+
+    def get(self, name):
+        for case in self.cases:
+            if case['name'] == name:
+                return case
+
+        return None
+
+    @property
+    def failed(self):
+        return [x for x in self.cases if x['status'] == self.Failed]
+
+    @property
+    def passed(self):
+        return [x for x in self.cases if x['status'] == self.Passed]
+
+    def to_dict(self):
+        return {
+            'shard': self.shard,
+            'key': self.key,
+            'cases': self.cases,
+        }
+
+    @nutcli.decorators.SideEffect()
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+
+        return cls(
+            data.get('shard', None),
+            data.get('cases', []),
+            data.get('key', None)
+        )
+
+    @classmethod
+    def merge(cls, results):
+        merged = cls()
+        for result in results:
+            merged.cases.extend(result.cases)
+
+        return merged
+
+
+class TestHistory(object):
+    """
+    Recent durations of test cases, used to balance shards.
+
+    Only durations of passed test cases are remembered since failed ones
+    usually finish early.
+    """
+
+    MaxEntries = 5
+
+    def __init__(self, durations=None):
+        self.durations = durations if durations is not None else {}
+
+    def get(self, name):
+        durations = self.durations.get(name, [])
+        if not durations:
+            return None
+
+        return sum(durations) / len(durations)
+
+    def update(self, results):
+        for case in results.cases:
+            if case['status'] != TestResults.Passed or case.get('reused'):
+                continue
+
+            durations = self.durations.setdefault(case['name'], [])
+            durations.append(case['duration'])
+            del durations[:-self.MaxEntries]
+
+    @nutcli.decorators.SideEffect()
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.durations, f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load history from history file or from results file of a test run
+        (e.g. merged results of previous CI run).
+        """
+        if not os.path.exists(path):
+            return cls()
+
+        with open(path) as f:
+            data = json.load(f)
+
+        if 'cases' not in data:
+            return cls(data)
+
+        history = cls()
+        history.update(TestResults(cases=data['cases']))
+        return history
+
+
+def parse_shard(value):
+    """
+    Parse shard specification "K/N" into (K, N) where 1 <= K <= N.
+    """
+    try:
+        k, n = [int(x) for x in value.split('/')]
+    except ValueError:
+        raise ValueError(f'Invalid shard "{value}", expected K/N') from None
+
+    if n < 1 or k < 1 or k > n:
+        raise ValueError(f'Invalid shard "{value}", expected 1 <= K <= N')
+
+    return (k, n)
+
+
+def shard_argument(value):
+    """
+    Argparse type of --shard option, value is kept as "K/N" string.
+    """
+    try:
+        parse_shard(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e)) from None
+
+    return value
+
+
+def select_shard(names, k, n, history):
+    """
+    Split test cases into N shards and return indices of cases in shard K.
+
+    If there is any history, cases are packed longest processing time
+    first, each case is given to the shard with the lowest total duration.
+    Cases without history are estimated with average of known durations.
+    Without any history, cases are distributed round-robin.
+
+    The selection is deterministic so all hosts compute the same split.
+    Original order of the cases is kept inside the shard.
+    """
+    estimates = [history.get(name) for name in names]
+    known = [x for x in estimates if x is not None]
+
+    if not known:
+        return [i for i in range(len(names)) if i % n == k - 1]
+
+    average = sum(known) / len(known)
+    estimates = [x if x is not None else average for x in estimates]
+
+    order = sorted(range(len(names)), key=lambda i: (-estimates[i], i))
+    shards = [(0, shard, []) for shard in range(n)]
+    heapq.heapify(shards)
+
+    for i in order:
+        load, shard, cases = heapq.heappop(shards)
+        cases.append(i)
+        heapq.heappush(shards, (load + estimates[i], shard, cases))
+
+    for load, shard, cases in shards:
+        if shard == k - 1:
+            return sorted(cases)
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+#
+#    Authors:
+#        Pavel Březina <pbrezina@redhat.com>
+#
+#    Copyright (C) 2019 Red Hat
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import math
+import os
+
+
+class GuestSizing(object):
+    """
+    Assign vCPUs and memory to guests based on host capacity.
+
+    Configuration (optional "sizing" section of config.json):
+
+    - policy: "fixed" (default) or "auto"
+      - fixed: each guest gets one vCPU and memory set in the box section
+      - auto: host CPUs are distributed among guests by their weight and
+        memory is scaled up to max_memory_factor if the host has enough of it
+    - environments: number of environments to size for (default 1)
+    - reserved_cpus: CPUs left to the host (default 1)
+    - reserved_memory: memory in MB left to the host (default 2048)
+    - max_cpus: maximum vCPUs per guest (default 4)
+    - max_memory_factor: maximum memory multiplier (default 2)
+    """
+
+    Weights = {
+        'client': 4,
+        'ipa': 2,
+        'ad': 2,
+        'ad-child': 2,
+        'ldap': 1,
+    }
+
+    def __init__(self, config, host_cpus=None, host_memory=None):
+        boxes = config.get('boxes', {})
+        sizing = config.get('sizing', {})
+
+        self.policy = sizing.get('policy', 'fixed')
+        self.environments = max(1, sizing.get('environments', 1))
+        self.reserved_cpus = sizing.get('reserved_cpus', 1)
+        self.reserved_memory = sizing.get('reserved_memory', 2048)
+        self.max_cpus = sizing.get('max_cpus', 4)
+        self.max_memory_factor = sizing.get('max_memory_factor', 2)
+
+        if self.policy not in ('auto', 'fixed'):
+            raise ValueError(f'Unknown sizing policy: {self.policy}')
+
+        self.host_cpus = host_cpus if host_cpus else os.cpu_count()
+        self.host_memory = host_memory if host_memory else self.read_memory()
+
+        # Only guests with a box are created.
+        self.base_memory = {
+            guest: box.get('memory', 0) for guest, box in boxes.items()
+            if box.get('name', None)
+        }
+
+        self.cpus = {}
+        self.memory = {}
+        self.compute()
+
+    @classmethod
+    def from_file(cls, path):
+        try:
+            with open(path) as f:
+                return cls(json.load(f))
+        except FileNotFoundError:
+            return cls({})
+
+    @staticmethod
+    def read_memory():
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1]) // 1024
+
+        return 0
+
+    @property
+    def available_cpus(self):
+        return max(1, self.host_cpus - self.reserved_cpus)
+
+    @property
+    def available_memory(self):
+        return max(0, self.host_memory - self.reserved_memory)
+
+    @property
+    def capacity(self):
+        """
+        Number of environments that fit into host memory with configured
+        memory per guest. CPUs can be overcommitted so they are not counted.
+        """
+        total = sum(self.base_memory.values())
+        if not total:
+            return 0
+
+        return self.available_memory // total
+
+    def compute(self):
+        if self.policy == 'fixed' or not self.base_memory:
+            self.cpus = {guest: 1 for guest in self.base_memory}
+            self.memory = dict(self.base_memory)
+            return
+
+        cpus = self.available_cpus / self.environments
+        memory = self.available_memory / self.environments
+        weights = sum([self.Weights.get(x, 1) for x in self.base_memory])
+
+        total = sum(self.base_memory.values())
+        factor = min(self.max_memory_factor, memory / total) if total else 1
+        factor = max(1, factor)
+
+        for guest, base in self.base_memory.items():
+            share = cpus * self.Weights.get(guest, 1) / weights
+            self.cpus[guest] = min(max(1, math.floor(share)), self.max_cpus)
+            self.memory[guest] = max(base, int(base * factor) // 256 * 256)
+
+    def get_env(self):
+        """
+        Environment variables that pass the choices to the Vagrantfile.
+        """
+        return {
+            'SSSD_TEST_SUITE_CPUS': ' '.join(
+                [f'{g}:{c}' for g, c in sorted(self.cpus.items())]
+            ),
+            'SSSD_TEST_SUITE_MEMORY': ' '.join(
+                [f'{g}:{m}' for g, m in sorted(self.memory.items())]
+            ),
+        }
+
+    def describe(self):
+        lines = [
+            f'Host: {self.host_cpus} CPUs, {self.host_memory} MB memory',
+            f'Sizing policy: {self.policy} '
+            f'(sized for {self.environments} environment(s), '
+            f'host can run {self.capacity} environment(s))',
+        ]
+
+        for guest in sorted(self.base_memory):
+            lines.append(
+                f'  {guest:10s} {self.cpus[guest]} vCPU(s), '
+                f'{self.memory[guest]} MB'
+            )
+
+        return lines
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+#    Authors:
+#        Pavel Březina <pbrezina@redhat.com>
+#
+#    Copyright (C) 2019 Red Hat
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import asyncio
+import subprocess
+
+from util import aio
+from util.environment import Environment
+from util.machine import VagrantMachine
+
+
+class GuestStatus(object):
+    """
+    State of guests read from .vagrant directory, libvirt and running qemu
+    processes without running vagrant.
+    """
+
+    def __init__(self, logger, project_dir):
+        self.logger = logger
+        self.project_dir = project_dir
+
+    def get_uptimes(self):
+        """
+        Return dictionary of libvirt domain uuid -> seconds since its qemu
+        process was started.
+        """
+        result = subprocess.run(
+            ['ps', '-eo', 'etimes=,args='],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL
+        )
+
+        uptimes = {}
+        for line in result.stdout.decode('utf-8', 'replace').splitlines():
+            etimes, _, args = line.strip().partition(' ')
+            args = args.split()
+            if '-uuid' in args and args.index('-uuid') + 1 < len(args):
+                uptimes[args[args.index('-uuid') + 1]] = int(etimes)
+
+        return uptimes
+
+    async def get_state(self, virsh, machine):
+        if machine.id is None:
+            return 'not created'
+
+        # Do not run virsh for each guest if libvirt is not accessible
+        if await virsh.connect() is not None:
+            return 'unknown'
+
+        state = await virsh.domstate(machine.id)
+        return state if state is not None else 'unknown'
+
+    async def collect_async(self, guests):
+        virsh = aio.Virsh(self.logger)
+        machines = [VagrantMachine(self.project_dir, x) for x in guests]
+        states = await asyncio.gather(
+            *[self.get_state(virsh, x) for x in machines]
+        )
+        uptimes = await asyncio.to_thread(self.get_uptimes)
+
+        status = {}
+        for guest, machine, state in zip(guests, machines, states):
+            status[guest] = {
+                'state': state,
+                'id': machine.id,
+                'ip': Environment.ip(guest),
+                'box': {
+                    'name': machine.box_name,
+                    'version': machine.box_version,
+                },
+                'uptime': uptimes.get(machine.id, None)
+                if state == 'running' else None,
+            }
+
+        return status
+
+    def collect(self, guests):
+        """
+        Return dictionary of guest -> state, id, ip, box and uptime.
+        """
+        return aio.run(self.collect_async(guests))
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+#
+#    Authors:
+#        Pavel Březina <pbrezina@redhat.com>
+#
+#    Copyright (C) 2019 Red Hat
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import asyncio
+import csv
+import json
+import os
+import re
+import time
+
+import nutcli.decorators
+
+from util import aio
+
+
+class TelemetrySampler(object):
+    """
+    Periodically sample resource usage of guests and host.
+
+    Guest statistics are read from libvirt with 'virsh domstats', host
+    statistics from /proc. Samples are appended to CSV files as they are
+    taken so they are kept even if the test case is interrupted:
+
+    - $output_dir/$name.guests.csv: cumulative counters of each guest
+    - $output_dir/$name.host.csv: host load and available memory
+
+    When the sampler is stopped, $output_dir/$name.summary.json with per
+    guest averages and peaks is written.
+    """
+
+    GuestColumns = [
+        'time', 'guest', 'vcpus', 'cpu_time', 'rss', 'balloon',
+        'block_rd_bytes', 'block_wr_bytes', 'net_rx_bytes', 'net_tx_bytes'
+    ]
+
+    HostColumns = ['time', 'load1', 'load5', 'mem_available', 'swap_free']
+
+    # Libvirt connection error is reported only once per run
+    warned = False
+
+    def __init__(self, logger, name, machines, output_dir, interval=10):
+        """
+        :param machines: Dictionary guest: libvirt domain id.
+        """
+        self.logger = logger
+        self.name = re.sub(r'[^\w.-]+', '-', name).strip('-')
+        self.machines = machines
+        self.output_dir = output_dir
+        self.interval = interval
+        self.samples = {guest: [] for guest in machines}
+        self.host = []
+        self.virsh = aio.Virsh(logger)
+        self.stop_event = None
+        self.future = None
+
+    @property
+    def prefix(self):
+        return f'{self.output_dir}/{self.name}'
+
+    @nutcli.decorators.SideEffect()
+    def start(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.future = aio.submit(self._run())
+
+    @nutcli.decorators.SideEffect()
+    def stop(self):
+        if self.future is None:
+            return
+
+        aio.run(self._stop())
+        self.future = None
+
+        summary = self.summarize()
+        with open(f'{self.prefix}.summary.json', 'w') as f:
+            json.dump(summary, f, indent=2)
+
+        for guest, values in summary['guests'].items():
+            self.logger.info(
+                '{}: cpu avg {:.0f}% max {:.0f}%, rss max {:.0f} MiB, '
+                'disk read {:.0f} MiB written {:.0f} MiB'.format(
+                    guest, values['cpu_avg'], values['cpu_max'],
+                    values['rss_max_mib'], values['block_rd_mib'],
+                    values['block_wr_mib']
+                )
+            )
+
+        self.logger.info('host: load max {:.2f}, available memory min '
+                         '{:.0f} MiB'.format(summary['host']['load1_max'],
+                                             summary['host']['mem_available_min_mib']))
+
+    async def _stop(self):
+        if self.stop_event is not None:
+            self.stop_event.set()
+
+        await asyncio.wrap_future(self.future)
+
+    async def _run(self):
+        self.stop_event = asyncio.Event()
+
+        error = await self.virsh.connect() if self.machines else None
+        if error is not None:
+            if not TelemetrySampler.warned:
+                self.logger.warning(
+                    f'Unable to read guest statistics from libvirt, only '
+                    f'host is sampled: {error}'
+                )
+                TelemetrySampler.warned = True
+
+            self.machines = {}
+
+        with open(f'{self.prefix}.guests.csv', 'w', newline='') as guests_file, \
+             open(f'{self.prefix}.host.csv', 'w', newline='') as host_file:
+            guests_csv = csv.DictWriter(guests_file, self.GuestColumns)
+            host_csv = csv.DictWriter(host_file, self.HostColumns)
+            guests_csv.writeheader()
+            host_csv.writeheader()
+
+            while not self.stop_event.is_set():
+                now = round(time.time(), 1)
+                samples = await asyncio.gather(*[
+                    self.sample_guest(domain)
+                    for domain in self.machines.values()
+                ])
+
+                for guest, sample in zip(self.machines.keys(), samples):
+                    if sample is None:
+                        continue
+
+                    sample = {'time': now, 'guest': guest, **sample}
+                    self.samples[guest].append(sample)
+                    guests_csv.writerow(sample)
+
+                sample = {'time': now, **self.sample_host()}
+                self.host.append(sample)
+                host_csv.writerow(sample)
+
+                guests_file.flush()
+                host_file.flush()
+
+                try:
+                    await asyncio.wait_for(
+                        self.stop_event.wait(), self.interval
+                    )
+                except asyncio.TimeoutError:
+                    pass
+
+    async def sample_guest(self, domain):
+        stats = await self.virsh.domstats(
+            domain, '--cpu-total', '--balloon', '--vcpu', '--block',
+            '--interface'
+        )
+
+        if stats is None:
+            return None
+
+        def get(key):
+            try:
+                return int(stats.get(key, 0))
+            except ValueError:
+                return 0
+
+        def total(regex):
+            return sum([
+                int(value) for key, value in stats.items()
+                if re.fullmatch(regex, key) and value.isdigit()
+            ])
+
+        return {
+            'vcpus': get('vcpu.current'),
+            'cpu_time': get('cpu.time'),
+            'rss': get('balloon.rss'),
+            'balloon': get('balloon.current'),
+            'block_rd_bytes': total(r'block\.\d+\.rd\.bytes'),
+            'block_wr_bytes': total(r'block\.\d+\.wr\.bytes'),
+            'net_rx_bytes': total(r'net\.\d+\.rx\.bytes'),
+            'net_tx_bytes': total(r'net\.\d+\.tx\.bytes'),
+        }
+
+    def sample_host(self):
+        load1, load5, _ = os.getloadavg()
+        meminfo = {}
+        with open('/proc/meminfo') as f:
+            for line in f:
+                key, value = line.split(':', 1)
+                meminfo[key] = int(value.split()[0])
+
+        return {
+            'load1': load1,
+            'load5': load5,
+            'mem_available': meminfo.get('MemAvailable', 0),
+            'swap_free': meminfo.get('SwapFree', 0),
+        }
+
+    def summarize(self):
+        mib = 1024 * 1024
+        guests = {}
+        for guest, samples in self.samples.items():
+            if not samples:
+                continue
+
+            usage = []
+            for prev, curr in zip(samples, samples[1:]):
+                elapsed = (curr['time'] - prev['time']) * 1e9
+                vcpus = max(curr['vcpus'], 1)
+                if elapsed > 0:
+                    usage.append(
+                        100 * (curr['cpu_time'] - prev['cpu_time'])
+                        / elapsed / vcpus
+                    )
+
+            first, last = samples[0], samples[-1]
+            guests[guest] = {
+                'samples': len(samples),
+                'cpu_avg': sum(usage) / len(usage) if usage else 0,
+                'cpu_max': max(usage) if usage else 0,
+                # balloon statistics are in KiB
+                'rss_max_mib': max([x['rss'] for x in samples]) / 1024,
+                'memory_mib': last['balloon'] / 1024,
+                'block_rd_mib': (last['block_rd_bytes'] - first['block_rd_bytes']) / mib,
+                'block_wr_mib': (last['block_wr_bytes'] - first['block_wr_bytes']) / mib,
+                'net_rx_mib': (last['net_rx_bytes'] - first['net_rx_bytes']) / mib,
+                'net_tx_mib': (last['net_tx_bytes'] - first['net_tx_bytes']) / mib,
+            }
+
+        return {
+            'interval': self.interval,
+            'guests': guests,
+            'host': {
+                'load1_max': max([x['load1'] for x in self.host], default=0),
+                'mem_available_min_mib': min(
+                    [x['mem_available'] for x in self.host], default=0
+                ) / 1024,
+                'swap_free_min_mib': min(
+                    [x['swap_free'] for x in self.host], default=0
+                ) / 1024,
+            }
+        }
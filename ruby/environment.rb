@@ -0,0 +1,34 @@
+require 'json'
+require_relative './machine.rb'
+
+# Environment generated by the cli (see cli/util/environment.py). All
+# values are resolved there, nothing is computed here.
+class TestEnvironment
+  def initialize(file)
+    @environment = JSON.parse(File.read(file))
+  end
+
+  def getMachines()
+    @environment["machines"].map do |m|
+      Machine.new(
+        name: m["name"],
+        type: if m["type"] == "windows" then Machine::WINDOWS else Machine::LINUX end,
+        hostname: m["hostname"],
+        ip: m["ip"],
+        memory: m["memory"],
+        cpus: m["cpus"],
+        box: m["box"],
+        url: m["url"]
+      )
+    end
+  end
+
+  def getFolders(type)
+    folders = {}
+    ((@environment["folders"] || {})[type] || []).each do |host, guest|
+      folders[host] = guest
+    end
+
+    return folders
+  end
+end
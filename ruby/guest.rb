@@ -1,8 +1,7 @@
-require_relative './config.rb'
 require_relative './machine.rb'
 
 class Guest
-  def self.Add(config, vagrant_config, machine)
+  def self.Add(environment, vagrant_config, machine)
     vagrant_config.vm.define machine.name do |this|
       this.vm.box = machine.box
       this.vm.box_url = machine.url
@@ -11,6 +10,9 @@ class Guest
 
       this.vm.provider :libvirt do |libvirt|
         libvirt.memory = machine.memory
+        if not machine.cpus.nil? and machine.cpus > 0
+          libvirt.cpus = machine.cpus
+        end
         libvirt.storage_pool_name = "sssd-test-suite"
 
         # Creating new private networks requires system connection.
@@ -21,25 +23,41 @@ class Guest
 
       case machine.type
       when Machine::LINUX
-        SetLinux(this, config)
+        SetLinux(this, environment)
       when Machine::WINDOWS
-        SetWindows(this, config)
+        SetWindows(this, environment)
       end
     end
   end
 
-  def self.SetLinux(this, config)
+  def self.SetLinux(this, environment)
     this.vm.synced_folder ".", "/vagrant", disabled: true
 
-    config.getFolders("sshfs", "SSSD_TEST_SUITE_SSHFS").each do |host, guest|
+    environment.getFolders("sshfs").each do |host, guest|
       this.vm.synced_folder "#{host}", "#{guest}", type: "sshfs", sshfs_opts_append: "-o cache=no"
     end
 
-    config.getFolders("nfs", "SSSD_TEST_SUITE_NFS").each do |host, guest|
+    # Only safe for folders that are not modified from both sides.
+    environment.getFolders("sshfs-cached").each do |host, guest|
+      this.vm.synced_folder "#{host}", "#{guest}", type: "sshfs", sshfs_opts_append: "-o cache=yes -o kernel_cache"
+    end
+
+    virtiofs = environment.getFolders("virtiofs")
+    virtiofs.each do |host, guest|
+      this.vm.synced_folder "#{host}", "#{guest}", type: "virtiofs"
+    end
+
+    if not virtiofs.empty?
+      this.vm.provider :libvirt do |libvirt|
+        libvirt.memorybacking :access, :mode => "shared"
+      end
+    end
+
+    environment.getFolders("nfs").each do |host, guest|
       this.vm.synced_folder "#{host}", "#{guest}", type: "nfs", nfs_udp: false
     end
 
-    config.getFolders("rsync", "SSSD_TEST_SUITE_RSYNC").each do |host, guest|
+    environment.getFolders("rsync").each do |host, guest|
       this.vm.synced_folder "#{host}", "#{guest}", type: "rsync"
     end
 
@@ -48,16 +66,18 @@ class Guest
     end
   end
 
-  def self.SetWindows(this, config)
+  def self.SetWindows(this, environment)
     this.vm.guest = :windows
     this.vm.communicator = "winrm"
 
     # Dot means that we will join into default (or empty) domain.
     this.winrm.username = ".\\Administrator"
 
-    # Avoid timeouting issues for initial WinRM connection.
-    this.winrm.retry_limit = 50
-    this.winrm.retry_delay = 10
+    # Avoid timeouting issues for initial WinRM connection. Poll often so
+    # the guest is used as soon as possible, the overall limit is the same.
+    # Services provided by the guest are checked later by the cli.
+    this.winrm.retry_limit = 250
+    this.winrm.retry_delay = 2
   end
 
   private_class_method :SetLinux, :SetWindows
@@ -1,7 +1,5 @@
-require_relative './config.rb'
-
 class Machine
-  attr_reader :name, :type, :hostname, :ip, :memory, :box, :url
+  attr_reader :name, :type, :hostname, :ip, :memory, :cpus, :box, :url
 
   LINUX   = 1
   WINDOWS = 2
@@ -12,22 +10,17 @@ class Machine
     hostname:,
     ip:,
     memory: nil,
+    cpus: nil,
     box: nil,
-    url: nil,
-    config: nil
+    url: nil
   )
     @name = name
     @type = type
     @ip = ip
     @hostname = hostname
     @memory = memory
+    @cpus = cpus
     @box = box
     @url = url
-
-    if not config.nil?
-      @memory = if memory.nil? then config.getMemory(name) end
-      @box = if box.nil? then config.getBox(type, name) end
-      @url = if url.nil? then config.getBoxURL(name) end
-    end
   end
 end